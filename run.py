@@ -3,14 +3,24 @@ from twisted.python import log
 from twisted.web.server import Site
 
 import os
+import signal
+import socket
 import sys
+import tempfile
 
-from alchimia import TWISTED_STRATEGY
-from sqlalchemy import create_engine
-
-from vc.sql import SQLVoteStore
+from vc.sql import SQLVoteStore, createEngine
+from vc.partition import VotePartitioner
+from vc.export import VoteExporter
+from vc.rollup import RollupAggregator
+from vc.cache import CachedVoteStore
 from vc.token import TimedTokenDispenser, MemoryStore
+from vc.shm import SharedMemoryStore
+from vc.persist import StoreJournal
 from vc.web import VoteCounter, RecaptchaVerifier
+from vc.prefork import WorkerPool, listeningSocket
+from vc.admission import AdmissionController
+from vc.profiling import Profiler
+from vc.metrics import REGISTRY, ReactorLagMonitor
 
 
 @defer.inlineCallbacks
@@ -30,6 +40,20 @@ def start(reactor):
 
     port = int(os.environ.get('PORT', 9003))
 
+    # Where captcha answers are checked, how many checks may be in flight at
+    # once, and how many seconds a check may take.
+    captcha_verify_url = os.environ.get('CAPTCHA_VERIFY_URL', None)
+    captcha_concurrency = int(os.environ.get('CAPTCHA_CONCURRENCY', 10))
+    captcha_timeout = float(os.environ.get('CAPTCHA_TIMEOUT', 10))
+
+    # Number of worker processes to serve requests with.  With more than one,
+    # this process binds the port and supervises the workers: a worker that
+    # dies is replaced, and SIGHUP replaces them all one at a time.
+    workers = int(os.environ.get('WORKERS', 1))
+
+    # Set by the supervisor in each worker's environment.
+    listen_fd = os.environ.get(WorkerPool.fd_variable, None)
+
     # Number of tokens per IP.  In other words, you can have this many people
     # vote from the same IP for ever TOKEN_REFRESH_RATE seconds.
     tokens_per_ip = int(os.environ.get('TOKENS_PER_IP', 4))
@@ -39,28 +63,245 @@ def start(reactor):
     token_refresh_rate = int(os.environ.get('TOKEN_REFRESH_RATE', 60))
 
     # Number of votes that can be cast per voting token.
-    use_limit = len(options) / 2
+    use_limit = max(1, len(options) // 2)
 
     # After a user gets a voting token, they have this many seconds to use it
     # before it won't work anymore.
     token_expiration = int(os.environ.get('TOKEN_EXPIRATION', 240))
 
-    engine = create_engine(url, reactor=reactor, strategy=TWISTED_STRATEGY)
-    store = SQLVoteStore(engine, options)
-    yield store.upgradeSchema()
+    # If set, voting tokens are signed with this secret and carry their own
+    # expiration and use limit instead of being stored until they're used.
+    token_secret = os.environ.get('TOKEN_SECRET', None)
+
+    # How the number of tokens given out per IP is limited: 'window' keeps
+    # the times of the last TOKENS_PER_IP tokens and checks them when the
+    # next is asked for, 'timer' schedules a call to give each token back.
+    token_rate_limit = os.environ.get('TOKEN_RATE_LIMIT', 'window')
+
+    # If set, token limits are kept in this memory-mapped file, so that every
+    # process on the host using the same file shares them.
+    token_store_path = os.environ.get('TOKEN_STORE_PATH', None)
+
+    # Number of keys the shared token store can hold.  Each IP that asked for
+    # a token in the last TOKEN_REFRESH_RATE seconds takes up to
+    # TOKENS_PER_IP of them, and each token not yet used up takes one until
+    # it expires.  Keep the table at most half full; the default suits about
+    # 4000 busy IPs with the default TOKENS_PER_IP.
+    token_store_slots = int(os.environ.get('TOKEN_STORE_SLOTS', 1 << 16))
+    if (token_store_path or workers > 1) and token_rate_limit != 'window':
+        # The timers giving tokens back only run in the process that set
+        # them, so in a shared store a worker that dies or is restarted
+        # would leave its IPs limited for good.
+        raise ValueError('TOKEN_STORE_PATH and WORKERS > 1 each need '
+            'TOKEN_RATE_LIMIT=window')
+
+    # If set (and TOKEN_STORE_PATH isn't), the in-memory token store is
+    # snapshotted to files starting with this path every
+    # TOKEN_SNAPSHOT_INTERVAL seconds, with changes in between synced every
+    # TOKEN_SYNC_INTERVAL seconds, and loaded again on start.  Reading the
+    # snapshot and replaying changes each stop after TOKEN_LOAD_BUDGET
+    # seconds: the rest of the snapshot is read in the background, and the
+    # changes left are lost.
+    token_journal_path = os.environ.get('TOKEN_JOURNAL_PATH', None)
+    token_sync_interval = float(os.environ.get('TOKEN_SYNC_INTERVAL', 1))
+    token_snapshot_interval = float(os.environ.get('TOKEN_SNAPSHOT_INTERVAL',
+        300))
+    token_load_budget = float(os.environ.get('TOKEN_LOAD_BUDGET', 0.5))
+    if token_journal_path and token_rate_limit != 'window':
+        # The timers giving tokens back can't be saved.
+        raise ValueError('TOKEN_JOURNAL_PATH needs TOKEN_RATE_LIMIT=window')
+
+    # If set, votes are buffered and written in batches of up to this many
+    # rows instead of one INSERT per vote.  SQLite has a single writer, so
+    # votes are always batched there unless this is set to 0.
+    vote_flush_size = os.environ.get('VOTE_FLUSH_SIZE', None)
+    if vote_flush_size is None and url.startswith('sqlite'):
+        vote_flush_size = 100
+    if vote_flush_size is not None:
+        vote_flush_size = int(vote_flush_size) or None
+
+    # Maximum number of seconds a buffered vote waits before it is written.
+    vote_flush_interval = float(os.environ.get('VOTE_FLUSH_INTERVAL',
+        0.05 if url.startswith('sqlite') else 1))
+
+    # Maximum number of buffered votes.  Votes beyond this are refused until
+    # the buffer drains.
+    vote_max_buffered = int(os.environ.get('VOTE_MAX_BUFFERED', 10000))
+
+    # Seconds for which results are served from memory before the database
+    # is asked again.  0 disables the cache.
+    results_cache_ttl = float(os.environ.get('RESULTS_CACHE_TTL', 1))
+
+    # Seconds between updates pushed to clients of /results/stream.
+    results_stream_interval = float(
+        os.environ.get('RESULTS_STREAM_INTERVAL', 1))
+
+    # Seconds between updates of the per-minute rollup behind
+    # /results/timeseries.
+    rollup_interval = float(os.environ.get('ROLLUP_INTERVAL', 10))
+
+    # Seconds between reloads of the polls stored in the database.  Votes for
+    # VOTING_OPTIONS go to the default poll; other polls are chosen with the
+    # poll parameter.
+    poll_refresh_interval = float(os.environ.get('POLL_REFRESH_INTERVAL', 60))
+
+    # Bearer token for admin-only endpoints such as /export.  Unset, they're
+    # disabled.
+    admin_token = os.environ.get('ADMIN_TOKEN', None)
+
+    # If set to 1, admins can profile a running server at /debug/profile.
+    # Nothing is profiled until they ask.
+    profiling = os.environ.get('PROFILING', '') == '1'
+
+    # Number of /token, /vote and /vote/batch requests each process handles at
+    # once to begin with.  The limit is lowered when requests take longer than
+    # ADMISSION_TARGET_LATENCY seconds and raised again while they're quick.
+    # Up to ADMISSION_QUEUE_SIZE more wait for up to ADMISSION_QUEUE_TIMEOUT
+    # seconds; others get a 503.  0 turns this off.
+    admission_limit = int(os.environ.get('ADMISSION_LIMIT', 32))
+    admission_max_limit = int(os.environ.get('ADMISSION_MAX_LIMIT', 256))
+    admission_queue_size = int(os.environ.get('ADMISSION_QUEUE_SIZE', 64))
+    admission_queue_timeout = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT',
+        2))
+    admission_target_latency = float(os.environ.get(
+        'ADMISSION_TARGET_LATENCY', 0.5))
+
+    # Number of database connections kept open, and how many more may be
+    # opened when they're all busy.  The reactor's thread pool, which runs
+    # the queries, is sized to match.
+    db_pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+    db_max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+
+    # On Postgres votes are partitioned by day.  Partitions are made this many
+    # days ahead, and if VOTE_RETENTION_DAYS is set, older votes are written
+    # to gzipped CSV files in VOTE_ARCHIVE_DIR and dropped.
+    vote_partitions_ahead = int(os.environ.get('VOTE_PARTITIONS_AHEAD', 7))
+    vote_retention_days = os.environ.get('VOTE_RETENTION_DAYS', None)
+    if vote_retention_days is not None:
+        vote_retention_days = int(vote_retention_days)
+    vote_archive_dir = os.environ.get('VOTE_ARCHIVE_DIR', None)
+
+    engine = createEngine(url, reactor,
+        pool_size=db_pool_size,
+        max_overflow=db_max_overflow,
+    )
+    store = SQLVoteStore(engine, options,
+        flush_size=vote_flush_size,
+        flush_interval=vote_flush_interval,
+        max_buffered=vote_max_buffered,
+        clock=reactor,
+    )
+    if listen_fd is None:
+        yield store.upgradeSchema()
+        aggregator = RollupAggregator(engine, interval=rollup_interval,
+            clock=reactor)
+        aggregator.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', aggregator.stop)
+        if engine.dialect.name == 'postgresql':
+            partitioner = VotePartitioner(engine,
+                ahead=vote_partitions_ahead,
+                retain=vote_retention_days,
+                archive_dir=vote_archive_dir,
+                clock=reactor,
+            )
+            partitioner.start()
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                partitioner.stop)
+
+    if workers > 1 and listen_fd is None:
+        env = {}
+        shared_path = token_store_path
+        if not shared_path:
+            # Workers must share token limits.
+            shared_path = os.path.join(tempfile.gettempdir(),
+                'vc-tokens-%d' % (os.getpid(),))
+            env['TOKEN_STORE_PATH'] = shared_path
+        # The workers leave reclaiming the store's slots to this process.
+        reclaimer = SharedMemoryStore(shared_path, slots=token_store_slots,
+            clock=reactor)
+        reactor.addSystemEventTrigger('after', 'shutdown', reclaimer.close)
+        if not token_store_path:
+            reactor.addSystemEventTrigger('after', 'shutdown', os.remove,
+                shared_path)
+        sock = listeningSocket(port)
+        pool = WorkerPool(reactor, [sys.executable, os.path.abspath(__file__)],
+            workers, sock.fileno(), env=env)
+        pool.start()
+        signal.signal(signal.SIGHUP,
+            lambda *args: reactor.callFromThread(pool.restart))
+        reactor.addSystemEventTrigger('before', 'shutdown', pool.stop)
+        yield defer.Deferred()
+
+    reactor.addSystemEventTrigger('before', 'shutdown', store.flush)
+    yield store.loadPolls()
+    poll_loader = task.LoopingCall(lambda: store.loadPolls().addErrback(
+        log.err, 'Error loading polls'))
+    poll_loader.clock = reactor
+    poll_loader.start(poll_refresh_interval, now=False)
+    vote_store = store
+    if results_cache_ttl > 0:
+        vote_store = CachedVoteStore(store, ttl=results_cache_ttl,
+            clock=reactor)
+
+    captcha_verifier = RecaptchaVerifier(captcha_private,
+        url=captcha_verify_url,
+        concurrency=captcha_concurrency,
+        timeout=captcha_timeout,
+        clock=reactor,
+    )
 
-    captcha_verifier = RecaptchaVerifier(captcha_private)
+    if token_store_path:
+        token_store = SharedMemoryStore(token_store_path,
+            slots=token_store_slots, clock=reactor,
+            reclaim_interval=1 if listen_fd is None else None)
+    else:
+        token_store = MemoryStore(reactor)
+        if token_journal_path:
+            journal = StoreJournal(token_store, token_journal_path,
+                sync_interval=token_sync_interval,
+                snapshot_interval=token_snapshot_interval,
+                clock=reactor,
+            )
+            journal.start(token_load_budget)
+            reactor.addSystemEventTrigger('before', 'shutdown', journal.stop)
+        REGISTRY.gauge('vc_store_keys',
+            'Keys in the token store').setFunction(lambda: len(token_store))
+        REGISTRY.gauge('vc_store_pending_expiries',
+            'Deadlines waiting in the token store').setFunction(
+            token_store.pendingExpiries)
+    ReactorLagMonitor(REGISTRY, clock=reactor).start()
 
     dispenser = TimedTokenDispenser(
         available=tokens_per_ip,
         refresh=token_refresh_rate,
         use_limit=use_limit,
         expiration=token_expiration,
-        store=MemoryStore(reactor),
+        store=token_store,
+        sliding_window=(token_rate_limit == 'window'),
+        secret=token_secret,
     )
-    app = VoteCounter(store, dispenser, captcha_verifier, 'example.html')
+    admission = {}
+    if admission_limit > 0:
+        for route in ('token', 'vote', 'vote_batch'):
+            admission[route] = AdmissionController(route,
+                limit=admission_limit,
+                max_limit=max(admission_limit, admission_max_limit),
+                queue_size=admission_queue_size,
+                queue_timeout=admission_queue_timeout,
+                target_latency=admission_target_latency,
+                clock=reactor,
+            )
+    app = VoteCounter(vote_store, dispenser, captcha_verifier, 'example.html',
+        stream_interval=results_stream_interval,
+        exporter=VoteExporter(engine),
+        admin_token=admin_token,
+        admission=admission,
+        profiler=Profiler(clock=reactor) if profiling else None)
     site = Site(app.app.resource())
-    reactor.listenTCP(port, site)
+    if listen_fd is None:
+        reactor.listenTCP(port, site)
+    else:
+        reactor.adoptStreamPort(int(listen_fd), socket.AF_INET, site)
     yield defer.Deferred()
 
 
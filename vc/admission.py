@@ -0,0 +1,145 @@
+from twisted.internet import defer, reactor
+
+from collections import deque
+
+from vc.error import Overloaded
+from vc.metrics import REGISTRY
+
+
+ADMISSION_LIMIT = REGISTRY.gauge('vc_admission_limit',
+    'Requests a route may handle at once', ['route'])
+ADMISSION_ACTIVE = REGISTRY.gauge('vc_admission_active',
+    'Requests a route is handling', ['route'])
+ADMISSION_QUEUED = REGISTRY.gauge('vc_admission_queued',
+    'Requests waiting for a route to have room', ['route'])
+ADMISSION_REJECTED = REGISTRY.counter('vc_admission_rejected_total',
+    'Requests turned away because a route was busy', ['route', 'reason'])
+
+
+
+class AdmissionController(object):
+    """
+    I limit how many requests a route handles at once.
+
+    Requests over the limit wait in a queue of at most C{queue_size}, for at
+    most C{queue_timeout} seconds; when the queue is full, or the wait runs
+    out, they fail with L{Overloaded}.
+
+    The limit adapts to how long admitted requests take: it grows by one
+    every C{limit} requests that finish within C{target_latency} seconds,
+    and is multiplied by C{backoff} when one takes longer (at most once
+    every C{target_latency} seconds, so one slow spell only counts once).
+    """
+
+
+    def __init__(self, route, limit=32, min_limit=1, max_limit=256,
+            queue_size=64, queue_timeout=2, target_latency=0.5, backoff=0.7,
+            clock=reactor):
+        """
+        @param route: Name of the route, used to label metrics.
+        @param limit: Number of requests handled at once to begin with.
+        @param min_limit: The limit never goes below this.
+        @param max_limit: The limit never goes above this.
+        @param queue_size: Number of requests that may wait for room.
+        @param queue_timeout: Seconds a request may wait before it's turned
+            away.
+        @param target_latency: Seconds within which requests should finish.
+        @param backoff: What to multiply the limit by when they don't.
+        """
+        self.route = route
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.clock = clock
+        self.active = 0
+        # (Deferred, timeout DelayedCall)
+        self._queue = deque()
+        self._backed_off = None
+        ADMISSION_LIMIT.labels(route).setFunction(lambda: int(self.limit))
+        ADMISSION_ACTIVE.labels(route).setFunction(lambda: self.active)
+        ADMISSION_QUEUED.labels(route).setFunction(lambda: len(self._queue))
+
+
+    def acquire(self):
+        """
+        Wait for room to handle a request.
+
+        Cancelling the returned Deferred while it's waiting gives up its
+        place in the queue.
+
+        @return: A Deferred which fires once there's room, after which
+            L{release} must be called, or fails with L{Overloaded}.
+        """
+        if self.active < int(self.limit) and not self._queue:
+            self.active += 1
+            return defer.succeed(None)
+        if len(self._queue) >= self.queue_size:
+            return self._reject('queue_full')
+        def cancel(d):
+            self._remove(d)
+        d = defer.Deferred(cancel)
+        call = self.clock.callLater(self.queue_timeout, self._timedOut, d)
+        self._queue.append((d, call))
+        return d
+
+
+    def release(self, latency=None):
+        """
+        Give back the room taken by L{acquire}.
+
+        @param latency: Seconds the request took, if it should count towards
+            the limit.
+        """
+        self.active -= 1
+        if latency is not None:
+            self.observe(latency)
+        self._admit()
+
+
+    def observe(self, latency):
+        """
+        Adjust the limit after a request took C{latency} seconds.
+        """
+        if latency > self.target_latency:
+            now = self.clock.seconds()
+            if self._backed_off is None or \
+                    now >= self._backed_off + self.target_latency:
+                self._backed_off = now
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif self.active + 1 >= int(self.limit):
+            # Only grow while the limit is what's holding requests back.
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+    def _admit(self):
+        while self._queue and self.active < int(self.limit):
+            d, call = self._queue.popleft()
+            call.cancel()
+            self.active += 1
+            d.callback(None)
+
+
+    def _remove(self, d):
+        for entry in self._queue:
+            if entry[0] is d:
+                self._queue.remove(entry)
+                entry[1].cancel()
+                return
+
+
+    def _timedOut(self, d):
+        for entry in self._queue:
+            if entry[0] is d:
+                self._queue.remove(entry)
+                break
+        self._reject('timeout').chainDeferred(d)
+
+
+    def _reject(self, reason):
+        ADMISSION_REJECTED.labels(self.route, reason).inc()
+        return defer.fail(Overloaded('Too busy, try again in a moment',
+            self.queue_timeout))
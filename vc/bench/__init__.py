@@ -0,0 +1,3 @@
+"""
+Benchmarks.  Run each module with C{python -m vc.bench.<name> --help}.
+"""
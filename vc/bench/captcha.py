@@ -0,0 +1,95 @@
+"""
+Measure captcha verification throughput against a local fake verifier.
+
+The fake verifier answers every check after --delay seconds, like a slow
+upstream.  Each check uses a different answer, so none come from the cache.
+
+    python -m vc.bench.captcha --concurrency 10 --delay 0.05
+"""
+from twisted.internet import task, defer
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+import argparse
+import sys
+import time
+
+from vc.web import RecaptchaVerifier
+
+
+
+class FakeVerifier(Resource):
+    """
+    I pass every captcha answer, after C{delay} seconds.
+    """
+
+    isLeaf = True
+
+
+    def __init__(self, clock, delay):
+        Resource.__init__(self)
+        self.clock = clock
+        self.delay = delay
+        self.requests = 0
+
+
+    def render_POST(self, request):
+        self.requests += 1
+        def answer():
+            request.write(b'true\nsuccess')
+            request.finish()
+        call = self.clock.callLater(self.delay, answer)
+        request.notifyFinish().addErrback(lambda _: call.cancel())
+        return NOT_DONE_YET
+
+
+
+@defer.inlineCallbacks
+def checkFor(verifier, clock, duration, prefix):
+    """
+    Check captchas one after another for C{duration} seconds.
+
+    @return: A Deferred firing with the number of checks made.
+    """
+    count = 0
+    end = clock.seconds() + duration
+    while clock.seconds() < end:
+        yield verifier.assertVerified('127.0.0.1', 'challenge',
+            '%s-%d' % (prefix, count))
+        count += 1
+    defer.returnValue(count)
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--clients', type=int, default=100,
+        help='Number of concurrent checkers (default %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=10,
+        help='Requests to the verifier at once (default %(default)s)')
+    parser.add_argument('--delay', type=float, default=0.05,
+        help='Seconds the fake verifier takes to answer (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=5,
+        help='Seconds to run (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    fake = FakeVerifier(reactor, args.delay)
+    port = reactor.listenTCP(0, Site(fake), interface='127.0.0.1')
+    url = 'http://127.0.0.1:%d/verify' % (port.getHost().port,)
+    verifier = RecaptchaVerifier('secret', url=url,
+        concurrency=args.concurrency, clock=reactor)
+    try:
+        start = time.time()
+        counts = yield defer.gatherResults([
+            checkFor(verifier, reactor, args.duration, i)
+            for i in range(args.clients)])
+        elapsed = time.time() - start
+        print('checks/sec:       %.1f' % (sum(counts) / elapsed,))
+        print('verifier calls:   %d' % (fake.requests,))
+        print('best possible:    %.1f' % (args.concurrency / args.delay,))
+    finally:
+        yield port.stopListening()
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,332 @@
+"""
+Load test the token -> vote flow and results polling end to end.
+
+The VoteCounter app is served in-process on a loopback port, backed by a
+MemoryStore and an in-memory vote store (or SQLVoteStore with
+--database-url), and driven by concurrent simulated clients, each request
+coming from one of many simulated IPs.
+
+    python -m vc.bench.load --workload vote --output new.json
+    python -m vc.bench.load --workload vote --compare old.json
+"""
+from twisted.internet import defer, task
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.server import Site
+
+import argparse
+import bisect
+import json
+import os
+import random
+import sys
+import time
+
+from vc.error import NotAnOption, NoSuchPoll
+from vc.sql import DEFAULT_POLL
+from vc.token import TimedTokenDispenser, MemoryStore
+from vc.web import VoteCounter
+
+
+
+class MemoryVoteStore(object):
+    """
+    I am an in-memory stand-in for L{vc.sql.SQLVoteStore}, with only the
+    default poll.
+    """
+
+
+    def __init__(self, options):
+        self.options = set(options)
+        self.totals = dict((x, 0) for x in options)
+
+
+    def checkVotes(self, options, poll=DEFAULT_POLL):
+        if poll != DEFAULT_POLL:
+            raise NoSuchPoll('%r is not a poll' % (poll,))
+        for option in options:
+            if option not in self.options:
+                raise NotAnOption('%r is not an option' % (option,))
+
+
+    def vote(self, option, ip, poll=DEFAULT_POLL):
+        try:
+            self.checkVotes([option], poll)
+        except (NoSuchPoll, NotAnOption):
+            return defer.fail()
+        self.totals[option] += 1
+        return defer.succeed(None)
+
+
+    def getResults(self, poll=DEFAULT_POLL):
+        if poll != DEFAULT_POLL:
+            return defer.fail(NoSuchPoll('%r is not a poll' % (poll,)))
+        return defer.succeed(dict(self.totals))
+
+
+
+class PassingCaptchaVerifier(object):
+
+
+    def assertVerified(self, ip, challenge, response):
+        return defer.succeed(None)
+
+
+
+class LatencyHistogram(object):
+    """
+    I count latencies of successful requests in logarithmic buckets from
+    10us to about 100s, and failed requests by their error.
+    """
+
+    # Upper bounds in seconds, 10 per decade.
+    bounds = [10 ** (x / 10.0) for x in range(-50, 21)]
+
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.error_messages = {}
+
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+
+
+    def fail(self, message):
+        self.errors += 1
+        self.error_messages[message] = self.error_messages.get(message, 0) + 1
+
+
+    @property
+    def error_rate(self):
+        total = self.count + self.errors
+        return float(self.errors) / total if total else 0.0
+
+
+    def percentile(self, p):
+        """
+        Return the upper bound of the bucket holding the C{p}th percentile.
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+
+    def summary(self, elapsed):
+        """
+        Summarize the successful requests; failed ones only count towards
+        C{errors}.
+        """
+        errors = {
+            'errors': self.errors,
+            'error_rate': self.error_rate,
+            'error_messages': self.error_messages,
+        }
+        if not self.count:
+            return dict(errors, count=0)
+        return dict(errors, **{
+            'count': self.count,
+            'rps': self.count / elapsed,
+            'p50_ms': self.percentile(50) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'p999_ms': self.percentile(99.9) * 1000,
+            'histogram': dict(('%.6g' % (self.bounds[i],), count)
+                for i, count in enumerate(self.counts[:-1]) if count),
+        })
+
+
+
+class LoadClient(object):
+
+
+    def __init__(self, reactor, base_url, options, ips, concurrency):
+        self.reactor = reactor
+        self.base_url = base_url
+        self.options = options
+        self.ips = ips
+        self.pool = HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = concurrency
+        self.agent = Agent(reactor, pool=self.pool)
+        self.histograms = {}
+
+
+    @defer.inlineCallbacks
+    def get(self, path, ip):
+        """
+        GET C{path} from C{ip}, recording the latency under C{path}'s route
+        if it succeeded, or the error if not.
+
+        @return: A Deferred firing with the decoded JSON response, or C{None}
+            if the request failed.
+        """
+        route = path.split('?')[0]
+        histogram = self.histograms.setdefault(route, LatencyHistogram())
+        start = time.time()
+        try:
+            response = yield self.agent.request(b'GET',
+                (self.base_url + path).encode('ascii'),
+                Headers({b'x-forwarded-for': [ip.encode('ascii')]}))
+            body = yield readBody(response)
+            result = json.loads(body.decode('utf-8'))
+        except Exception as e:
+            histogram.fail(type(e).__name__)
+            defer.returnValue(None)
+        if isinstance(result, dict) and 'error' in result:
+            histogram.fail(result['error'])
+            defer.returnValue(None)
+        histogram.record(time.time() - start)
+        defer.returnValue(result)
+
+
+    @defer.inlineCallbacks
+    def voter(self, end):
+        while self.reactor.seconds() < end:
+            ip = random.choice(self.ips)
+            result = yield self.get('/token', ip)
+            if result is None:
+                continue
+            yield self.get('/vote?token=%s&option=%s' % (
+                result['token'], random.choice(self.options)), ip)
+
+
+    @defer.inlineCallbacks
+    def poller(self, end):
+        while self.reactor.seconds() < end:
+            yield self.get('/results', random.choice(self.ips))
+
+
+    def run(self, workload, concurrency, duration):
+        end = self.reactor.seconds() + duration
+        clients = {'vote': self.voter, 'results': self.poller}
+        if workload == 'mixed':
+            workers = [(self.voter if i % 2 else self.poller)(end)
+                for i in range(concurrency)]
+        else:
+            workers = [clients[workload](end) for _ in range(concurrency)]
+        return defer.gatherResults(workers)
+
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+
+
+def serve(reactor, vote_store, clock=None):
+    """
+    Serve a L{VoteCounter} for C{vote_store} on a loopback port.
+
+    @param clock: The clock tokens are given out by; C{reactor} by default.
+
+    @return: The listening port.
+    """
+    if clock is None:
+        clock = reactor
+    dispenser = TimedTokenDispenser(use_limit=1, store=MemoryStore(clock),
+        clock=clock)
+    index = os.path.join(os.path.dirname(__file__), '..', '..',
+        'example.html')
+    app = VoteCounter(vote_store, dispenser, PassingCaptchaVerifier(), index)
+    return reactor.listenTCP(0, Site(app.app.resource()),
+        interface='127.0.0.1')
+
+
+
+def compare(old, new):
+    """
+    Print how C{new} results differ from C{old} ones.
+    """
+    print('%-12s %-10s %12s %12s %8s' % ('route', 'metric', 'old', 'new',
+        'change'))
+    for route in sorted(set(old['routes']) | set(new['routes'])):
+        for metric in ('rps', 'p50_ms', 'p99_ms', 'p999_ms', 'error_rate'):
+            a = old['routes'].get(route, {}).get(metric)
+            b = new['routes'].get(route, {}).get(metric)
+            change = '-'
+            if a and b is not None:
+                change = '%+.1f%%' % ((b - a) / a * 100,)
+            print('%-12s %-10s %12s %12s %8s' % (route, metric,
+                '-' if a is None else '%.2f' % (a,),
+                '-' if b is None else '%.2f' % (b,), change))
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--workload', choices=['vote', 'results', 'mixed'],
+        default='mixed')
+    parser.add_argument('--concurrency', type=int, default=50,
+        help='Number of simulated clients (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=10,
+        help='Seconds to run for (default %(default)s)')
+    parser.add_argument('--ips', type=int, default=10000,
+        help='Number of simulated client IPs (default %(default)s)')
+    parser.add_argument('--options', type=int, default=4,
+        help='Number of voting options (default %(default)s)')
+    parser.add_argument('--database-url',
+        help='Use an SQLVoteStore on this database instead of memory')
+    parser.add_argument('--max-error-rate', type=float, default=0.5,
+        help='Fail if more than this fraction of any route\'s requests '
+            'fail (default %(default)s)')
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument('--compare', help='Compare with results in this file')
+    args = parser.parse_args(argv)
+
+    options = ['option%d' % (i,) for i in range(args.options)]
+    ips = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        for i in range(args.ips)]
+
+    if args.database_url:
+        from vc.sql import SQLVoteStore, createEngine
+        engine = createEngine(args.database_url, reactor)
+        vote_store = SQLVoteStore(engine, options)
+        yield vote_store.upgradeSchema()
+    else:
+        vote_store = MemoryVoteStore(options)
+    port = serve(reactor, vote_store)
+
+    client = LoadClient(reactor,
+        'http://127.0.0.1:%d' % (port.getHost().port,), options, ips,
+        args.concurrency)
+    start = time.time()
+    yield client.run(args.workload, args.concurrency, args.duration)
+    elapsed = time.time() - start
+    yield port.stopListening()
+
+    report = {
+        'workload': args.workload,
+        'concurrency': args.concurrency,
+        'duration': elapsed,
+        'ips': args.ips,
+        'routes': dict((route, histogram.summary(elapsed))
+            for route, histogram in client.histograms.items()),
+    }
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    failing = sorted(route for route, histogram in client.histograms.items()
+        if histogram.error_rate > args.max_error_rate)
+    for route in failing:
+        histogram = client.histograms[route]
+        sys.stderr.write('*** %s: %d of %d requests failed, so its numbers '
+            'don\'t measure anything.  Errors: %s\n' % (route,
+            histogram.errors, histogram.errors + histogram.count,
+            json.dumps(histogram.error_messages, sort_keys=True)))
+    if failing:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,82 @@
+"""
+Measure MemoryStore memory use and throughput with many expiring keys.
+
+Each key is written the way TimedTokenDispenser writes a token: an
+increment followed by an expire.  The same workload is run against a store
+that schedules one reactor timer per key, as MemoryStore used to.
+
+    python -m vc.bench.memstore --keys 1000000
+"""
+from twisted.internet import reactor
+
+import argparse
+import gc
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from vc.token import MemoryStore
+
+
+
+class TimerMemoryStore(MemoryStore):
+    """
+    I expire keys with one reactor timer per key.
+    """
+
+
+    def expire(self, key, seconds):
+        self.clock.callLater(seconds, self._maybeRemove, key)
+
+
+
+def run(store, keys):
+    """
+    Write C{keys} expiring keys to C{store}.
+
+    @return: A tuple of (seconds taken, bytes allocated or C{None}).
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    for i in range(keys):
+        key = 'TK:%d' % (i,)
+        store.increment(key, 3)
+        store.expire(key, 240)
+    elapsed = time.time() - start
+    allocated = None
+    if tracemalloc is not None:
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return elapsed, allocated
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--keys', type=int, default=1000000,
+        help='Number of live keys (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    print('%-18s %12s %12s %14s' % ('store', 'seconds', 'keys/sec', 'bytes/key'))
+    for name, factory in [
+            ('sweeper', MemoryStore),
+            ('timer per key', TimerMemoryStore)]:
+        store = factory(reactor)
+        elapsed, allocated = run(store, args.keys)
+        per_key = '-'
+        if allocated is not None:
+            per_key = '%.1f' % (float(allocated) / args.keys,)
+        print('%-18s %12.2f %12.0f %14s' % (name, elapsed,
+            args.keys / elapsed, per_key))
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+        del store
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+"""
+Measure how long a persisted MemoryStore takes to load after a restart.
+
+The store is filled with keys the way TimedTokenDispenser writes them (a
+token per key and a sliding window per IP), a snapshot is taken, more
+changes are written to the log, and then a fresh store is loaded from disk:
+first for the time budget, then the rest of the snapshot in the background.
+
+    python -m vc.bench.persist --keys 1000000
+"""
+from twisted.internet import defer, task
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from vc.persist import StoreJournal
+from vc.token import MemoryStore
+
+
+def fill(store, keys, prefix):
+    for i in range(keys // 2):
+        key = 'TK:%s%d' % (prefix, i)
+        store.increment(key, 3, expire=240)
+        store.hit('W:%s%d' % (prefix, i), 4, 60)
+
+
+@defer.inlineCallbacks
+def run(reactor, keys, changes, budget):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'tokens')
+        journal = StoreJournal(MemoryStore(reactor), path, clock=reactor)
+        journal.load()
+        fill(journal.store, keys, 's')
+        start = time.time()
+        yield journal.snapshot()
+        snapshot_seconds = time.time() - start
+        fill(journal.store, changes, 'l')
+        yield journal.flush()
+        journal.store.journal = None
+
+        store = MemoryStore(reactor)
+        loader = StoreJournal(store, path, clock=reactor)
+        start = time.time()
+        loaded = loader.load(budget)
+        load_seconds = time.time() - start
+        yield loader.whenLoaded()
+        total_seconds = time.time() - start
+        print('%-20s %12d' % ('keys', len(journal.store)))
+        print('%-20s %12.3f' % ('snapshot seconds', snapshot_seconds))
+        print('%-20s %12d' % ('snapshot bytes',
+            os.path.getsize(path + '.snapshot')))
+        print('%-20s %12d' % ('keys loaded', loaded))
+        print('%-20s %12.3f' % ('load seconds', load_seconds))
+        print('%-20s %12d' % ('keys in the end', len(store)))
+        print('%-20s %12.3f' % ('all loaded seconds', total_seconds))
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--keys', type=int, default=1000000,
+        help='Number of keys in the snapshot (default %(default)s)')
+    parser.add_argument('--changes', type=int, default=100000,
+        help='Number of keys written to the log after it (default '
+            '%(default)s)')
+    parser.add_argument('--budget', type=float, default=0.5,
+        help='Seconds allowed for reading the snapshot and for replaying '
+            'the log (default %(default)s)')
+    args = parser.parse_args(argv)
+    task.react(run, [args.keys, args.changes, args.budget])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
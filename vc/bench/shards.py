@@ -0,0 +1,84 @@
+"""
+Measure concurrent vote INSERT throughput against the number of total shards.
+
+Every writer votes for the same option, which is the worst case for the
+C{total} row lock.  This writes votes to the database in C{DATABASE_URL}, so
+don't point it at production.
+
+    DATABASE_URL=postgresql://... python -m vc.bench.shards
+"""
+from twisted.internet import task, defer
+from twisted.python import log
+
+import argparse
+import os
+import sys
+import time
+
+from vc.sql import SQLVoteStore, TOTAL_SHARDS, createEngine
+
+
+def setShards(engine, shards):
+    """
+    Recreate the vote trigger so that totals are spread over C{shards} rows.
+    """
+    d = engine.execute('DROP TRIGGER inc_vote_total ON vote')
+    d.addCallback(lambda _: engine.execute('''
+        CREATE TRIGGER inc_vote_total AFTER INSERT ON vote
+        FOR EACH ROW EXECUTE PROCEDURE inc_vote_total_shard('%d')''' % (
+            shards,)))
+    return d
+
+
+@defer.inlineCallbacks
+def insertFor(store, clock, duration):
+    """
+    Cast votes one after another for C{duration} seconds.
+
+    @return: A Deferred firing with the number of votes cast.
+    """
+    count = 0
+    end = clock.seconds() + duration
+    while clock.seconds() < end:
+        yield store.vote('hot', '127.0.0.1')
+        count += 1
+    defer.returnValue(count)
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--writers', type=int, default=16,
+        help='Number of concurrent writers (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=5,
+        help='Seconds to run each shard count (default %(default)s)')
+    parser.add_argument('--shards', default='1,2,4,8,16,32',
+        help='Comma-separated shard counts to try (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    url = os.environ.get('DATABASE_URL', None)
+    if url is None:
+        raise Exception('You must set DATABASE_URL')
+    log.startLogging(sys.stderr)
+
+    engine = createEngine(url, reactor, pool_size=args.writers,
+        max_overflow=0)
+    store = SQLVoteStore(engine, ['hot'])
+    yield store.upgradeSchema()
+
+    print('%8s %12s' % ('shards', 'votes/sec'))
+    try:
+        for shards in [int(x) for x in args.shards.split(',')]:
+            yield setShards(engine, shards)
+            start = time.time()
+            counts = yield defer.gatherResults([
+                insertFor(store, reactor, args.duration)
+                for _ in range(args.writers)])
+            elapsed = time.time() - start
+            print('%8d %12.1f' % (shards, sum(counts) / elapsed))
+    finally:
+        yield setShards(engine, TOTAL_SHARDS)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
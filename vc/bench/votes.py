@@ -0,0 +1,87 @@
+"""
+Measure vote throughput with one INSERT per vote against buffered batches.
+
+This writes votes to the database in C{DATABASE_URL}, so don't point it at
+production.  Without C{DATABASE_URL} a new SQLite database is used.
+
+    python -m vc.bench.votes
+    DATABASE_URL=postgresql://... python -m vc.bench.votes --writers 64
+"""
+from twisted.internet import task, defer
+from twisted.python import log
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from vc.sql import SQLVoteStore, createEngine
+
+
+@defer.inlineCallbacks
+def voteFor(store, clock, duration):
+    """
+    Cast votes one after another for C{duration} seconds.
+
+    @return: A Deferred firing with the number of votes cast.
+    """
+    count = 0
+    end = clock.seconds() + duration
+    while clock.seconds() < end:
+        yield store.vote('foo', '127.0.0.1')
+        count += 1
+    defer.returnValue(count)
+
+
+@defer.inlineCallbacks
+def run(reactor, engine, writers, duration, flush_size):
+    store = SQLVoteStore(engine, ['foo'], flush_size=flush_size,
+        flush_interval=0.01, max_buffered=writers * 2, clock=reactor)
+    start = time.time()
+    counts = yield defer.gatherResults([
+        voteFor(store, reactor, duration)
+        for _ in range(writers)])
+    yield store.flush()
+    defer.returnValue(sum(counts) / (time.time() - start))
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--writers', type=int, default=16,
+        help='Number of concurrent voters (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=5,
+        help='Seconds to run each mode (default %(default)s)')
+    parser.add_argument('--flush-sizes', default='0,4,16',
+        help='Comma-separated batch sizes to try; 0 is one INSERT per vote.  '
+             'Each voter waits for its vote, so batches never get bigger '
+             'than --writers (default %(default)s)')
+    args = parser.parse_args(argv)
+    log.startLogging(sys.stderr)
+
+    url = os.environ.get('DATABASE_URL', None)
+    tmpdir = None
+    if url is None:
+        tmpdir = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(tmpdir, 'votes.sqlite')
+    engine = createEngine(url, reactor, pool_size=args.writers,
+        max_overflow=0)
+    try:
+        yield SQLVoteStore(engine, ['foo']).upgradeSchema()
+        print('%s' % (engine.dialect.name,))
+        print('%10s %12s' % ('flush size', 'votes/sec'))
+        for flush_size in [int(x) for x in args.flush_sizes.split(',')]:
+            rate = yield run(reactor, engine, args.writers, args.duration,
+                flush_size or None)
+            print('%10d %12.1f' % (flush_size, rate))
+    finally:
+        if hasattr(engine, 'close'):
+            engine.close()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
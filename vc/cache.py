@@ -0,0 +1,116 @@
+from twisted.internet import defer, reactor
+
+from vc.sql import DEFAULT_POLL
+
+
+
+class _PollResults(object):
+    """
+    The cached results of one poll.
+    """
+
+
+    def __init__(self):
+        self.results = None
+        self.fetched = None
+        self.generation = 0
+        self.waiting = None
+
+
+
+class CachedVoteStore(object):
+    """
+    I wrap a vote store and serve its results from memory.
+
+    Each poll's results are fetched from the wrapped store at most once
+    every C{ttl} seconds and requests that arrive while a fetch is in
+    progress share it.  Votes cast through me are added to the cached counts
+    right away and are corrected against the wrapped store on the next
+    fetch.
+    """
+
+
+    def __init__(self, store, ttl=1, clock=reactor):
+        """
+        @param store: The vote store to wrap.
+        @param ttl: Seconds for which fetched results are served.
+        """
+        self.store = store
+        self.ttl = ttl
+        self.clock = clock
+        self._polls = {}
+
+
+    def checkVotes(self, options, poll=DEFAULT_POLL):
+        return self.store.checkVotes(options, poll)
+
+
+    def vote(self, option, ip, poll=DEFAULT_POLL):
+        d = self.store.vote(option, ip, poll)
+        return self._counted(d, poll, [option])
+
+
+    def voteMany(self, options, ip, poll=DEFAULT_POLL):
+        d = self.store.voteMany(options, ip, poll)
+        return self._counted(d, poll, options)
+
+
+    def _counted(self, d, poll, options):
+        """
+        Add votes for C{options} to the cached counts, taking them away again
+        if C{d} fails.
+        """
+        cached = self._polls.get(poll)
+        if cached is None or cached.results is None:
+            return d
+        options = [x for x in options if x in cached.results]
+        for option in options:
+            cached.results[option] += 1
+        generation = cached.generation
+        def undo(err):
+            if generation == cached.generation:
+                for option in options:
+                    cached.results[option] -= 1
+            return err
+        d.addErrback(undo)
+        return d
+
+
+    def getResults(self, poll=DEFAULT_POLL):
+        cached = self._polls.get(poll)
+        if cached is None:
+            cached = self._polls[poll] = _PollResults()
+        if cached.results is not None and \
+                self.clock.seconds() < cached.fetched + self.ttl:
+            return defer.succeed(dict(cached.results))
+        d = defer.Deferred()
+        if cached.waiting is None:
+            cached.waiting = [d]
+            self._fetch(poll, cached)
+        else:
+            cached.waiting.append(d)
+        return d
+
+
+    def getTimeseries(self, minutes=60, poll=DEFAULT_POLL):
+        return self.store.getTimeseries(minutes, poll)
+
+
+    def _fetch(self, poll, cached):
+        fetched = self.clock.seconds()
+        d = self.store.getResults(poll)
+        def gotResults(results):
+            cached.results = dict(results)
+            cached.fetched = fetched
+            cached.generation += 1
+            waiting, cached.waiting = cached.waiting, None
+            for waiter in waiting:
+                waiter.callback(dict(results))
+        def failed(err):
+            if cached.results is None:
+                # Don't keep an entry for every poll id anyone asks for.
+                self._polls.pop(poll, None)
+            waiting, cached.waiting = cached.waiting, None
+            for waiter in waiting:
+                waiter.errback(err)
+        d.addCallbacks(gotResults, failed)
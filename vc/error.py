@@ -2,3 +2,18 @@ class Error(Exception): pass
 class InvalidToken(Error): pass
 class NoTokensLeft(Error): pass
 class NotAnOption(Error): pass
+class NoSuchPoll(Error): pass
+class BufferFull(Error): pass
+class StoreFull(Error): pass
+class CaptchaFailed(Error): pass
+
+
+class Overloaded(Error):
+    """
+    The server is too busy to handle a request; it may be retried after
+    C{retry_after} seconds.
+    """
+
+    def __init__(self, message, retry_after=1):
+        Error.__init__(self, message)
+        self.retry_after = retry_after
@@ -0,0 +1,153 @@
+"""
+Streaming exports of the vote log.
+"""
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from zope.interface import implementer
+from sqlalchemy.sql import select
+
+import csv
+import io
+import json
+
+from vc.sql import Vote, fetchmany
+from vc.metrics import REGISTRY
+
+
+EXPORTED_ROWS = REGISTRY.counter('vc_export_rows_total',
+    'Votes written by exports')
+
+
+def encodeCSV(rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for poll, key, ip, created in rows:
+        writer.writerow([poll, key, ip, created.isoformat()])
+    return out.getvalue().encode('utf-8')
+
+
+def encodeNDJSON(rows):
+    return b''.join(json.dumps({
+        'poll': poll,
+        'option': key,
+        'ip': ip,
+        'created': created.isoformat(),
+    }, sort_keys=True).encode('utf-8') + b'\n'
+        for poll, key, ip, created in rows)
+
+
+# name: (content type, header, encoder)
+formats = {
+    'csv': ('text/csv; charset=utf-8', b'poll,option,ip,created\r\n', encodeCSV),
+    'ndjson': ('application/x-ndjson', b'', encodeNDJSON),
+}
+
+
+
+@implementer(IPushProducer)
+class VoteExport(object):
+    """
+    I stream the vote log to one request.  Rows are read through a
+    server-side cursor C{batch_size} at a time, and the next batch isn't
+    read until the request's transport has taken the last one, so memory
+    use doesn't grow with the log.
+    """
+
+
+    def __init__(self, engine, request, encoder, batch_size=1000):
+        self.engine = engine
+        self.request = request
+        self.encoder = encoder
+        self.batch_size = batch_size
+        self.stopped = False
+        self._paused = None
+
+
+    def pauseProducing(self):
+        if self._paused is None:
+            self._paused = defer.Deferred()
+
+
+    def resumeProducing(self):
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
+
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+
+    @defer.inlineCallbacks
+    def run(self):
+        """
+        Write every vote to my request.
+
+        @return: A Deferred which fires when the log has been written or the
+            request has gone away.
+        """
+        conn = yield self.engine.connect()
+        self.request.registerProducer(self, True)
+        try:
+            result = yield conn.execute(
+                select([Vote.c.poll, Vote.c.key, Vote.c.ip, Vote.c.created])
+                .order_by(Vote.c.id)
+                .execution_options(stream_results=True))
+            while not self.stopped:
+                rows = yield fetchmany(result, self.batch_size)
+                if not rows:
+                    break
+                if self.stopped:
+                    break
+                self.request.write(self.encoder(rows))
+                EXPORTED_ROWS.inc(len(rows))
+                if self._paused is not None:
+                    yield self._paused
+        finally:
+            self.request.unregisterProducer()
+            yield conn.close()
+
+
+
+class VoteExporter(object):
+    """
+    I serve exports of the vote log.
+    """
+
+
+    def __init__(self, engine, batch_size=1000):
+        self.engine = engine
+        self.batch_size = batch_size
+
+
+    def export(self, request, format='csv'):
+        """
+        Stream the vote log to C{request} in C{format} (C{csv} or
+        C{ndjson}).
+
+        @return: A Deferred which fires with C{b''} once the log has been
+            written.  Cancelling it stops the export.
+        """
+        if format not in formats:
+            raise ValueError('Unknown format %r' % (format,))
+        content_type, header, encoder = formats[format]
+        request.setHeader('Content-Type', content_type)
+        request.setHeader('Content-Disposition',
+            'attachment; filename="votes.%s"' % (format,))
+        request.setHeader('Cache-Control', 'no-store')
+        request.write(header)
+        export = VoteExport(self.engine, request, encoder, self.batch_size)
+        d = defer.Deferred(lambda d: export.stopProducing())
+        def finished(_):
+            if not d.called:
+                d.callback(b'')
+        def failed(err):
+            log.err(err, 'Error exporting votes')
+            # Don't let a partial export look complete.
+            request.loseConnection()
+        done = export.run()
+        done.addCallbacks(finished, failed)
+        request.notifyFinish().addBoth(lambda _: export.stopProducing())
+        return d
@@ -0,0 +1,312 @@
+"""
+Counters, gauges and fixed-bucket histograms, exposed in the Prometheus
+text format.
+"""
+from twisted.internet import reactor, task
+
+import bisect
+import time
+
+
+# Monotonic where available.
+timer = getattr(time, 'perf_counter', time.time)
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10)
+
+
+
+def _formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, str(value)
+        .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs),)
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+
+class _Metric(object):
+
+    kind = None
+
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._newChild()
+
+
+    def labels(self, *values):
+        """
+        Return the child metric for these label values.  Keep hold of it to
+        avoid looking it up on hot paths.
+        """
+        values = tuple(values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('Expected labels %r' % (self.labelnames,))
+            child = self._children[values] = self._newChild()
+        return child
+
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.kind),
+        ]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._renderChild(values, child))
+        return lines
+
+
+
+class _CounterChild(object):
+
+
+    def __init__(self):
+        self.value = 0
+
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+
+class Counter(_Metric):
+
+    kind = 'counter'
+
+
+    def _newChild(self):
+        return _CounterChild()
+
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+
+    def _renderChild(self, values, child):
+        yield '%s%s %s' % (self.name, _formatLabels(self.labelnames, values),
+            _formatValue(child.value))
+
+
+
+class _GaugeChild(object):
+
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+
+    def set(self, value):
+        self.value = value
+
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+    def setFunction(self, function):
+        """
+        Report the result of calling C{function} instead of a set value.
+        """
+        self.function = function
+
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+
+    def _newChild(self):
+        return _GaugeChild()
+
+
+    def set(self, value):
+        self._children[()].set(value)
+
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+
+    def setFunction(self, function):
+        self._children[()].setFunction(function)
+
+
+    def _renderChild(self, values, child):
+        yield '%s%s %s' % (self.name, _formatLabels(self.labelnames, values),
+            _formatValue(child.get()))
+
+
+
+class _HistogramChild(object):
+
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def observeDeferred(self, d, start=None):
+        """
+        Observe the seconds from C{start} (default now) until C{d} fires.
+
+        @return: C{d}
+        """
+        if start is None:
+            start = timer()
+        def observe(result):
+            self.observe(timer() - start)
+            return result
+        return d.addBoth(observe)
+
+
+
+class Histogram(_Metric):
+
+    kind = 'histogram'
+
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, name, help, labelnames)
+
+
+    def _newChild(self):
+        return _HistogramChild(self.buckets)
+
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+
+    def observeDeferred(self, d, start=None):
+        return self._children[()].observeDeferred(d, start)
+
+
+    def _renderChild(self, values, child):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            yield '%s_bucket%s %d' % (self.name, _formatLabels(
+                self.labelnames, values, [('le', _formatValue(bound))]),
+                cumulative)
+        labels = _formatLabels(self.labelnames, values)
+        yield '%s_sum%s %s' % (self.name, labels, _formatValue(child.sum))
+        yield '%s_count%s %d' % (self.name, labels, child.count)
+
+
+
+class Registry(object):
+    """
+    I hold a set of metrics and render them for Prometheus.
+    """
+
+
+    def __init__(self):
+        self.metrics = {}
+
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError('%r is already a %s' % (name, metric.kind))
+        return metric
+
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter, name, help, labelnames)
+
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge, name, help, labelnames)
+
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labelnames, buckets)
+
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+
+REGISTRY = Registry()
+
+
+
+class ReactorLagMonitor(object):
+    """
+    I measure how late the reactor runs a timer scheduled every C{interval}
+    seconds, which is how long other work kept it busy.
+    """
+
+
+    def __init__(self, registry=REGISTRY, interval=1, clock=reactor):
+        self.interval = interval
+        self.clock = clock
+        self.gauge = registry.gauge('vc_reactor_lag_seconds',
+            'How late the last periodic reactor timer ran')
+        self.histogram = registry.histogram('vc_reactor_lag',
+            'How late periodic reactor timers ran, in seconds')
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.clock = clock
+        self._expected = None
+
+
+    def start(self):
+        self._expected = self.clock.seconds()
+        self._loop.start(self.interval)
+
+
+    def stop(self):
+        self._loop.stop()
+
+
+    def _tick(self):
+        now = self.clock.seconds()
+        lag = max(0, now - self._expected)
+        self.gauge.set(lag)
+        self.histogram.observe(lag)
+        # The loop runs next at the first multiple of interval since it
+        # started that's after now, however late this run was.
+        start = self._loop.starttime
+        self._expected = now + self.interval - (now - start) % self.interval
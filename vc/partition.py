@@ -0,0 +1,186 @@
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log
+from sqlalchemy.sql import text
+
+import csv
+import datetime
+import gzip
+import io
+import os
+import re
+
+from vc.metrics import REGISTRY
+
+
+PARTITIONS_ARCHIVED = REGISTRY.counter('vc_vote_partitions_archived_total',
+    'Vote partitions archived and dropped')
+
+
+_upper_bound = re.compile(r"TO \('(\d{4})-(\d{2})-(\d{2})")
+
+
+def upperBound(bound):
+    """
+    Return the date a partition's votes are before, given its bound as
+    printed by C{pg_get_expr}, or C{None} if it has no upper limit (like the
+    default partition).
+    """
+    match = _upper_bound.search(bound or '')
+    if match is None:
+        return None
+    return datetime.date(*[int(x) for x in match.groups()])
+
+
+def encodeRows(rows):
+    """
+    Encode vote rows as UTF-8 CSV.
+    """
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for id, created, poll, key, ip in rows:
+        writer.writerow([id, created.isoformat(), poll, key, ip])
+    return out.getvalue().encode('utf-8')
+
+
+
+class VotePartitioner(object):
+    """
+    I look after the daily partitions of the (Postgres) vote table: I make
+    them ahead of time, and archive votes older than the retention period to
+    gzipped CSV files before dropping their partitions.
+
+    Totals are kept separately, so archiving votes doesn't change results.
+    """
+
+    batch_size = 10000
+
+
+    def __init__(self, engine, ahead=7, retain=None, archive_dir=None,
+            interval=3600, clock=reactor):
+        """
+        @param ahead: Number of days after today to have partitions for.
+        @param retain: Number of days of votes to keep, or C{None} to keep
+            them all.
+        @param archive_dir: Directory to write archived partitions to.
+            Required if C{retain} is given.
+        @param interval: Seconds between checks.
+        """
+        if retain is not None and archive_dir is None:
+            raise ValueError('An archive_dir is needed to retain votes')
+        self.engine = engine
+        self.ahead = ahead
+        self.retain = retain
+        self.archive_dir = archive_dir
+        self.clock = clock
+        self.interval = interval
+        self._loop = None
+
+
+    def start(self):
+        """
+        Check now and every C{interval} seconds.
+        """
+        self._loop = task.LoopingCall(self._maintain)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval)
+
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+
+    def _maintain(self):
+        d = self.maintain()
+        d.addErrback(log.err, 'Error maintaining vote partitions')
+        return d
+
+
+    @defer.inlineCallbacks
+    def maintain(self):
+        yield self.createPartitions()
+        if self.retain is not None:
+            yield self.archiveOld()
+
+
+    def createPartitions(self):
+        """
+        Make sure there are partitions for today and the next C{ahead} days.
+        """
+        return self.engine.execute(text('''
+            SELECT create_vote_partition(current_date + n)
+            FROM generate_series(0, :ahead) n'''), ahead=self.ahead)
+
+
+    @defer.inlineCallbacks
+    def partitions(self):
+        """
+        List the vote table's partitions.
+
+        @return: A Deferred firing with a list of C{(name, upper)} tuples,
+            where C{upper} is the date the partition's votes are before, or
+            C{None} if it has no upper limit.
+        """
+        result = yield self.engine.execute('''
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'vote'::regclass''')
+        rows = yield result.fetchall()
+        defer.returnValue(sorted(
+            (name, upperBound(bound)) for name, bound in rows))
+
+
+    @defer.inlineCallbacks
+    def archiveOld(self):
+        """
+        Archive and drop every partition whose votes are all more than
+        C{retain} days old.
+        """
+        result = yield self.engine.execute(
+            text('SELECT current_date - :days'), days=self.retain)
+        cutoff = (yield result.fetchall())[0][0]
+        partitions = yield self.partitions()
+        for name, upper in partitions:
+            if upper is not None and upper <= cutoff:
+                yield self.archivePartition(name)
+
+
+    @defer.inlineCallbacks
+    def archivePartition(self, name):
+        """
+        Write a partition's votes to C{<archive_dir>/<name>.csv.gz}, then
+        detach and drop it.
+
+        The file is complete before the partition is dropped, so if this is
+        interrupted it can just be done again.
+        """
+        quoted = self.engine.dialect.identifier_preparer.quote(name)
+        select_batch = text('SELECT id, created, poll, key, ip FROM %s '
+            'WHERE id > :last ORDER BY id LIMIT :limit' % (quoted,))
+        path = os.path.join(self.archive_dir, name + '.csv.gz')
+        partial = path + '.partial'
+        log.msg('Archiving %s to %s' % (name, path), system='db')
+        out = yield threads.deferToThread(gzip.open, partial, 'wb')
+        count = 0
+        try:
+            yield threads.deferToThread(out.write,
+                b'id,created,poll,key,ip\r\n')
+            last = -1
+            while True:
+                result = yield self.engine.execute(select_batch,
+                    last=last, limit=self.batch_size)
+                rows = yield result.fetchall()
+                if not rows:
+                    break
+                yield threads.deferToThread(out.write, encodeRows(rows))
+                count += len(rows)
+                last = rows[-1][0]
+        finally:
+            yield threads.deferToThread(out.close)
+        os.rename(partial, path)
+        yield self.engine.execute('ALTER TABLE vote DETACH PARTITION %s'
+            % (quoted,))
+        yield self.engine.execute('DROP TABLE %s' % (quoted,))
+        PARTITIONS_ARCHIVED.inc()
+        log.msg('Archived %d votes from %s' % (count, name), system='db')
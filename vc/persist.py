@@ -0,0 +1,411 @@
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log
+from twisted.python.failure import Failure
+
+import gc
+import itertools
+import marshal
+import os
+import struct
+
+from vc.metrics import REGISTRY, timer
+from vc.token import NOTHING
+
+
+FORMAT = 2
+
+
+# Each write to a log, and each chunk of a snapshot, is marshalled and
+# preceded by its length.
+_length = struct.Struct('<I')
+
+
+def _frame(obj):
+    data = marshal.dumps(obj)
+    return _length.pack(len(data)) + data
+
+
+def _unframe(data):
+    """
+    Yield what was written with L{_frame} to C{data}, stopping at a write cut
+    short by a crash.
+    """
+    view = memoryview(data)
+    offset = 0
+    while offset + _length.size <= len(data):
+        size, = _length.unpack_from(data, offset)
+        offset += _length.size
+        if offset + size > len(data):
+            break
+        try:
+            obj = marshal.loads(view[offset:offset + size])
+        except (EOFError, ValueError, TypeError):
+            break
+        offset += size
+        yield obj
+
+
+JOURNAL_PENDING = REGISTRY.gauge('vc_store_journal_pending',
+    'Token store changes waiting to be written to the journal')
+JOURNAL_SYNC_SECONDS = REGISTRY.histogram('vc_store_journal_sync_seconds',
+    'Time spent writing and syncing token store changes')
+SNAPSHOT_SECONDS = REGISTRY.histogram('vc_store_snapshot_seconds',
+    'Time spent writing token store snapshots')
+
+
+
+class StoreJournal(object):
+    """
+    I keep a L{vc.token.MemoryStore} on disk, so that token limits and
+    unused tokens survive a restart.
+
+    Every C{snapshot_interval} seconds the whole store is written, with
+    C{marshal}, to C{<path>.snapshot}, in chunks of C{snapshot_chunk} keys
+    so that it can be read back a chunk at a time.  Changes since are
+    appended to C{<path>.log.<generation>} and synced in groups every
+    C{sync_interval} seconds, so at most that much is lost in a crash.  Each
+    group is read back with a single C{marshal.loads}.
+
+    Each log record is a key's whole state after a change (C{(key, value,
+    deadline)}, or C{(key,)} if it was removed), so replaying a
+    record more than once does no harm.  That lets a snapshot be taken
+    without stopping the store: the log is switched at the moment the store
+    is copied, and whatever was written to the old one is harmless.
+    """
+
+    # Keys written to a snapshot in each chunk.
+    snapshot_chunk = 10000
+
+    # Seconds spent at a time reading the rest of a snapshot in the
+    # background.
+    load_slice = 0.01
+
+
+    def __init__(self, store, path, sync_interval=1, snapshot_interval=300,
+            clock=reactor):
+        """
+        @param store: The L{vc.token.MemoryStore} to keep.
+        @param path: Prefix of the files it's kept in.
+        @param sync_interval: Seconds between writes to the log.
+        @param snapshot_interval: Seconds between snapshots.
+        """
+        self.store = store
+        self.path = path
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+        self.clock = clock
+        self.generation = None
+        self._log = None
+        self._pending = []
+        self._flusher = None
+        # Writes to the logs, one at a time.
+        self._lock = defer.DeferredLock()
+        self._snapshotting = None
+        self._loop = None
+        # While the rest of the snapshot is being read: the keys changed
+        # since it was taken, which it mustn't overwrite, and who is waiting
+        # for it to be read.
+        self._changedKeys = None
+        self._loading = None
+        JOURNAL_PENDING.setFunction(lambda: len(self._pending))
+
+
+    def _logPath(self, generation):
+        return '%s.log.%d' % (self.path, generation)
+
+
+    def _logGenerations(self):
+        directory, prefix = os.path.split(self.path)
+        prefix += '.log.'
+        generations = []
+        for name in os.listdir(directory or '.'):
+            if name.startswith(prefix):
+                try:
+                    generations.append(int(name[len(prefix):]))
+                except ValueError:
+                    pass
+        return sorted(generations)
+
+
+    def _readLog(self, generation):
+        """
+        Yield the groups of records in a log, stopping at one cut short by a
+        crash.
+        """
+        with open(self._logPath(generation), 'rb') as f:
+            data = f.read()
+        return _unframe(data)
+
+
+    def load(self, budget=0.5):
+        """
+        Fill the store from the latest snapshot and the logs written since,
+        and start a new log.
+
+        The snapshot is read for at most C{budget} seconds.  The rest of it
+        is read in the background, C{load_slice} seconds at a time, once the
+        store is in use; until then the keys in it look missing, and any
+        key changed in the meantime keeps its new state.  Logs are replayed
+        for at most C{budget} seconds; whatever doesn't fit is left out, as
+        if those changes had never been made.  C{python -m vc.bench.persist}
+        measures how long both take.  Changes to keys which have since
+        expired are skipped; expired keys in the snapshot are never seen,
+        and go with the store's next sweep.
+
+        @return: The number of keys loaded before returning.
+        """
+        start = timer()
+        now = self.clock.seconds()
+        # Collecting while building millions of objects only slows it down.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            generation, data, deadlines, rest = self._readSnapshot(budget)
+            changed = None if rest is None else set()
+            self._replay(generation, data, deadlines, changed, now, budget)
+        finally:
+            if collecting:
+                gc.enable()
+        self.store.restore(data, deadlines)
+        self._log = open(self._logPath(self.generation), 'ab')
+        self.store.journal = self
+        log.msg('Loaded %d keys in %.3fs' % (len(data), timer() - start),
+            system='store')
+        if rest is not None:
+            self._changedKeys = changed
+            self._loading = []
+            self.clock.callLater(0, self._loadMore, rest, timer(), 0)
+        return len(data)
+
+
+    def _readSnapshot(self, budget):
+        """
+        Read the snapshot for at most C{budget} seconds.
+
+        @return: Its generation, the values and deadlines of the keys read,
+            and an iterator over the chunks left, or C{None} if it was all
+            read.
+        """
+        path = self.path + '.snapshot'
+        if not os.path.exists(path):
+            return 0, {}, {}, None
+        with open(path, 'rb') as f:
+            chunks = _unframe(f.read())
+        header = next(chunks, None)
+        if not isinstance(header, tuple) or header[0] != FORMAT:
+            raise ValueError('Unknown snapshot format in %s' % (path,))
+        generation = header[1]
+        data, deadlines = {}, {}
+        start = timer()
+        for chunk_data, chunk_deadlines in chunks:
+            data.update(chunk_data)
+            deadlines.update(chunk_deadlines)
+            if timer() - start > budget:
+                return generation, data, deadlines, chunks
+        return generation, data, deadlines, None
+
+
+    def _loadMore(self, chunks, started, loaded):
+        """
+        Read the rest of the snapshot into the store for C{load_slice}
+        seconds, then let the reactor run before carrying on.
+        """
+        start = timer()
+        for chunk_data, chunk_deadlines in chunks:
+            for key in self._changedKeys.intersection(chunk_data):
+                del chunk_data[key]
+                chunk_deadlines.pop(key, None)
+            self.store.merge(chunk_data, chunk_deadlines)
+            loaded += len(chunk_data)
+            if timer() - start > self.load_slice:
+                self.clock.callLater(0, self._loadMore, chunks, started,
+                    loaded)
+                return
+        log.msg('Loaded %d more keys in the background in %.3fs' % (
+            loaded, timer() - started), system='store')
+        self._changedKeys = None
+        waiting, self._loading = self._loading, None
+        for d in waiting:
+            d.callback(None)
+
+
+    def whenLoaded(self):
+        """
+        @return: A Deferred which fires once the whole snapshot has been
+            read.
+        """
+        if self._loading is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._loading.append(d)
+        return d
+
+
+    def _replay(self, generation, data, deadlines, changed, now, budget):
+        """
+        Apply the changes in the logs since C{generation} to C{data} and
+        C{deadlines}, adding the keys changed to C{changed} unless it's
+        C{None}.
+        """
+        logs = [g for g in self._logGenerations() if g >= generation]
+        self.generation = max([generation] + logs) + 1
+        start = timer()
+        for g in logs:
+            for group in self._readLog(g):
+                for record in group:
+                    if changed is not None:
+                        changed.add(record[0])
+                    if len(record) == 1 or (record[2] is not None and
+                            record[2] <= now):
+                        # Removed, or since expired.
+                        data.pop(record[0], None)
+                        deadlines.pop(record[0], None)
+                    else:
+                        key, value, deadline = record
+                        data[key] = value
+                        if deadline is None:
+                            deadlines.pop(key, None)
+                        else:
+                            deadlines[key] = deadline
+                if timer() - start > budget:
+                    log.msg('Ran out of time replaying %s; the rest of the '
+                        'token store journal is left out' % (
+                        self._logPath(g),), system='store')
+                    return
+
+
+    def start(self, budget=0.5):
+        """
+        Load the store and take snapshots every C{snapshot_interval}
+        seconds.
+        """
+        self.load(budget)
+        self._loop = task.LoopingCall(self._snapshot)
+        self._loop.clock = self.clock
+        self._loop.start(self.snapshot_interval, now=False)
+
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """
+        Stop keeping the store, after writing a final snapshot.
+        """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        yield self.snapshot()
+        self.store.journal = None
+        yield self.flush()
+        self._log.close()
+
+
+    def changed(self, key, value, deadline):
+        """
+        Called by the store when C{key} changes to C{value} (or L{NOTHING}
+        if it was removed) with C{deadline}.
+        """
+        if self._changedKeys is not None:
+            self._changedKeys.add(key)
+        if value is NOTHING:
+            record = (key,)
+        else:
+            record = (key, value, deadline)
+        self._pending.append(record)
+        if self._flusher is None:
+            self._flusher = self.clock.callLater(self.sync_interval,
+                self.flush)
+
+
+    def flush(self):
+        """
+        Write and sync the changes made so far to the current log.
+
+        @return: A Deferred which fires when they're on disk.
+        """
+        if self._flusher is not None:
+            if self._flusher.active():
+                self._flusher.cancel()
+            self._flusher = None
+        if not self._pending:
+            # Still wait for earlier writes.
+            return self._lock.run(defer.succeed, None)
+        data = _frame(self._pending)
+        self._pending = []
+        start = timer()
+        d = self._lock.run(threads.deferToThread, self._write, self._log,
+            data)
+        d.addCallback(lambda _: JOURNAL_SYNC_SECONDS.observe(timer() - start))
+        d.addErrback(log.err, 'Error writing the token store journal')
+        return d
+
+
+    def _write(self, f, data):
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+    def _snapshot(self):
+        d = self.snapshot()
+        d.addErrback(log.err, 'Error writing a token store snapshot')
+        return d
+
+
+    def snapshot(self):
+        """
+        Write the whole store, then remove the logs it replaces.
+        """
+        if self._snapshotting is None:
+            self._snapshotting = self._writeSnapshot()
+            def done(result):
+                self._snapshotting = None
+                return result
+            self._snapshotting.addBoth(done)
+        # Everyone asking while one is being written shares it.
+        d = defer.Deferred()
+        def fire(result):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+        self._snapshotting.addBoth(fire)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _writeSnapshot(self):
+        # Keys not read yet would be missing from it.
+        yield self.whenLoaded()
+        start = timer()
+        # Changes so far go to the old log, in case this snapshot is never
+        # finished, and changes from here on go to a new one.
+        self.flush()
+        data, deadlines = self.store.dump()
+        old_log = self._log
+        self.generation += 1
+        self._log = open(self._logPath(self.generation), 'ab')
+        yield self._lock.run(defer.succeed, None)
+        old_log.close()
+        yield threads.deferToThread(self._writeSnapshotFile,
+            self.generation, data, deadlines)
+        for g in self._logGenerations():
+            if g < self.generation:
+                os.remove(self._logPath(g))
+        SNAPSHOT_SECONDS.observe(timer() - start)
+
+
+    def _writeSnapshotFile(self, generation, data, deadlines):
+        path = self.path + '.snapshot'
+        partial = path + '.partial'
+        items = iter(data.items())
+        with open(partial, 'wb') as f:
+            f.write(_frame((FORMAT, generation)))
+            while True:
+                chunk = dict(itertools.islice(items, self.snapshot_chunk))
+                if not chunk:
+                    break
+                f.write(_frame((chunk, dict((key, deadlines[key])
+                    for key in chunk if key in deadlines))))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(partial, path)
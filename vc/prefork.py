@@ -0,0 +1,152 @@
+"""
+Run several worker processes sharing one listening socket.
+"""
+from twisted.internet import defer, protocol, error
+from twisted.python import log
+
+import os
+import socket
+
+
+
+def listeningSocket(port, interface='', backlog=1024):
+    """
+    Bind a non-blocking listening TCP socket that workers can adopt.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.pid = None
+        self.ended = defer.Deferred()
+
+
+    def processEnded(self, reason):
+        self.pool._workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+
+class WorkerPool(object):
+    """
+    I start C{workers} copies of a program, hand each of them the listening
+    socket C{fd} and start a new one whenever one dies.
+
+    Each worker is told the socket's descriptor in the C{VC_LISTEN_FD}
+    environment variable.
+    """
+
+    fd_variable = 'VC_LISTEN_FD'
+
+
+    def __init__(self, reactor, argv, workers, fd, env=None,
+            respawn_delay=1, stop_timeout=30):
+        """
+        @param argv: The worker's command line; C{argv[0]} is the executable.
+        @param fd: The listening socket's file descriptor.
+        @param env: Extra environment variables for the workers.
+        @param respawn_delay: Seconds to wait before replacing a dead worker.
+        @param stop_timeout: Seconds a worker is given to exit after
+            C{SIGTERM} before it is killed.
+        """
+        self.reactor = reactor
+        self.argv = argv
+        self.workers = workers
+        self.fd = fd
+        self.env = dict(os.environ)
+        self.env.update(env or {})
+        self.env[self.fd_variable] = str(fd)
+        self.respawn_delay = respawn_delay
+        self.stop_timeout = stop_timeout
+        self.running = False
+        self.protocols = []
+        self._retiring = []
+
+
+    def start(self):
+        self.running = True
+        for _ in range(self.workers):
+            self._spawn()
+
+
+    def _spawn(self):
+        if not self.running:
+            return
+        proto = WorkerProtocol(self)
+        self.reactor.spawnProcess(proto, self.argv[0], self.argv,
+            env=self.env, childFDs={0: 0, 1: 1, 2: 2, self.fd: self.fd})
+        proto.pid = proto.transport.pid
+        self.protocols.append(proto)
+        log.msg('Started worker %r' % (proto.pid,), system='prefork')
+
+
+    def _workerEnded(self, proto, reason):
+        log.msg('Worker %r ended: %s' % (proto.pid, reason.value),
+            system='prefork')
+        if proto in self._retiring:
+            self._retiring.remove(proto)
+            return
+        self.protocols.remove(proto)
+        self.reactor.callLater(self.respawn_delay, self._spawn)
+
+
+    def _retire(self, proto):
+        """
+        Ask a worker to exit, killing it if it doesn't do so in time.
+
+        @return: A Deferred which fires once the worker has exited.
+        """
+        self.protocols.remove(proto)
+        self._retiring.append(proto)
+        try:
+            proto.transport.signalProcess('TERM')
+        except error.ProcessExitedAlready:
+            return proto.ended
+        def kill():
+            try:
+                proto.transport.signalProcess('KILL')
+            except error.ProcessExitedAlready:
+                pass
+        killer = self.reactor.callLater(self.stop_timeout, kill)
+        def cancel(result):
+            if killer.active():
+                killer.cancel()
+            return result
+        return proto.ended.addBoth(cancel)
+
+
+    @defer.inlineCallbacks
+    def restart(self):
+        """
+        Replace every worker, one at a time.  Each new worker is started
+        before the old one is asked to exit, so the socket is always being
+        served.
+        """
+        for proto in list(self.protocols):
+            if proto not in self.protocols:
+                # It died while an earlier one was being replaced, and has
+                # been replaced already.
+                continue
+            self._spawn()
+            yield self._retire(proto)
+
+
+    def stop(self):
+        """
+        Stop every worker and don't start new ones.
+
+        @return: A Deferred which fires once every worker has exited.
+        """
+        self.running = False
+        return defer.DeferredList([self._retire(proto)
+            for proto in list(self.protocols)])
@@ -0,0 +1,215 @@
+from twisted.internet import defer, reactor
+
+from io import StringIO
+
+import cProfile
+import os
+import pstats
+import signal
+import sys
+
+from vc.metrics import timer
+
+
+
+def _label(code):
+    path = code.co_filename.split(os.sep)
+    return '%s:%s' % ('/'.join(path[-2:]), code.co_name)
+
+
+def collapse(counts):
+    """
+    Format sampled stacks one per line, outermost frame first, with the
+    number of times each was seen, as read by C{flamegraph.pl}.
+
+    @param counts: A dict of tuples of code objects (innermost first) to
+        counts.
+    """
+    lines = {}
+    for codes, count in counts.items():
+        line = ';'.join(_label(code) for code in reversed(codes))
+        lines[line] = lines.get(line, 0) + count
+    return ''.join('%s %d\n' % (line, count)
+        for line, count in sorted(lines.items()))
+
+
+def formatSteps(steps, threshold):
+    """
+    Format slow C{inlineCallbacks} steps, slowest in total first.
+
+    @param steps: A dict of C{(code, from line, to line)} to lists of
+        seconds taken.
+    """
+    out = ['# inlineCallbacks steps over %.1fms\n' % (threshold * 1000,),
+        '%6s %10s %10s  %s\n' % ('count', 'total_ms', 'max_ms', 'step')]
+    for (code, start, end), times in sorted(steps.items(),
+            key=lambda x: -sum(x[1])):
+        out.append('%6d %10.1f %10.1f  %s (lines %d-%d)\n' % (len(times),
+            sum(times) * 1000, max(times) * 1000, _label(code), start, end))
+    return ''.join(out)
+
+
+
+class Profiler(object):
+    """
+    I profile the reactor thread on demand, one way at a time, for at most
+    C{max_seconds}.  Nothing is hooked in while I'm not profiling.
+
+    Three ways are offered:
+
+      - L{sample}: a C{SIGPROF} timer records the reactor thread's stack
+        every C{interval} seconds of CPU time, for a flame graph.
+      - L{slowSteps}: every step of an C{inlineCallbacks} generator (from
+        one C{yield} to the next) slower than a threshold is recorded.
+      - L{profileRequest}: the next request marked with an C{X-Profile}
+        header is run under C{cProfile}.
+    """
+
+    max_seconds = 60
+
+
+    def __init__(self, interval=0.005, clock=reactor):
+        """
+        @param interval: Seconds of CPU time between samples.
+        """
+        self.interval = interval
+        self.clock = clock
+        self._finish = None
+        self._wanted = False
+        self._profile = None
+
+
+    @property
+    def busy(self):
+        return self._finish is not None
+
+
+    def _run(self, seconds, begin, finish):
+        """
+        Call C{begin} now and C{finish} after C{seconds}, or when L{stop} is
+        called.
+
+        @return: A Deferred firing with C{finish}'s result.
+        """
+        if self.busy:
+            raise ValueError('Already profiling')
+        d = defer.Deferred()
+        def done():
+            self._finish = None
+            if call.active():
+                call.cancel()
+            d.callback(finish())
+        begin()
+        self._finish = done
+        call = self.clock.callLater(seconds, done)
+        return d
+
+
+    def stop(self):
+        """
+        Stop profiling early.
+        """
+        if self._finish is not None:
+            self._finish()
+
+
+    def sample(self, seconds):
+        """
+        Sample the reactor thread's stack for C{seconds}.
+
+        @return: A Deferred firing with the collapsed stacks.
+        """
+        counts = {}
+        def sampled(signum, frame):
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes = tuple(codes)
+            counts[codes] = counts.get(codes, 0) + 1
+        previous = []
+        def begin():
+            previous.append(signal.signal(signal.SIGPROF, sampled))
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        def finish():
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous[0])
+            return collapse(counts)
+        return self._run(seconds, begin, finish)
+
+
+    def slowSteps(self, seconds, threshold=0.01):
+        """
+        Record C{inlineCallbacks} steps which take at least C{threshold}
+        seconds, for C{seconds}.  Every Python call is traced meanwhile, so
+        everything is slower.
+
+        @return: A Deferred firing with a table of the slow steps.
+        """
+        started = {}
+        steps = {}
+        def traced(frame, event, arg):
+            if event == 'call':
+                back = frame.f_back
+                if back is not None and \
+                        back.f_code.co_name == '_inlineCallbacks':
+                    started[frame] = (timer(), frame.f_lineno)
+            elif event == 'return' and frame in started:
+                start, line = started.pop(frame)
+                elapsed = timer() - start
+                if elapsed >= threshold:
+                    steps.setdefault((frame.f_code, line, frame.f_lineno),
+                        []).append(elapsed)
+        def begin():
+            sys.setprofile(traced)
+        def finish():
+            sys.setprofile(None)
+            return formatSteps(steps, threshold)
+        return self._run(seconds, begin, finish)
+
+
+    def profileRequest(self, seconds):
+        """
+        Run the next request marked with an C{X-Profile} header in the next
+        C{seconds} under C{cProfile}.  Everything else the reactor does
+        meanwhile is profiled too.
+
+        @return: A Deferred firing with the profile's statistics.
+        """
+        def begin():
+            self._wanted = True
+            self._profile = None
+        def finish():
+            self._wanted = False
+            profile, self._profile = self._profile, None
+            if profile is None:
+                return 'No request was profiled\n'
+            out = StringIO()
+            stats = pstats.Stats(profile, stream=out)
+            stats.sort_stats('cumulative').print_stats(50)
+            return out.getvalue()
+        return self._run(seconds, begin, finish)
+
+
+    def wants(self, request):
+        """
+        Return C{True} if C{request} should be run with L{profile}.
+        """
+        return self._wanted and bool(request.getHeader('x-profile'))
+
+
+    def profile(self, f, *args, **kwargs):
+        """
+        Call C{f} under C{cProfile} until its result is ready, and finish
+        L{profileRequest}.
+        """
+        self._wanted = False
+        profile = cProfile.Profile()
+        profile.enable()
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        def done(result):
+            profile.disable()
+            self._profile = profile
+            self.stop()
+            return result
+        return d.addBoth(done)
@@ -0,0 +1,128 @@
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+from sqlalchemy.sql import select, func, text, bindparam
+from sqlalchemy import DateTime
+
+import datetime
+
+from vc.sql import Vote, RollupWatermark, inTransaction
+from vc.metrics import REGISTRY
+
+
+ROLLUP_VOTES = REGISTRY.counter('vc_rollup_votes_total',
+    'Votes added to the per-minute rollup')
+ROLLUP_WATERMARK = REGISTRY.gauge('vc_rollup_watermark',
+    'Id of the last vote in the per-minute rollup')
+
+
+_upsert = text('''
+    INSERT INTO vote_rollup (minute, poll, key, count)
+    VALUES (:minute, :poll, :key, :count)
+    ON CONFLICT (minute, poll, key)
+    DO UPDATE SET count = vote_rollup.count + excluded.count
+''').bindparams(bindparam('minute', type_=DateTime))
+
+
+
+class RollupAggregator(object):
+    """
+    I keep the C{vote_rollup} table of votes per poll option per minute up to
+    date.  Each batch reads the votes after the id in C{rollup_watermark},
+    adds them to the rollup and moves the watermark past them, all in one
+    transaction, so every vote is counted exactly once.
+
+    Ids are handed out before votes are committed, so a vote can become
+    visible after one with a higher id.  Votes younger than C{lag} seconds
+    are therefore left for a later batch, as is everything after them.
+    """
+
+    name = 'vote_rollup'
+
+
+    def __init__(self, engine, batch_size=10000, interval=10, lag=5,
+            clock=reactor):
+        """
+        @param batch_size: Maximum number of votes read per transaction.
+        @param interval: Seconds between catching up.
+        @param lag: Seconds a vote must be old before it's rolled up.
+        """
+        self.engine = engine
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lag = lag
+        self.clock = clock
+        self._loop = None
+
+
+    def start(self):
+        """
+        Catch up now and every C{interval} seconds.
+        """
+        self._loop = task.LoopingCall(self._catchUp)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval)
+
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+
+    def _catchUp(self):
+        d = self.catchUp()
+        d.addErrback(log.err, 'Error rolling up votes')
+        return d
+
+
+    @defer.inlineCallbacks
+    def catchUp(self):
+        """
+        Roll up batches until there are no votes old enough left.
+
+        @return: A Deferred firing with the number of votes rolled up.
+        """
+        total = 0
+        while True:
+            count, last = yield inTransaction(self.engine, self._rollupBatch)
+            total += count
+            ROLLUP_VOTES.inc(count)
+            ROLLUP_WATERMARK.set(last)
+            if count < self.batch_size:
+                break
+        defer.returnValue(total)
+
+
+    def _rollupBatch(self, conn):
+        """
+        Roll up one batch on a synchronous connection.
+
+        @return: The number of votes rolled up, and the watermark.
+        """
+        watermark = RollupWatermark.c.name == self.name
+        last = conn.execute(select([RollupWatermark.c.last_id])
+            .where(watermark)).scalar()
+        now = conn.execute(select([func.current_timestamp()])).scalar()
+        cutoff = now.replace(tzinfo=None) - datetime.timedelta(
+            seconds=self.lag)
+        rows = conn.execute(select([Vote.c.id, Vote.c.poll, Vote.c.key,
+            Vote.c.created])
+            .where(Vote.c.id > last)
+            .order_by(Vote.c.id)
+            .limit(self.batch_size)).fetchall()
+        counts = {}
+        ready = 0
+        for id, poll, key, created in rows:
+            if created > cutoff:
+                break
+            bucket = (created.replace(second=0, microsecond=0), poll, key)
+            counts[bucket] = counts.get(bucket, 0) + 1
+            last = id
+            ready += 1
+        if ready:
+            conn.execute(_upsert, [
+                {'minute': minute, 'poll': poll, 'key': key, 'count': count}
+                for (minute, poll, key), count in counts.items()])
+            conn.execute(RollupWatermark.update().where(watermark)
+                .values(last_id=last))
+        return ready, last
@@ -0,0 +1,438 @@
+"""
+A key-value store shared by every process on a host through a memory-mapped
+file.
+"""
+from twisted.internet import defer, reactor, task
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+from vc.error import StoreFull
+from vc.token import NOTHING
+
+
+
+# Slot states
+EMPTY = 0
+USED = 1
+REMOVED = 2
+
+
+class SharedMemoryStore(object):
+    """
+    I am a key-value store of integers kept in a fixed-size open-addressing
+    hash table in a memory-mapped file.  Every process which opens the same
+    file sees the same data, and each operation (or pipeline of operations)
+    holds an exclusive lock on the file, so it is atomic across processes.
+
+    I implement the same interface as L{vc.token.MemoryStore}, except that
+    values must be integers.
+    """
+
+    # magic, number of slots, number of slots in use
+    _header = struct.Struct('<8sII')
+    _used = struct.Struct('<I')
+    _used_offset = 12
+    _state = struct.Struct('<B')
+    _magic = b'VCSHM002'
+
+    # state, key length, key hash, value, deadline (0 for none), key
+    _slot = struct.Struct('<BBxxIqd64s')
+    key_size = 64
+
+    operations = frozenset(['setValue', 'getValue', 'rmValue', 'exists',
+        'increment', 'expire', 'take', 'put', 'hit'])
+
+
+    def __init__(self, path, slots=65536, clock=reactor, reclaim_interval=1,
+            reclaim_slots=4096):
+        """
+        @param path: File backing the table.  It's created if it doesn't
+            exist; if it does, its existing size is used.
+        @param slots: Number of keys the table can hold.
+        @param reclaim_interval: Seconds between calls to L{reclaim}, or
+            C{None} to only reclaim when it's called.
+        @param reclaim_slots: Number of slots each call to L{reclaim} sweeps.
+        """
+        self.clock = clock
+        self.reclaim_slots = reclaim_slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size < self._header.size:
+                size = self._header.size + slots * self._slot.size
+                os.ftruncate(self._fd, size)
+                os.write(self._fd, self._header.pack(self._magic, slots, 0))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        magic, self.slots, _ = self._header.unpack_from(self._map, 0)
+        if magic != self._magic:
+            raise ValueError('%r is not a shared memory store' % (path,))
+        # Where the next reclaim starts, sweeping backwards.
+        self._cursor = 0
+        self._reclaimer = None
+        if reclaim_interval is not None:
+            self._reclaimer = task.LoopingCall(self.reclaim)
+            self._reclaimer.clock = clock
+            self._reclaimer.start(reclaim_interval, now=False)
+
+
+    def close(self):
+        if self._reclaimer is not None and self._reclaimer.running:
+            self._reclaimer.stop()
+        self._map.close()
+        os.close(self._fd)
+
+
+    def _lock(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+
+
+    def _unlock(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+
+    def _locked(self, func, *args):
+        self._lock()
+        try:
+            return defer.succeed(func(*args))
+        except Exception:
+            return defer.fail()
+        finally:
+            self._unlock()
+
+
+    def _encodeKey(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        if len(key) > self.key_size:
+            key = b'#' + hashlib.sha1(key).digest()
+        return key
+
+
+    def _offset(self, index):
+        return self._header.size + index * self._slot.size
+
+
+    def _find(self, key):
+        """
+        Find C{key}'s slot.
+
+        @return: A tuple of (index of the key's slot or C{None}, index of
+            the first free slot on the probe path or C{None}).
+        """
+        h = zlib.crc32(key) & 0xffffffff
+        now = None
+        free = None
+        index = h % self.slots
+        for _ in range(self.slots):
+            offset = self._offset(index)
+            state, keylen, khash, value, deadline, kbytes = \
+                self._slot.unpack_from(self._map, offset)
+            if state == EMPTY:
+                if free is None:
+                    free = index
+                return None, free
+            if state == USED and deadline:
+                if now is None:
+                    now = self.clock.seconds()
+                if deadline <= now:
+                    self._setState(index, REMOVED)
+                    state = REMOVED
+            if state == REMOVED:
+                if free is None:
+                    free = index
+            elif khash == h and kbytes[:keylen] == key:
+                return index, free
+            index = (index + 1) % self.slots
+        return None, free
+
+
+    def _getState(self, index):
+        return self._state.unpack_from(self._map, self._offset(index))[0]
+
+
+    def _setState(self, index, state):
+        offset = self._offset(index)
+        if self._state.unpack_from(self._map, offset)[0] == USED:
+            self._addUsed(-1)
+        self._state.pack_into(self._map, offset, state)
+
+
+    def _addUsed(self, amount):
+        used = self._used.unpack_from(self._map, self._used_offset)[0]
+        self._used.pack_into(self._map, self._used_offset, used + amount)
+
+
+    def _read(self, index):
+        state, keylen, khash, value, deadline, kbytes = \
+            self._slot.unpack_from(self._map, self._offset(index))
+        return value, deadline
+
+
+    def _write(self, key, value, deadline, index=None):
+        if index is None:
+            index, free = self._find(key)
+            if index is None:
+                index = free
+        if index is None:
+            raise StoreFull('No free slots left')
+        if self._getState(index) != USED:
+            self._addUsed(1)
+        self._slot.pack_into(self._map, self._offset(index), USED, len(key),
+            zlib.crc32(key) & 0xffffffff, value, deadline, key)
+        return index
+
+
+    def _deadline(self, seconds):
+        if seconds is None:
+            return 0.0
+        return self.clock.seconds() + seconds
+
+
+    def __len__(self):
+        """
+        Number of slots in use, including expired keys not yet reclaimed.
+        """
+        return self._used.unpack_from(self._map, self._used_offset)[0]
+
+
+    def reclaim(self, count=None):
+        """
+        Sweep the next C{count} slots (by default C{reclaim_slots}), working
+        backwards through the table a slice at a time.
+
+        Expired keys are removed, and removed slots just before an empty one
+        are emptied, so that lookups stop there instead of probing past
+        them.  Only the slice is swept while holding the lock, so other
+        processes are never kept waiting for long.
+        """
+        if count is None:
+            count = self.reclaim_slots
+        count = min(count, self.slots)
+        self._lock()
+        try:
+            now = self.clock.seconds()
+            index = self._cursor
+            following = self._getState(index)
+            for _ in range(count):
+                index = (index - 1) % self.slots
+                state, keylen, khash, value, deadline, kbytes = \
+                    self._slot.unpack_from(self._map, self._offset(index))
+                if state == USED and deadline and deadline <= now:
+                    self._setState(index, REMOVED)
+                    state = REMOVED
+                if state == REMOVED and following == EMPTY:
+                    self._setState(index, EMPTY)
+                    state = EMPTY
+                following = state
+            self._cursor = index
+        finally:
+            self._unlock()
+
+
+    def _checkValue(self, value):
+        if not isinstance(value, int) or isinstance(value, bool):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise TypeError('Only integers can be stored, not %r' % (
+                    value,))
+        return value
+
+
+    # Unlocked operations
+
+    def _setValue(self, key, value):
+        key = self._encodeKey(key)
+        value = self._checkValue(value)
+        index, free = self._find(key)
+        deadline = 0.0
+        if index is not None:
+            deadline = self._read(index)[1]
+        else:
+            index = free
+        self._write(key, value, deadline, index)
+
+
+    def _getValue(self, key, default=NOTHING):
+        index, _ = self._find(self._encodeKey(key))
+        if index is not None:
+            return self._read(index)[0]
+        if default is NOTHING:
+            raise KeyError(key)
+        return default
+
+
+    def _rmValue(self, key):
+        index, _ = self._find(self._encodeKey(key))
+        if index is None:
+            raise KeyError(key)
+        self._setState(index, REMOVED)
+
+
+    def _exists(self, key):
+        index, _ = self._find(self._encodeKey(key))
+        return index is not None
+
+
+    def _increment(self, key, amount, expire=None):
+        key = self._encodeKey(key)
+        index, free = self._find(key)
+        if index is None:
+            value, deadline, index = amount, self._deadline(expire), free
+        else:
+            value, deadline = self._read(index)
+            value += amount
+        self._write(key, value, deadline, index)
+        return value
+
+
+    def _take(self, key, amount=1, initial=None, expire=None,
+            remove_empty=False):
+        key = self._encodeKey(key)
+        index, free = self._find(key)
+        created = index is None
+        if created:
+            if initial is None:
+                return None
+            value, deadline, index = initial, self._deadline(expire), free
+        else:
+            value, deadline = self._read(index)
+        left = value - amount
+        if left < 0:
+            if created:
+                self._write(key, value, deadline, index)
+            return None
+        if left == 0 and remove_empty:
+            if not created:
+                self._setState(index, REMOVED)
+        else:
+            self._write(key, left, deadline, index)
+        return left
+
+
+    def _put(self, key, amount, full):
+        key = self._encodeKey(key)
+        index, free = self._find(key)
+        created = index is None
+        if created:
+            value, deadline, index = amount, 0.0, free
+        else:
+            value, deadline = self._read(index)
+            value += amount
+        if value >= full:
+            if not created:
+                self._setState(index, REMOVED)
+        else:
+            self._write(key, value, deadline, index)
+        return value
+
+
+    def _hit(self, key, limit, window):
+        # Each of the last limit hits is kept in its own slot, which expires
+        # when the hit leaves the window.
+        used = 0
+        free = None
+        for i in range(limit):
+            subkey = self._encodeKey('%s|%d' % (key, i))
+            index, slot = self._find(subkey)
+            if index is not None:
+                used += 1
+            elif free is None:
+                free = (subkey, slot)
+        if free is None:
+            return None
+        subkey, slot = free
+        now = self.clock.seconds()
+        self._write(subkey, int(now * 1000), now + window, slot)
+        return limit - used - 1
+
+
+    def _expire(self, key, seconds):
+        key = self._encodeKey(key)
+        index, _ = self._find(key)
+        if index is not None:
+            value = self._read(index)[0]
+            self._write(key, value, self._deadline(seconds), index)
+
+
+    # Public interface
+
+    def setValue(self, key, value):
+        return self._locked(self._setValue, key, value)
+
+
+    def getValue(self, key, default=NOTHING):
+        return self._locked(self._getValue, key, default)
+
+
+    def rmValue(self, key):
+        return self._locked(self._rmValue, key)
+
+
+    def exists(self, key):
+        return self._locked(self._exists, key)
+
+
+    def increment(self, key, amount, expire=None):
+        """
+        Increment a value by a certain amount.
+
+        @param expire: If the key is created by this increment, it expires
+            in this many seconds.
+        """
+        return self._locked(self._increment, key, amount, expire)
+
+
+    def take(self, key, amount=1, initial=None, expire=None,
+            remove_empty=False):
+        """
+        See L{vc.token.MemoryStore.take}.
+        """
+        return self._locked(self._take, key, amount, initial, expire,
+            remove_empty)
+
+
+    def put(self, key, amount, full):
+        """
+        See L{vc.token.MemoryStore.put}.
+        """
+        return self._locked(self._put, key, amount, full)
+
+
+    def hit(self, key, limit, window):
+        """
+        See L{vc.token.MemoryStore.hit}.
+        """
+        return self._locked(self._hit, key, limit, window)
+
+
+    def expire(self, key, seconds):
+        """
+        Set a key to expire in C{seconds} seconds.
+        """
+        return self._locked(self._expire, key, seconds)
+
+
+    def pipeline(self, operations):
+        """
+        Run several operations under a single lock.  See
+        L{vc.token.MemoryStore.pipeline}.
+        """
+        def run():
+            results = []
+            for operation in operations:
+                name, args = operation[0], operation[1:]
+                if name not in self.operations:
+                    raise ValueError('%r is not a pipeline operation' % (
+                        name,))
+                results.append(getattr(self, '_' + name)(*args))
+            return results
+        return self._locked(run)
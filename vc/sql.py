@@ -1,11 +1,22 @@
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.internet.threads import deferToThreadPool
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime
-from sqlalchemy.sql import select
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql import select, func, bindparam
+from alchimia import TWISTED_STRATEGY
+from alchimia.engine import TwistedEngine
+from alchimia.strategy import TwistedEngineStrategy
 
 from collections import OrderedDict
+import datetime
+import sqlite3
 
-from vc.error import NotAnOption
+from vc.error import NotAnOption, NoSuchPoll, BufferFull
+from vc.metrics import REGISTRY, timer
 
 metadata = MetaData()
 
@@ -19,12 +30,38 @@ Total = Table('total', metadata,
     Column('count', Integer),
     Column('updated', DateTime),
 )
+TotalShard = Table('total_shard', metadata,
+    Column('poll', String, primary_key=True),
+    Column('key', String, primary_key=True),
+    Column('shard', Integer, primary_key=True),
+    Column('count', Integer),
+    Column('updated', DateTime),
+)
 Vote = Table('vote', metadata,
     Column('id', Integer, primary_key=True),
     Column('created', DateTime),
+    Column('poll', String),
     Column('key', String),
     Column('ip', String),
 )
+VoteRollup = Table('vote_rollup', metadata,
+    Column('minute', DateTime, primary_key=True),
+    Column('poll', String, primary_key=True),
+    Column('key', String, primary_key=True),
+    Column('count', Integer),
+)
+Poll = Table('poll', metadata,
+    Column('id', String, primary_key=True),
+    Column('created', DateTime),
+)
+PollOption = Table('poll_option', metadata,
+    Column('poll', String, primary_key=True),
+    Column('key', String, primary_key=True),
+)
+RollupWatermark = Table('rollup_watermark', metadata,
+    Column('name', String, primary_key=True),
+    Column('last_id', Integer),
+)
 
 
 patches = OrderedDict()
@@ -67,16 +104,512 @@ patches['first'] = [
 
 
 
+# Number of rows each option's total is spread over.  A vote increments the
+# shard belonging to the database backend that inserted it, so concurrent
+# writers don't queue on a single row lock.
+TOTAL_SHARDS = 16
+
+patches['sharded_total'] = [
+    '''CREATE TABLE total_shard (
+        key text,
+        shard integer,
+        count integer default 0,
+        updated timestamp default current_timestamp,
+        primary key (key, shard)
+    )''',
+    '''INSERT INTO total_shard (key, shard, count, updated)
+        SELECT key, 0, count, updated FROM total''',
+    'DROP TRIGGER inc_vote_total ON vote',
+    'DROP FUNCTION inc_vote_total()',
+    'DROP TABLE total',
+    '''
+    CREATE FUNCTION inc_vote_total_shard() RETURNS trigger as $inc_vote_total_shard$
+    DECLARE
+        -- The shard count is the trigger's argument.
+        pick integer := mod(pg_backend_pid(), TG_ARGV[0]::integer);
+    BEGIN
+        -- Try update
+        UPDATE total_shard SET count = count + 1, updated = current_timestamp
+            WHERE key = NEW.key AND shard = pick;
+        IF found THEN
+            RETURN NEW;
+        END IF;
+
+        -- Insert
+        BEGIN
+            INSERT INTO total_shard (key, shard, count)
+                VALUES (NEW.key, pick, 1);
+        EXCEPTION WHEN unique_violation THEN
+            UPDATE total_shard SET count = count + 1,
+                updated = current_timestamp
+                WHERE key = NEW.key AND shard = pick;
+        END;
+        RETURN NEW;
+    END;
+    $inc_vote_total_shard$ LANGUAGE plpgsql;
+    ''',
+    '''
+        CREATE TRIGGER inc_vote_total AFTER INSERT ON vote
+        FOR EACH ROW EXECUTE PROCEDURE inc_vote_total_shard('%d');
+    ''' % (TOTAL_SHARDS,),
+    # Kept so that ad-hoc queries against total still work.
+    '''CREATE VIEW total AS
+        SELECT key, sum(count) AS count, max(updated) AS updated
+        FROM total_shard GROUP BY key''',
+]
+
+
+
+
+# Votes are partitioned by day, so old days can be archived and dropped
+# without touching the rest.  The old table becomes the partition for
+# everything before tomorrow; vc.partition.VotePartitioner keeps partitions
+# made for the days after that.
+patches['partitioned_vote'] = [
+    'ALTER TABLE vote RENAME TO vote_unpartitioned',
+    'ALTER INDEX vote_pkey RENAME TO vote_unpartitioned_pkey',
+    'ALTER SEQUENCE vote_id_seq OWNED BY NONE',
+    'DROP TRIGGER inc_vote_total ON vote_unpartitioned',
+    '''UPDATE vote_unpartitioned SET created = current_timestamp
+        WHERE created IS NULL''',
+    'ALTER TABLE vote_unpartitioned ALTER created SET NOT NULL',
+    '''CREATE TABLE vote (
+        id integer not null default nextval('vote_id_seq'),
+        created timestamp not null default current_timestamp,
+        key text,
+        ip text,
+        primary key (id, created)
+    ) PARTITION BY RANGE (created)''',
+    'ALTER SEQUENCE vote_id_seq OWNED BY vote.id',
+    # For audits of an IP, and of a period.
+    'CREATE INDEX vote_ip_created ON vote (ip, created)',
+    'CREATE INDEX vote_created ON vote (created)',
+    '''
+    DO $attach$
+    BEGIN
+        EXECUTE 'ALTER TABLE vote ATTACH PARTITION vote_unpartitioned '
+            || 'FOR VALUES FROM (MINVALUE) TO ('
+            || quote_literal(current_date + 1) || ')';
+    END;
+    $attach$
+    ''',
+    # Catches votes for days that have no partition yet.
+    'CREATE TABLE vote_default PARTITION OF vote DEFAULT',
+    '''
+    CREATE FUNCTION create_vote_partition(day date) RETURNS text
+    AS $create_vote_partition$
+    DECLARE
+        name text := 'vote_p' || to_char(day, 'YYYYMMDD');
+    BEGIN
+        EXECUTE 'CREATE TABLE IF NOT EXISTS ' || quote_ident(name)
+            || ' PARTITION OF vote FOR VALUES FROM (' || quote_literal(day)
+            || ') TO (' || quote_literal(day + 1) || ')';
+        RETURN name;
+    EXCEPTION WHEN invalid_object_definition THEN
+        -- Another partition already covers the day.
+        RETURN NULL;
+    END;
+    $create_vote_partition$ LANGUAGE plpgsql;
+    ''',
+    '''SELECT create_vote_partition(current_date + n)
+        FROM generate_series(1, 7) n''',
+    '''
+        CREATE TRIGGER inc_vote_total AFTER INSERT ON vote
+        FOR EACH ROW EXECUTE PROCEDURE inc_vote_total_shard('%d');
+    ''' % (TOTAL_SHARDS,),
+]
+
+
+# Votes per option per minute, filled in by vc.rollup.RollupAggregator from
+# votes after the watermark's last_id.
+rollup_patch = [
+    '''CREATE TABLE vote_rollup (
+        minute timestamp,
+        key text,
+        count integer default 0,
+        primary key (minute, key)
+    )''',
+    '''CREATE TABLE rollup_watermark (
+        name text primary key,
+        last_id integer default 0
+    )''',
+    "INSERT INTO rollup_watermark (name, last_id) VALUES ('vote_rollup', 0)",
+]
+patches['vote_rollup'] = rollup_patch
+
+
+# The poll whose options are given to SQLVoteStore rather than stored in
+# the poll tables.  Votes from before there were polls belong to it.
+DEFAULT_POLL = ''
+
+# Votes and totals belong to a poll.
+patches['polls'] = [
+    '''CREATE TABLE poll (
+        id text primary key,
+        created timestamp default current_timestamp
+    )''',
+    '''CREATE TABLE poll_option (
+        poll text references poll (id) on delete cascade,
+        key text,
+        primary key (poll, key)
+    )''',
+    "ALTER TABLE vote ADD COLUMN poll text NOT NULL DEFAULT ''",
+    'CREATE INDEX vote_poll_created ON vote (poll, created)',
+    'DROP VIEW total',
+    "ALTER TABLE total_shard ADD COLUMN poll text NOT NULL DEFAULT ''",
+    'ALTER TABLE total_shard DROP CONSTRAINT total_shard_pkey',
+    'ALTER TABLE total_shard ADD PRIMARY KEY (poll, key, shard)',
+    '''
+    CREATE OR REPLACE FUNCTION inc_vote_total_shard() RETURNS trigger
+    AS $inc_vote_total_shard$
+    DECLARE
+        -- The shard count is the trigger's argument.
+        pick integer := mod(pg_backend_pid(), TG_ARGV[0]::integer);
+    BEGIN
+        -- Try update
+        UPDATE total_shard SET count = count + 1, updated = current_timestamp
+            WHERE poll = NEW.poll AND key = NEW.key AND shard = pick;
+        IF found THEN
+            RETURN NEW;
+        END IF;
+
+        -- Insert
+        BEGIN
+            INSERT INTO total_shard (poll, key, shard, count)
+                VALUES (NEW.poll, NEW.key, pick, 1);
+        EXCEPTION WHEN unique_violation THEN
+            UPDATE total_shard SET count = count + 1,
+                updated = current_timestamp
+                WHERE poll = NEW.poll AND key = NEW.key AND shard = pick;
+        END;
+        RETURN NEW;
+    END;
+    $inc_vote_total_shard$ LANGUAGE plpgsql;
+    ''',
+    '''CREATE VIEW total AS
+        SELECT poll, key, sum(count) AS count, max(updated) AS updated
+        FROM total_shard GROUP BY poll, key''',
+    "ALTER TABLE vote_rollup ADD COLUMN poll text NOT NULL DEFAULT ''",
+    'ALTER TABLE vote_rollup DROP CONSTRAINT vote_rollup_pkey',
+    'ALTER TABLE vote_rollup ADD PRIMARY KEY (minute, poll, key)',
+]
+
+
+# Votes for a day with no partition yet go to vote_default, and a
+# partition for that day can't be made while they're there, so they're
+# moved into it first.
+patches['partition_default_votes'] = [
+    '''
+    CREATE OR REPLACE FUNCTION create_vote_partition(day date) RETURNS text
+    AS $create_vote_partition$
+    DECLARE
+        name text := 'vote_p' || to_char(day, 'YYYYMMDD');
+        bounds text := ' FOR VALUES FROM (' || quote_literal(day)
+            || ') TO (' || quote_literal(day + 1) || ')';
+    BEGIN
+        EXECUTE 'CREATE TABLE IF NOT EXISTS ' || quote_ident(name)
+            || ' PARTITION OF vote' || bounds;
+        RETURN name;
+    EXCEPTION
+        WHEN invalid_object_definition THEN
+            -- Another partition already covers the day.
+            RETURN NULL;
+        WHEN check_violation THEN
+            -- vote_default has votes for the day.  Hold new ones back
+            -- while they're moved to a table that's then attached.
+            LOCK TABLE vote_default IN EXCLUSIVE MODE;
+            EXECUTE 'CREATE TABLE ' || quote_ident(name)
+                || ' (LIKE vote INCLUDING DEFAULTS INCLUDING CONSTRAINTS)';
+            EXECUTE 'WITH moved AS (DELETE FROM vote_default '
+                || 'WHERE created >= $1 AND created < $2 '
+                || 'RETURNING id, created, poll, key, ip) '
+                || 'INSERT INTO ' || quote_ident(name)
+                || ' (id, created, poll, key, ip) SELECT * FROM moved'
+                USING day, day + 1;
+            EXECUTE 'ALTER TABLE vote ATTACH PARTITION '
+                || quote_ident(name) || bounds;
+            RETURN name;
+    END;
+    $create_vote_partition$ LANGUAGE plpgsql;
+    ''',
+]
+
+
+DB_SECONDS = REGISTRY.histogram('vc_db_seconds',
+    'Time spent on database queries', ['query'])
+DB_INFLIGHT = REGISTRY.gauge('vc_db_inflight',
+    'Number of database queries in progress')
+
+
+
+# The same schema for SQLite, for single-node deployments.  SQLite only
+# allows one writer at a time, so totals aren't sharded: every vote updates
+# shard 0.
+sqlite_patches = OrderedDict()
+sqlite_patches['first'] = [
+    '''CREATE TABLE _schema_patch (
+        name text primary key,
+        created timestamp default current_timestamp
+    )''',
+    '''CREATE TABLE total_shard (
+        key text,
+        shard integer,
+        count integer default 0,
+        updated timestamp default current_timestamp,
+        primary key (key, shard)
+    )''',
+    '''CREATE TABLE vote (
+        id integer primary key autoincrement,
+        created timestamp default current_timestamp,
+        key text,
+        ip text
+    )''',
+    '''
+    CREATE TRIGGER inc_vote_total AFTER INSERT ON vote
+    BEGIN
+        INSERT OR IGNORE INTO total_shard (key, shard, count)
+            VALUES (NEW.key, 0, 0);
+        UPDATE total_shard SET count = count + 1, updated = current_timestamp
+            WHERE key = NEW.key AND shard = 0;
+    END
+    ''',
+    '''CREATE VIEW total AS
+        SELECT key, sum(count) AS count, max(updated) AS updated
+        FROM total_shard GROUP BY key''',
+]
+
+
+sqlite_patches['vote_indexes'] = [
+    'CREATE INDEX vote_ip_created ON vote (ip, created)',
+    'CREATE INDEX vote_created ON vote (created)',
+]
+
+
+sqlite_patches['vote_rollup'] = rollup_patch
+
+
+# SQLite can't change primary keys, so total_shard and vote_rollup are
+# copied into new tables.
+sqlite_patches['polls'] = [
+    '''CREATE TABLE poll (
+        id text primary key,
+        created timestamp default current_timestamp
+    )''',
+    '''CREATE TABLE poll_option (
+        poll text references poll (id) on delete cascade,
+        key text,
+        primary key (poll, key)
+    )''',
+    "ALTER TABLE vote ADD COLUMN poll text NOT NULL DEFAULT ''",
+    'CREATE INDEX vote_poll_created ON vote (poll, created)',
+    'DROP VIEW total',
+    'DROP TRIGGER inc_vote_total',
+    'ALTER TABLE total_shard RENAME TO total_shard_old',
+    '''CREATE TABLE total_shard (
+        poll text not null default '',
+        key text,
+        shard integer,
+        count integer default 0,
+        updated timestamp default current_timestamp,
+        primary key (poll, key, shard)
+    )''',
+    '''INSERT INTO total_shard (poll, key, shard, count, updated)
+        SELECT '', key, shard, count, updated FROM total_shard_old''',
+    'DROP TABLE total_shard_old',
+    '''
+    CREATE TRIGGER inc_vote_total AFTER INSERT ON vote
+    BEGIN
+        INSERT OR IGNORE INTO total_shard (poll, key, shard, count)
+            VALUES (NEW.poll, NEW.key, 0, 0);
+        UPDATE total_shard SET count = count + 1, updated = current_timestamp
+            WHERE poll = NEW.poll AND key = NEW.key AND shard = 0;
+    END
+    ''',
+    '''CREATE VIEW total AS
+        SELECT poll, key, sum(count) AS count, max(updated) AS updated
+        FROM total_shard GROUP BY poll, key''',
+    'ALTER TABLE vote_rollup RENAME TO vote_rollup_old',
+    '''CREATE TABLE vote_rollup (
+        minute timestamp,
+        poll text not null default '',
+        key text,
+        count integer default 0,
+        primary key (minute, poll, key)
+    )''',
+    '''INSERT INTO vote_rollup (minute, poll, key, count)
+        SELECT minute, '', key, count FROM vote_rollup_old''',
+    'DROP TABLE vote_rollup_old',
+]
+
+
+# Patch sets by dialect name.
+dialect_patches = {
+    'postgresql': patches,
+    'sqlite': sqlite_patches,
+}
+
+
+
+class SQLiteEngine(TwistedEngine):
+    """
+    I am an alchimia engine which runs every query on one dedicated thread,
+    over one connection, because SQLite serializes writers anyway.
+    """
+
+
+    def __init__(self, *args, **kwargs):
+        TwistedEngine.__init__(self, *args, **kwargs)
+        self._threadpool = ThreadPool(1, 1, 'sqlite')
+        self._threadpool.start()
+        self._shutdown = self._reactor.addSystemEventTrigger('during',
+            'shutdown', self._threadpool.stop)
+
+
+    def _defer_to_thread(self, f, *args, **kwargs):
+        return deferToThreadPool(self._reactor, self._threadpool, f,
+            *args, **kwargs)
+
+
+    def close(self):
+        """
+        Stop my thread.
+        """
+        self._reactor.removeSystemEventTrigger(self._shutdown)
+        self._threadpool.stop()
+
+
+
+class SQLiteEngineStrategy(TwistedEngineStrategy):
+
+    name = '_twisted_sqlite'
+    engine_cls = SQLiteEngine
+
+SQLiteEngineStrategy()
+
+
+def _sqliteConnector(path, synchronous):
+    def connect():
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=%s' % (synchronous,))
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+    return connect
+
+
+def createEngine(url, reactor=reactor, pool_size=5, max_overflow=10,
+        pool_timeout=30, sqlite_synchronous='NORMAL'):
+    """
+    Create an alchimia engine whose connection pool and the reactor's thread
+    pool (which alchimia runs every query in) are the same size, so that
+    every thread can get a connection and every connection can get a thread.
+
+    SQLite URLs get an L{SQLiteEngine} instead, with the database in WAL
+    mode.
+
+    @param pool_size: Number of connections kept open.
+    @param max_overflow: Number of connections that may be opened beyond
+        C{pool_size} when they're all busy.
+    @param pool_timeout: Seconds to wait for a connection before failing.
+    @param sqlite_synchronous: SQLite's C{synchronous} setting.  C{NORMAL}
+        can lose the last transactions on power loss, but never corrupts
+        the database in WAL mode.
+    """
+    if url.startswith('sqlite'):
+        path = make_url(url).database or ':memory:'
+        return create_engine('sqlite://', reactor=reactor,
+            strategy=SQLiteEngineStrategy.name,
+            creator=_sqliteConnector(path, sqlite_synchronous),
+            poolclass=StaticPool)
+    reactor.suggestThreadPoolSize(pool_size + max_overflow)
+    kwargs = {}
+    if make_url(url).get_dialect().driver == 'psycopg2':
+        # Rows executed together go in multi-row INSERTs, not one by one.
+        kwargs['executemany_mode'] = 'values'
+    return create_engine(url, reactor=reactor, strategy=TWISTED_STRATEGY,
+        pool_size=pool_size, max_overflow=max_overflow,
+        pool_timeout=pool_timeout, **kwargs)
+
+
+
+def inTransaction(engine, fn, *args, **kwargs):
+    """
+    Call C{fn} in a thread with a synchronous connection and the rest of
+    the arguments, in a transaction that's committed if it returns and
+    rolled back if it raises.
+
+    Unlike a transaction made of several alchimia calls, nothing else can
+    run on the connection in between, which matters for L{SQLiteEngine}'s
+    single shared connection.
+
+    @return: A Deferred firing with C{fn}'s result.
+    """
+    return engine._defer_to_thread(engine._engine.transaction, fn,
+        *args, **kwargs)
+
+
+def fetchmany(result, size):
+    """
+    Fetch up to C{size} rows from an alchimia result, which has no
+    C{fetchmany} of its own.
+    """
+    return result._engine._defer_to_thread(result._result_proxy.fetchmany,
+        size)
+
+
 
 class SQLVoteStore(object):
 
 
-    def __init__(self, engine, options):
+    def __init__(self, engine, options, flush_size=None, flush_interval=1,
+            max_buffered=10000, clock=reactor):
         """
-        @param options: List of allowed voting options.
+        @param options: List of allowed voting options in the default poll,
+            L{DEFAULT_POLL}.  Other polls are read from the database by
+            L{loadPolls}.
+        @param flush_size: If given, votes are buffered in memory and written
+            together, in one transaction, once this many are waiting.  If
+            C{None} (the default) each vote is written as soon as it's cast.
+        @param flush_interval: Seconds a buffered vote may wait before it is
+            written even though the batch isn't full.
+        @param max_buffered: Maximum number of buffered votes (including
+            those currently being written).  Votes beyond this are refused
+            with L{BufferFull}.
         """
         self.engine = engine
         self.options = options
+        # poll: frozenset of options
+        self.polls = {DEFAULT_POLL: frozenset(options)}
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.clock = clock
+
+        # (rows, Deferred) for each buffered vote or ballot
+        self._pending = []
+        self._pending_rows = 0
+        self._buffered = 0
+        self._writing = []
+        self._flush_call = None
+
+        # Statements are compiled once and executed with bound parameters.
+        # Batches are written by executing it with a list of rows.
+        self._insert_vote = self._compile(Vote.insert(),
+            column_keys=['poll', 'key', 'ip'])
+        self._select_totals = self._compile(select([TotalShard.c.key,
+            func.sum(TotalShard.c.count)])
+            .where(TotalShard.c.poll == bindparam('poll'))
+            .group_by(TotalShard.c.key))
+        self._select_rollup = self._compile(select([VoteRollup.c.minute,
+            VoteRollup.c.key, VoteRollup.c.count]).where(
+            (VoteRollup.c.minute >= bindparam('start')) &
+            (VoteRollup.c.poll == bindparam('poll'))))
+        self._select_poll_options = self._compile(select([PollOption.c.poll,
+            PollOption.c.key]))
+
+
+    def _compile(self, statement, **kwargs):
+        return statement.compile(dialect=self.engine.dialect, **kwargs)
 
 
     @defer.inlineCallbacks
@@ -88,7 +621,7 @@ class SQLVoteStore(object):
             applied = [x[0] for x in rows]
         except Exception as e:
             log.msg('Error fetching patches: %r' % (e,))
-        for name, sqls in patches.items():
+        for name, sqls in dialect_patches[self.engine.dialect.name].items():
             if name in applied:
                 continue
             conn = yield self.engine.connect()
@@ -105,21 +638,213 @@ class SQLVoteStore(object):
                 raise e
 
 
-    def vote(self, option, ip):
-        if option not in self.options:
-            return defer.fail(NotAnOption('%r is not an option' % (option,)))
-        return self.engine.execute(Vote.insert().values(key=option, ip=ip))
+    @defer.inlineCallbacks
+    def loadPolls(self):
+        """
+        Read every poll and its options from the database, replacing the
+        polls read before.
+        """
+        result = yield self.engine.execute(self._select_poll_options)
+        rows = yield result.fetchall()
+        options = {}
+        for poll, option in rows:
+            options.setdefault(poll, []).append(option)
+        polls = {DEFAULT_POLL: frozenset(self.options)}
+        for poll, keys in options.items():
+            polls[poll] = frozenset(keys)
+        self.polls = polls
+
+
+    def createPoll(self, poll, options):
+        """
+        Store a new poll with the given options.
+        """
+        def create(conn):
+            conn.execute(Poll.insert().values(id=poll))
+            conn.execute(PollOption.insert(), [
+                {'poll': poll, 'key': option} for option in options])
+        d = inTransaction(self.engine, create)
+        def created(_):
+            self.polls[poll] = frozenset(options)
+        return d.addCallback(created)
+
+
+    def checkVotes(self, options, poll=DEFAULT_POLL):
+        """
+        Raise L{NoSuchPoll} or L{NotAnOption} unless votes for every one of
+        C{options} in C{poll} would be accepted, without touching the
+        database.
+        """
+        known = self.polls.get(poll)
+        if known is None:
+            raise NoSuchPoll('%r is not a poll' % (poll,))
+        if not options:
+            raise NotAnOption('No options given')
+        for option in options:
+            if option not in known:
+                raise NotAnOption('%r is not an option' % (option,))
+
+
+    def vote(self, option, ip, poll=DEFAULT_POLL):
+        """
+        Record a vote.
+
+        @return: A Deferred which fires once the vote is durable.  In buffered
+            mode that is once the batch holding the vote has been written.
+        """
+        try:
+            self.checkVotes([option], poll)
+        except (NoSuchPoll, NotAnOption):
+            return defer.fail()
+        if self.flush_size is None:
+            return self._timed('vote', self.engine.execute,
+                self._insert_vote, poll=poll, key=option, ip=ip)
+        return self._buffer([{'poll': poll, 'key': option, 'ip': ip}])
+
+
+    def voteMany(self, options, ip, poll=DEFAULT_POLL):
+        """
+        Record several votes at once, in one transaction: either they're
+        all recorded or none are.
+
+        @param options: The options voted for, which may repeat.
+
+        @return: A Deferred which fires once the votes are durable.
+        """
+        try:
+            self.checkVotes(options, poll)
+        except (NoSuchPoll, NotAnOption):
+            return defer.fail()
+        rows = [{'poll': poll, 'key': option, 'ip': ip} for option in options]
+        if self.flush_size is None:
+            return self._timed('vote_batch', self.engine.execute,
+                self._insert_vote, rows)
+        return self._buffer(rows)
+
+
+    def _buffer(self, rows):
+        if self._buffered + len(rows) > self.max_buffered:
+            return defer.fail(BufferFull('Too many votes waiting to be written'))
+        d = defer.Deferred()
+        self._pending.append((rows, d))
+        self._pending_rows += len(rows)
+        self._buffered += len(rows)
+        if self._pending_rows >= self.flush_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.flush_interval,
+                self.flush)
+        return d
+
+
+    def flush(self):
+        """
+        Write all buffered votes now.
+
+        @return: A Deferred which fires once every vote buffered before this
+            call has been written (successfully or not).
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        batch, self._pending = self._pending, []
+        self._pending_rows = 0
+        if batch:
+            self._writeBatch(batch)
+        return defer.DeferredList(list(self._writing))
+
+
+    def _writeBatch(self, batch):
+        rows = [row for ballot, _ in batch for row in ballot]
+        d = self._timed('vote_batch', self.engine.execute,
+            self._insert_vote, rows)
+        self._writing.append(d)
+        def written(result):
+            for _, waiter in batch:
+                waiter.callback(None)
+        def failed(err):
+            log.msg('Error writing %d votes: %s' % (len(rows), err.value),
+                system='db')
+            for _, waiter in batch:
+                waiter.errback(err)
+        def finished(result):
+            self._writing.remove(d)
+            self._buffered -= len(rows)
+            return result
+        d.addBoth(finished)
+        d.addCallbacks(written, failed)
+        return d
+
+
+    def _timed(self, query, fn, *args, **kwargs):
+        """
+        Call C{fn}, counting it as an in-flight query and recording how
+        long it takes under C{query}.
+        """
+        start = timer()
+        DB_INFLIGHT.inc()
+        d = defer.maybeDeferred(fn, *args, **kwargs)
+        def done(result):
+            DB_INFLIGHT.dec()
+            return result
+        d.addBoth(done)
+        return DB_SECONDS.labels(query).observeDeferred(d, start)
+
+
+    def getResults(self, poll=DEFAULT_POLL):
+        if poll not in self.polls:
+            return defer.fail(NoSuchPoll('%r is not a poll' % (poll,)))
+        return self._timed('results', self._getResults, poll)
 
 
     @defer.inlineCallbacks
-    def getResults(self):
-        result = yield self.engine.execute(select([Total.c.key, Total.c.count]))
+    def _getResults(self, poll):
+        result = yield self.engine.execute(self._select_totals, poll=poll)
         rows = yield result.fetchall()
         ret = {}
-        for option in self.options:
+        for option in self.polls[poll]:
             ret[option] = 0
         for option, total in rows:
-            ret[option] = total
+            ret[option] = int(total)
         defer.returnValue(ret)
 
 
+    def getTimeseries(self, minutes=60, poll=DEFAULT_POLL):
+        """
+        Get a poll's votes per option per minute for the last C{minutes}
+        minutes, from the rollup kept by L{vc.rollup.RollupAggregator}.
+
+        @return: A Deferred firing with a dict holding C{start}, the first
+            minute in database time as an ISO 8601 string; C{step}, the
+            seconds in a bucket; and C{series}, mapping each option to a
+            list of C{minutes} counts.
+        """
+        if poll not in self.polls:
+            return defer.fail(NoSuchPoll('%r is not a poll' % (poll,)))
+        return self._timed('timeseries', self._getTimeseries, minutes, poll)
+
+
+    @defer.inlineCallbacks
+    def _getTimeseries(self, minutes, poll):
+        result = yield self.engine.execute(select([func.current_timestamp()]))
+        now = yield result.scalar()
+        # Postgres says what time it is in the session's time zone, which is
+        # the zone votes are timestamped in.
+        now = now.replace(tzinfo=None, second=0, microsecond=0)
+        start = now - datetime.timedelta(minutes=minutes - 1)
+        result = yield self.engine.execute(self._select_rollup, start=start,
+            poll=poll)
+        rows = yield result.fetchall()
+        series = {}
+        for option in self.polls[poll]:
+            series[option] = [0] * minutes
+        for minute, option, count in rows:
+            i = int((minute - start).total_seconds()) // 60
+            if option in series and 0 <= i < minutes:
+                series[option][i] = count
+        defer.returnValue({
+            'start': start.isoformat(),
+            'step': 60,
+            'series': series,
+        })
@@ -0,0 +1,166 @@
+"""
+Live results pushed to clients as Server-Sent Events.
+"""
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+import json
+
+from vc.sql import DEFAULT_POLL
+
+
+
+def _bytes(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+
+def event(name, data):
+    """
+    Encode a Server-Sent Event.
+    """
+    return _bytes('event: %s\ndata: %s\n\n' % (name, data))
+
+
+
+@implementer(IPushProducer)
+class Subscriber(object):
+    """
+    I am one client's event stream.  I'm registered as the producer for the
+    client's request, so the transport pauses me when it can't keep up.
+    """
+
+
+    def __init__(self, request):
+        self.request = request
+        self.paused = False
+        self.new = True
+        self.done = None
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+    def stopProducing(self):
+        pass
+
+
+
+class ResultsBroadcaster(object):
+    """
+    I watch a poll's results and send every subscriber the changes
+    once per tick.  Each tick's message is encoded once and written to every
+    subscriber.  A subscriber whose connection is still backed up when the
+    next message is due is disconnected rather than buffered for.
+
+    New subscribers are first sent all the results as a C{results} event;
+    after that they're sent C{delta} events holding only the options whose
+    totals changed.
+    """
+
+
+    def __init__(self, vote_store, interval=1, heartbeat=15, clock=reactor,
+            poll=DEFAULT_POLL):
+        """
+        @param interval: Seconds between ticks.
+        @param poll: The poll whose results are sent.
+        @param heartbeat: Number of ticks without changes after which a
+            comment is sent to keep idle connections open.
+        """
+        self.vote_store = vote_store
+        self.poll = poll
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.subscribers = []
+        self.results = None
+        self._snapshot = None
+        self._idle = 0
+        self._loop = None
+
+
+    def subscribe(self, request):
+        """
+        Start streaming results to C{request}.
+
+        @return: A Deferred which fires with C{None} when the stream ends.
+        """
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.setHeader('X-Accel-Buffering', 'no')
+        # Pages on other sites use this like they use the JSONP endpoints.
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        sub = Subscriber(request)
+        sub.done = defer.Deferred(lambda d: self._remove(sub))
+        request.registerProducer(sub, True)
+        request.notifyFinish().addBoth(lambda _: self._remove(sub))
+        self.subscribers.append(sub)
+        if self._loop is None:
+            self._loop = task.LoopingCall(self._tick)
+            self._loop.clock = self.clock
+            self._loop.start(self.interval)
+        return sub.done
+
+
+    def _remove(self, sub):
+        if sub not in self.subscribers:
+            return
+        self.subscribers.remove(sub)
+        sub.request.unregisterProducer()
+        if not self.subscribers and self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+        if not sub.done.called:
+            sub.done.callback(None)
+
+
+    def _tick(self):
+        d = self.vote_store.getResults(self.poll)
+        d.addCallback(self._broadcast)
+        d.addErrback(log.err, 'Error getting results to broadcast')
+        return d
+
+
+    def _broadcast(self, results):
+        delta = None
+        if self.results is None:
+            self._snapshot = None
+        else:
+            delta = dict((option, count)
+                for option, count in results.items()
+                if self.results.get(option) != count)
+            if delta:
+                self._snapshot = None
+        self.results = dict(results)
+
+        message = None
+        if delta:
+            message = event('delta', json.dumps(delta, sort_keys=True))
+            self._idle = 0
+        else:
+            self._idle += 1
+            if self._idle >= self.heartbeat:
+                message = b': keepalive\n\n'
+                self._idle = 0
+
+        for sub in list(self.subscribers):
+            if sub.paused:
+                log.msg('Dropping slow results subscriber', system='stream')
+                self._remove(sub)
+                continue
+            if sub.new:
+                if self._snapshot is None:
+                    self._snapshot = event('results',
+                        json.dumps(self.results, sort_keys=True))
+                sub.request.write(self._snapshot)
+                sub.new = False
+            elif message is not None:
+                sub.request.write(message)
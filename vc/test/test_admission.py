@@ -0,0 +1,217 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+import json
+
+from vc.admission import AdmissionController
+from vc.error import Overloaded
+from vc.web import jsonHandler, admitted
+
+
+
+class AdmissionControllerTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+
+    def controller(self, **kwargs):
+        kwargs.setdefault('clock', self.clock)
+        return AdmissionController('test', **kwargs)
+
+
+    def test_limit(self):
+        """
+        Requests over the limit wait until others are released.
+        """
+        c = self.controller(limit=2)
+        self.successResultOf(c.acquire())
+        self.successResultOf(c.acquire())
+        d = c.acquire()
+        self.assertNoResult(d)
+        c.release()
+        self.successResultOf(d)
+        self.assertEqual(c.active, 2)
+
+
+    def test_queueFull(self):
+        """
+        Requests are turned away right away once the queue is full.
+        """
+        c = self.controller(limit=1, queue_size=1)
+        c.acquire()
+        c.acquire()
+        self.failureResultOf(c.acquire(), Overloaded)
+
+
+    def test_queueTimeout(self):
+        """
+        Requests which wait too long are turned away.
+        """
+        c = self.controller(limit=1, queue_timeout=2)
+        c.acquire()
+        d = c.acquire()
+        self.clock.advance(2)
+        f = self.failureResultOf(d, Overloaded)
+        self.assertEqual(f.value.retry_after, 2)
+        c.release()
+        self.assertEqual(c.active, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_cancel(self):
+        """
+        Cancelling a waiting request gives up its place in the queue.
+        """
+        c = self.controller(limit=1, queue_size=1)
+        c.acquire()
+        d = c.acquire()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertNoResult(c.acquire())
+
+
+    def test_backoff(self):
+        """
+        The limit shrinks when requests are slow, once per slow spell.
+        """
+        c = self.controller(limit=10, target_latency=1, backoff=0.5)
+        c.acquire()
+        c.acquire()
+        c.release(2)
+        self.assertEqual(c.limit, 5)
+        c.release(2)
+        self.assertEqual(c.limit, 5)
+        self.clock.advance(1)
+        c.acquire()
+        c.release(2)
+        self.assertEqual(c.limit, 2.5)
+
+
+    def test_minLimit(self):
+        """
+        The limit doesn't go below C{min_limit}.
+        """
+        c = self.controller(limit=2, min_limit=2, target_latency=1)
+        c.acquire()
+        c.release(2)
+        self.assertEqual(c.limit, 2)
+
+
+    def test_grow(self):
+        """
+        The limit grows by about one for every C{limit} quick requests, but
+        only while requests are being held back by it.
+        """
+        c = self.controller(limit=2, target_latency=1)
+        c.acquire()
+        c.release(0.1)
+        self.assertEqual(c.limit, 2)
+        for _ in range(4):
+            c.acquire()
+            c.acquire()
+            c.release(0.1)
+            c.release(0.1)
+        self.assertTrue(3 <= c.limit < 4, c.limit)
+
+
+    def test_growAdmits(self):
+        """
+        Waiting requests are let in as the limit grows.
+        """
+        c = self.controller(limit=1, target_latency=1)
+        c.acquire()
+        waiting = [c.acquire(), c.acquire()]
+        c.release(0.1)
+        self.assertEqual(c.limit, 2)
+        self.successResultOf(waiting[0])
+        self.successResultOf(waiting[1])
+
+
+
+class FakeCounter(object):
+
+
+    def __init__(self, admission):
+        self.admission = admission
+        self.pending = []
+
+
+    @jsonHandler
+    @admitted
+    def vote(self, request):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+
+class AdmittedTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.controller = AdmissionController('vote', limit=1, queue_size=0,
+            clock=self.clock)
+        self.counter = FakeCounter({'vote': self.controller})
+
+
+    def test_admitted(self):
+        """
+        Requests with room are handled, and give it back when done.
+        """
+        d = self.counter.vote(DummyRequest([]))
+        self.assertEqual(self.controller.active, 1)
+        self.counter.pending[0].callback({})
+        self.assertEqual(json.loads(self.successResultOf(d)), {})
+        self.assertEqual(self.controller.active, 0)
+
+
+    def test_rejected(self):
+        """
+        Requests turned away get a 503 with a JSON body saying when to try
+        again.
+        """
+        self.counter.vote(DummyRequest([]))
+        request = DummyRequest([])
+        body = self.successResultOf(self.counter.vote(request))
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(request.responseHeaders.getRawHeaders('retry-after'),
+            ['2'])
+        self.assertEqual(json.loads(body), {
+            'error': 'Too busy, try again in a moment',
+            'retry_after': 2,
+        })
+        self.assertEqual(len(self.counter.pending), 1)
+
+
+    def test_rejectedJSONP(self):
+        """
+        JSONP requests turned away get the same body wrapped in their
+        callback, without an error code a script tag wouldn't run.
+        """
+        self.counter.vote(DummyRequest([]))
+        request = DummyRequest([])
+        request.args[b'callback'] = [b'cb']
+        body = self.successResultOf(self.counter.vote(request))
+        self.assertNotEqual(request.responseCode, 503)
+        self.assertEqual(request.responseHeaders.getRawHeaders('retry-after'),
+            ['2'])
+        self.assertTrue(body.startswith('cb(') and body.endswith(')'), body)
+        self.assertEqual(json.loads(body[3:-1]), {
+            'error': 'Too busy, try again in a moment',
+            'retry_after': 2,
+        })
+
+
+    def test_notLimited(self):
+        """
+        Routes without a controller aren't limited.
+        """
+        counter = FakeCounter({})
+        counter.vote(DummyRequest([]))
+        counter.vote(DummyRequest([]))
+        self.assertEqual(len(counter.pending), 2)
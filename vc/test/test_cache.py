@@ -0,0 +1,190 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
+
+
+from vc.cache import CachedVoteStore
+from vc.error import NotAnOption
+
+
+
+class FakeVoteStore(object):
+
+
+    def __init__(self, options):
+        self.options = options
+        self.totals = dict((x, 0) for x in options)
+        self.queries = []
+        self.polls = []
+
+
+    def checkVotes(self, options, poll=''):
+        if [x for x in options if x not in self.options]:
+            raise NotAnOption(options)
+
+
+    def vote(self, option, ip, poll=''):
+        if option not in self.options:
+            return defer.fail(NotAnOption(option))
+        self.totals[option] += 1
+        return defer.succeed(None)
+
+
+    def voteMany(self, options, ip, poll=''):
+        if [x for x in options if x not in self.options]:
+            return defer.fail(NotAnOption(options))
+        for option in options:
+            self.totals[option] += 1
+        return defer.succeed(None)
+
+
+    def getResults(self, poll=''):
+        d = defer.Deferred()
+        self.queries.append(d)
+        self.polls.append(poll)
+        return d
+
+
+    def answer(self):
+        queries, self.queries = self.queries, []
+        for d in queries:
+            d.callback(dict(self.totals))
+
+
+
+class CachedVoteStoreTest(TestCase):
+
+
+    def test_getResults_cached(self):
+        """
+        Results are served from memory until the ttl passes.
+        """
+        clock = task.Clock()
+        fake = FakeVoteStore(['foo'])
+        store = CachedVoteStore(fake, ttl=10, clock=clock)
+        d = store.getResults()
+        fake.answer()
+        self.assertEqual(self.successResultOf(d), {'foo': 0})
+
+        fake.totals['foo'] = 5
+        clock.advance(9)
+        self.assertEqual(self.successResultOf(store.getResults()), {'foo': 0})
+        self.assertEqual(fake.queries, [])
+
+        clock.advance(1)
+        d = store.getResults()
+        self.assertEqual(len(fake.queries), 1)
+        fake.answer()
+        self.assertEqual(self.successResultOf(d), {'foo': 5})
+
+
+    def test_getResults_collapse(self):
+        """
+        Concurrent misses share a single query.
+        """
+        fake = FakeVoteStore(['foo'])
+        store = CachedVoteStore(fake, clock=task.Clock())
+        d1 = store.getResults()
+        d2 = store.getResults()
+        self.assertEqual(len(fake.queries), 1)
+        fake.answer()
+        self.assertEqual(self.successResultOf(d1), {'foo': 0})
+        self.assertEqual(self.successResultOf(d2), {'foo': 0})
+
+
+    def test_getResults_error(self):
+        """
+        A failed query fails every waiting request and isn't cached.
+        """
+        fake = FakeVoteStore(['foo'])
+        store = CachedVoteStore(fake, clock=task.Clock())
+        d1 = store.getResults()
+        d2 = store.getResults()
+        fake.queries.pop().errback(Exception('db down'))
+        self.failureResultOf(d1, Exception)
+        self.failureResultOf(d2, Exception)
+
+        d = store.getResults()
+        fake.answer()
+        self.assertEqual(self.successResultOf(d), {'foo': 0})
+
+
+    def test_getResults_perPoll(self):
+        """
+        Each poll's results are cached separately.
+        """
+        fake = FakeVoteStore(['foo'])
+        store = CachedVoteStore(fake, ttl=10, clock=task.Clock())
+        store.getResults('a')
+        store.getResults('b')
+        self.assertEqual(fake.polls, ['a', 'b'])
+        fake.answer()
+
+        self.successResultOf(store.getResults('a'))
+        self.successResultOf(store.getResults('b'))
+        self.assertEqual(fake.queries, [])
+        store.getResults()
+        self.assertEqual(fake.polls, ['a', 'b', ''])
+
+
+    def test_vote_optimistic(self):
+        """
+        Votes are applied to the cached results right away and corrected on
+        the next refresh.
+        """
+        clock = task.Clock()
+        fake = FakeVoteStore(['foo', 'bar'])
+        store = CachedVoteStore(fake, ttl=10, clock=clock)
+        store.getResults()
+        fake.answer()
+
+        self.successResultOf(store.vote('foo', '1.2.3.4'))
+        fake.totals['bar'] = 3
+        self.assertEqual(self.successResultOf(store.getResults()),
+            {'foo': 1, 'bar': 0})
+
+        clock.advance(10)
+        d = store.getResults()
+        fake.answer()
+        self.assertEqual(self.successResultOf(d), {'foo': 1, 'bar': 3})
+
+
+    def test_vote_failed(self):
+        """
+        Votes which fail don't change the cached results.
+        """
+        fake = FakeVoteStore(['foo'])
+        store = CachedVoteStore(fake, clock=task.Clock())
+        store.getResults()
+        fake.answer()
+        self.failureResultOf(store.vote('bar', '1.2.3.4'), NotAnOption)
+
+        fake.vote = lambda option, ip, poll: defer.fail(Exception('db down'))
+        self.failureResultOf(store.vote('foo', '1.2.3.4'), Exception)
+        self.assertEqual(self.successResultOf(store.getResults()), {'foo': 0})
+
+
+    def test_voteMany(self):
+        """
+        Every vote cast at once is applied to the cached results, or none
+        are if they fail.
+        """
+        fake = FakeVoteStore(['foo', 'bar'])
+        store = CachedVoteStore(fake, ttl=10, clock=task.Clock())
+        store.getResults()
+        fake.answer()
+        self.successResultOf(store.voteMany(['foo', 'bar', 'foo'], '1.2.3.4'))
+        self.assertEqual(self.successResultOf(store.getResults()),
+            {'foo': 2, 'bar': 1})
+        self.failureResultOf(store.voteMany(['foo', 'baz'], '1.2.3.4'),
+            NotAnOption)
+        self.assertEqual(self.successResultOf(store.getResults()),
+            {'foo': 2, 'bar': 1})
+
+
+    def test_checkVotes(self):
+        """
+        Votes are checked by the wrapped store.
+        """
+        store = CachedVoteStore(FakeVoteStore(['foo']), clock=task.Clock())
+        store.checkVotes(['foo'])
+        self.assertRaises(NotAnOption, store.checkVotes, ['bar'])
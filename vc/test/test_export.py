@@ -0,0 +1,151 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+import json
+
+
+from vc.export import VoteExporter
+from vc.test.test_sql import makeEngine
+from vc.sql import SQLVoteStore
+
+
+
+class StreamingRequest(DummyRequest):
+    """
+    I am a request whose producer is a push producer, and which can be made
+    to pause it whenever something is written.
+    """
+
+
+    def __init__(self):
+        DummyRequest.__init__(self, [])
+        self.producer = None
+        self.pause_on_write = False
+        self.lost = False
+        self._wrote = []
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+    def loseConnection(self):
+        self.lost = True
+
+
+    def write(self, data):
+        DummyRequest.write(self, data)
+        if self.pause_on_write and self.producer is not None:
+            self.producer.pauseProducing()
+        waiting, self._wrote = self._wrote, []
+        for d in waiting:
+            d.callback(None)
+
+
+    def nextWrite(self):
+        d = defer.Deferred()
+        self._wrote.append(d)
+        return d
+
+
+    def body(self):
+        return b''.join(self.written)
+
+
+
+class VoteExporterTest(TestCase):
+
+
+    timeout = 10
+
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.engine = makeEngine(self)
+        store = SQLVoteStore(self.engine, ['foo', 'bar'])
+        yield store.upgradeSchema()
+        for i in range(5):
+            yield store.vote('foo' if i % 2 else 'bar', '1.2.3.%d' % (i,))
+
+
+    @defer.inlineCallbacks
+    def test_csv(self):
+        """
+        The whole vote log is written as CSV, oldest first.
+        """
+        request = StreamingRequest()
+        result = yield VoteExporter(self.engine, batch_size=2).export(request)
+        self.assertEqual(result, b'')
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            'content-type'), ['text/csv; charset=utf-8'])
+        lines = request.body().split(b'\r\n')
+        self.assertEqual(lines[0], b'poll,option,ip,created')
+        self.assertEqual([x.split(b',')[:3] for x in lines[1:-1]], [
+            [b'', b'bar', b'1.2.3.0'],
+            [b'', b'foo', b'1.2.3.1'],
+            [b'', b'bar', b'1.2.3.2'],
+            [b'', b'foo', b'1.2.3.3'],
+            [b'', b'bar', b'1.2.3.4'],
+        ])
+        self.assertEqual(lines[-1], b'')
+        self.assertEqual(request.producer, None)
+
+
+    @defer.inlineCallbacks
+    def test_ndjson(self):
+        request = StreamingRequest()
+        yield VoteExporter(self.engine).export(request, 'ndjson')
+        rows = [json.loads(x.decode('utf-8'))
+            for x in request.body().splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['poll'], '')
+        self.assertEqual(rows[0]['option'], 'bar')
+        self.assertEqual(rows[0]['ip'], '1.2.3.0')
+        self.assertIn('created', rows[0])
+
+
+    def test_unknownFormat(self):
+        self.assertRaises(ValueError, VoteExporter(self.engine).export,
+            StreamingRequest(), 'xml')
+
+
+    @defer.inlineCallbacks
+    def test_paused(self):
+        """
+        No more rows are read while the request's transport is backed up.
+        """
+        request = StreamingRequest()
+        request.pause_on_write = True
+        d = VoteExporter(self.engine, batch_size=2).export(request)
+        yield request.nextWrite()
+        self.assertEqual(len(request.written), 2)
+        # Give a read that shouldn't happen a chance to.
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(len(request.written), 2)
+        self.assertFalse(d.called)
+
+        request.pause_on_write = False
+        request.producer.resumeProducing()
+        yield d
+        self.assertEqual(len(request.written), 4)
+
+
+    @defer.inlineCallbacks
+    def test_stopped(self):
+        """
+        The export stops when the request goes away.
+        """
+        request = StreamingRequest()
+        request.pause_on_write = True
+        d = VoteExporter(self.engine, batch_size=2).export(request)
+        yield request.nextWrite()
+        request.processingFailed(Exception('Connection lost'))
+        yield d
+        self.assertEqual(len(request.written), 2)
+        self.assertEqual(request.producer, None)
+
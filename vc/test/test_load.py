@@ -0,0 +1,29 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, reactor, task
+
+
+from vc.bench.load import LoadClient, MemoryVoteStore, serve
+
+
+
+class LoadClientTest(TestCase):
+
+
+    @defer.inlineCallbacks
+    def test_vote(self):
+        """
+        Simulated voters get tokens and vote with them.
+        """
+        options = ['a', 'b']
+        store = MemoryVoteStore(options)
+        port = serve(reactor, store, clock=task.Clock())
+        self.addCleanup(port.stopListening)
+        client = LoadClient(reactor,
+            'http://127.0.0.1:%d' % (port.getHost().port,), options,
+            ['10.0.0.%d' % (i,) for i in range(100)], 2)
+        self.addCleanup(client.close)
+        yield client.run('vote', 2, 0.2)
+        votes = client.histograms['/vote']
+        self.assertTrue(votes.count > 0)
+        self.assertEqual(votes.errors, 0, votes.error_messages)
+        self.assertEqual(sum(store.totals.values()), votes.count)
@@ -0,0 +1,123 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
+
+
+from vc.metrics import Registry, ReactorLagMonitor
+
+
+
+class RegistryTest(TestCase):
+
+
+    def test_counter(self):
+        registry = Registry()
+        counter = registry.counter('requests_total', 'Requests',
+            ['route', 'outcome'])
+        counter.labels('vote', 'ok').inc()
+        counter.labels('vote', 'ok').inc(2)
+        counter.labels('token', 'error').inc()
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{route="token",outcome="error"} 1',
+            'requests_total{route="vote",outcome="ok"} 3',
+        ]) + '\n')
+
+
+    def test_labels(self):
+        """
+        You must give every label, and their values are escaped.
+        """
+        registry = Registry()
+        counter = registry.counter('c', 'C', ['a'])
+        self.assertRaises(ValueError, counter.labels, 'x', 'y')
+        counter.labels('say "hi"\n').inc()
+        self.assertIn('c{a="say \\"hi\\"\\n"} 1', registry.render())
+
+
+    def test_gauge(self):
+        registry = Registry()
+        gauge = registry.gauge('inflight', 'In flight')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertIn('inflight 1\n', registry.render())
+        gauge.setFunction(lambda: 42)
+        self.assertIn('inflight 42\n', registry.render())
+
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('latency', 'Latency',
+            buckets=[0.1, 1])
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'latency_bucket{le="0.1"} 2',
+            'latency_bucket{le="1"} 3',
+            'latency_bucket{le="+Inf"} 4',
+            'latency_sum 5.65',
+            'latency_count 4',
+        ])
+
+
+    def test_observeDeferred(self):
+        """
+        A histogram can record how long a Deferred takes to fire, whether it
+        succeeds or fails.
+        """
+        registry = Registry()
+        histogram = registry.histogram('latency', 'Latency')
+        d = defer.Deferred()
+        result = histogram.observeDeferred(d)
+        self.assertIs(result, d)
+        d.errback(Exception('boom'))
+        self.failureResultOf(d, Exception)
+        self.assertEqual(histogram.labels().count, 1)
+
+
+    def test_sameName(self):
+        """
+        Asking for a metric again returns the existing one, unless it's of a
+        different type.
+        """
+        registry = Registry()
+        counter = registry.counter('c', 'C')
+        self.assertIs(registry.counter('c', 'C'), counter)
+        self.assertRaises(ValueError, registry.gauge, 'c', 'C')
+
+
+
+class ReactorLagMonitorTest(TestCase):
+
+
+    def test_lag(self):
+        """
+        The lag is how late the periodic timer ran.
+        """
+        clock = task.Clock()
+        registry = Registry()
+        monitor = ReactorLagMonitor(registry, interval=1, clock=clock)
+        monitor.start()
+        self.assertEqual(monitor.gauge.labels().get(), 0)
+        clock.advance(1.25)
+        self.assertEqual(monitor.gauge.labels().get(), 0.25)
+        monitor.stop()
+
+
+    def test_lateTicks(self):
+        """
+        A late run doesn't move when the next one is expected.
+        """
+        clock = task.Clock()
+        registry = Registry()
+        monitor = ReactorLagMonitor(registry, interval=1, clock=clock)
+        monitor.start()
+        clock.advance(1.25)
+        clock.advance(1.25)
+        self.assertEqual(monitor.gauge.labels().get(), 0.5)
+        clock.advance(0.5)
+        self.assertEqual(monitor.gauge.labels().get(), 0)
+        monitor.stop()
@@ -0,0 +1,106 @@
+from twisted.trial.unittest import TestCase, SkipTest
+from twisted.internet import reactor, defer
+
+import datetime
+import os
+
+
+from vc.partition import upperBound, encodeRows, VotePartitioner
+from vc.sql import SQLVoteStore, createEngine
+
+
+
+class UpperBoundTest(TestCase):
+
+
+    def test_range(self):
+        self.assertEqual(upperBound("FOR VALUES FROM ('2014-03-01 00:00:00') "
+            "TO ('2014-03-02 00:00:00')"), datetime.date(2014, 3, 2))
+
+
+    def test_minvalue(self):
+        self.assertEqual(upperBound("FOR VALUES FROM (MINVALUE) "
+            "TO ('2014-03-02 00:00:00')"), datetime.date(2014, 3, 2))
+
+
+    def test_unbounded(self):
+        self.assertEqual(upperBound('DEFAULT'), None)
+        self.assertEqual(upperBound("FOR VALUES FROM ('2014-03-01 00:00:00') "
+            "TO (MAXVALUE)"), None)
+
+
+
+class EncodeRowsTest(TestCase):
+
+
+    def test_csv(self):
+        rows = [
+            (1, datetime.datetime(2014, 3, 1, 12, 30), '', 'foo', '1.2.3.4'),
+            (2, datetime.datetime(2014, 3, 1, 12, 31), 'p', 'a,b', '1.2.3.5'),
+        ]
+        self.assertEqual(encodeRows(rows),
+            b'1,2014-03-01T12:30:00,,foo,1.2.3.4\r\n'
+            b'2,2014-03-01T12:31:00,p,"a,b",1.2.3.5\r\n')
+
+
+
+class VotePartitionerTest(TestCase):
+
+
+    timeout = 10
+
+
+    def test_retainNeedsArchive(self):
+        self.assertRaises(ValueError, VotePartitioner, None, retain=30)
+
+
+    @defer.inlineCallbacks
+    def getStore(self):
+        url = os.environ.get('DATABASE_URL', '')
+        if not url.startswith('postgres'):
+            raise SkipTest('You must set DATABASE_URL to a Postgres database')
+        store = SQLVoteStore(createEngine(url, reactor), ['foo'])
+        yield store.upgradeSchema()
+        defer.returnValue(store)
+
+
+    @defer.inlineCallbacks
+    def test_createPartitions(self):
+        """
+        There are partitions for today and the next C{ahead} days.
+        """
+        engine = (yield self.getStore()).engine
+        partitioner = VotePartitioner(engine, ahead=3)
+        yield partitioner.createPartitions()
+        partitions = yield partitioner.partitions()
+        result = yield engine.execute('SELECT current_date')
+        today = (yield result.fetchall())[0][0]
+        uppers = [upper for _, upper in partitions]
+        for i in range(1, 5):
+            self.assertIn(today + datetime.timedelta(days=i), uppers)
+
+
+    @defer.inlineCallbacks
+    def test_createPartitions_defaultRows(self):
+        """
+        Votes already in the default partition for a new partition's day
+        are moved into it, without being counted again.
+        """
+        store = yield self.getStore()
+        engine = store.engine
+        result = yield engine.execute('SELECT max(id) FROM vote')
+        last = (yield result.fetchall())[0][0] or 0
+        before = yield store.getResults()
+        yield engine.execute("INSERT INTO vote (created, poll, key, ip) "
+            "VALUES (current_date + 40, '', 'foo', '1.2.3.4')")
+        partitioner = VotePartitioner(engine, ahead=40)
+        yield partitioner.createPartitions()
+        result = yield engine.execute('SELECT tableoid::regclass::text '
+            'FROM vote WHERE id > %d' % (last,))
+        rows = yield result.fetchall()
+        result = yield engine.execute("SELECT to_char(current_date + 40, "
+            "'YYYYMMDD')")
+        day = (yield result.fetchall())[0][0]
+        self.assertEqual(rows, [('vote_p' + day,)])
+        after = yield store.getResults()
+        self.assertEqual(after['foo'], before.get('foo', 0) + 1)
@@ -0,0 +1,254 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task
+
+import glob
+import os
+
+from vc.persist import StoreJournal
+from vc.token import MemoryStore
+
+
+
+class StoreJournalTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.path = os.path.join(self.mktemp(), 'tokens')
+        os.makedirs(os.path.dirname(self.path))
+
+
+    def journal(self, **kwargs):
+        journal = StoreJournal(MemoryStore(self.clock), self.path,
+            clock=self.clock, **kwargs)
+        journal.load()
+        self.addCleanup(self.close, journal)
+        return journal
+
+
+    def close(self, journal):
+        journal.store.journal = None
+        if journal._flusher is not None and journal._flusher.active():
+            journal._flusher.cancel()
+        d = journal._lock.run(defer.succeed, None)
+        d.addCallback(lambda _: journal._log.close())
+        return d
+
+
+    def reload(self):
+        return self.journal().store.dump()
+
+
+    @defer.inlineCallbacks
+    def test_log(self):
+        """
+        Changes are written to the log and replayed when loading.
+        """
+        store = self.journal().store
+        yield store.setValue('a', 'value')
+        yield store.increment('b', 3, expire=60)
+        yield store.take('c', initial=2)
+        yield store.hit('d', 2, 10)
+        yield store.setValue('e', 1)
+        yield store.rmValue('e')
+        yield store.take('f', initial=1, remove_empty=True)
+        expected = store.dump()
+        yield store.journal.flush()
+        self.assertEqual(self.reload(), expected)
+
+
+    @defer.inlineCallbacks
+    def test_oddPath(self):
+        """
+        Paths with characters special to glob work.
+        """
+        self.path = os.path.join(os.path.dirname(self.path), 'tokens[1]*')
+        journal = self.journal()
+        yield journal.store.setValue('a', 1)
+        yield journal.snapshot()
+        yield journal.store.setValue('b', 2)
+        yield journal.flush()
+        self.assertEqual(journal._logGenerations(), [2])
+        self.assertEqual(self.reload()[0], {'a': 1, 'b': 2})
+
+
+    @defer.inlineCallbacks
+    def test_groupedSync(self):
+        """
+        Changes are written together every C{sync_interval} seconds.
+        """
+        journal = self.journal(sync_interval=2)
+        yield journal.store.increment('a', 1)
+        yield journal.store.increment('a', 1)
+        self.assertEqual(len(journal._pending), 2)
+        self.assertEqual(os.path.getsize(journal._logPath(1)), 0)
+        self.clock.advance(2)
+        self.assertEqual(journal._pending, [])
+        yield journal.flush()
+        self.assertEqual(self.reload()[0], {'a': 2})
+
+
+    @defer.inlineCallbacks
+    def test_expired(self):
+        """
+        Keys which have expired by the time the store is loaded are left out.
+        """
+        journal = self.journal()
+        yield journal.store.increment('a', 1, expire=10)
+        yield journal.store.increment('b', 1, expire=30)
+        yield journal.snapshot()
+        yield journal.store.increment('c', 1, expire=10)
+        yield journal.store.increment('d', 1, expire=30)
+        yield journal.flush()
+        self.clock.advance(20)
+        store = self.journal().store
+        for key, exists in [('a', False), ('b', True), ('c', False),
+                ('d', True)]:
+            result = yield store.exists(key)
+            self.assertEqual(result, exists, key)
+        self.assertEqual(sorted(store._deadlines), ['b', 'd'])
+
+
+    @defer.inlineCallbacks
+    def test_snapshot(self):
+        """
+        A snapshot replaces the logs before it, and changes after it are
+        written to a new log.
+        """
+        journal = self.journal()
+        yield journal.store.increment('a', 1)
+        yield journal.store.increment('b', 1, expire=60)
+        yield journal.snapshot()
+        self.assertEqual(glob.glob(self.path + '.log.*'),
+            [journal._logPath(2)])
+        yield journal.store.increment('a', 1)
+        yield journal.store.rmValue('b')
+        expected = journal.store.dump()
+        yield journal.flush()
+        self.assertEqual(self.reload(), expected)
+
+
+    @defer.inlineCallbacks
+    def test_unfinishedSnapshot(self):
+        """
+        If a snapshot isn't finished the older logs are still replayed.
+        """
+        journal = self.journal()
+        yield journal.store.increment('a', 1)
+        def fail(*args):
+            raise IOError('disk full')
+        journal._writeSnapshotFile = fail
+        yield self.assertFailure(journal.snapshot(), IOError)
+        yield journal.store.increment('b', 1)
+        expected = journal.store.dump()
+        yield journal.flush()
+        self.assertEqual(self.reload(), expected)
+
+
+    @defer.inlineCallbacks
+    def test_truncated(self):
+        """
+        A write cut short by a crash is ignored.
+        """
+        journal = self.journal()
+        yield journal.store.increment('a', 1)
+        yield journal.flush()
+        yield journal.store.increment('b', 1)
+        yield journal.flush()
+        with open(journal._logPath(1), 'r+b') as f:
+            f.truncate(os.path.getsize(journal._logPath(1)) - 1)
+        self.assertEqual(self.reload()[0], {'a': 1})
+
+
+    @defer.inlineCallbacks
+    def test_budget(self):
+        """
+        Logs are replayed for no longer than the time budget.
+        """
+        journal = self.journal()
+        yield journal.store.increment('a', 1)
+        yield journal.flush()
+        yield journal.store.increment('b', 1)
+        yield journal.flush()
+        store = MemoryStore(self.clock)
+        loader = StoreJournal(store, self.path, clock=self.clock)
+        loader.load(budget=-1)
+        self.addCleanup(self.close, loader)
+        self.assertEqual(store.dump()[0], {'a': 1})
+
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        """
+        Stopping writes a final snapshot and stops logging.
+        """
+        journal = StoreJournal(MemoryStore(self.clock), self.path,
+            clock=self.clock)
+        journal.start()
+        yield journal.store.increment('a', 1)
+        yield journal.stop()
+        self.assertEqual(journal.store.journal, None)
+        self.assertEqual(self.reload()[0], {'a': 1})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    @defer.inlineCallbacks
+    def backgroundLoad(self):
+        """
+        Write a snapshot of C{a}, C{b} and C{c} a key per chunk, remove C{c}
+        after it, and start loading it one chunk at a time.
+        """
+        journal = self.journal()
+        journal.snapshot_chunk = 1
+        yield journal.store.setValue('a', 1)
+        yield journal.store.increment('b', 1, expire=10)
+        yield journal.store.setValue('c', 1)
+        yield journal.snapshot()
+        yield journal.store.rmValue('c')
+        yield journal.flush()
+        store = MemoryStore(self.clock)
+        loader = StoreJournal(store, self.path, clock=self.clock)
+        loader.load_slice = -1
+        self.assertEqual(loader.load(budget=-1), 1)
+        self.addCleanup(self.close, loader)
+        defer.returnValue(loader)
+
+
+    @defer.inlineCallbacks
+    def test_background(self):
+        """
+        The snapshot is read a chunk at a time once over budget, without
+        overwriting keys changed since it was taken.
+        """
+        loader = yield self.backgroundLoad()
+        yield loader.store.setValue('b', 'new')
+        d = loader.whenLoaded()
+        self.assertNoResult(d)
+        self.clock.advance(0)
+        self.successResultOf(d)
+        self.assertEqual(loader.store.dump(), ({'a': 1, 'b': 'new'}, {}))
+
+
+    @defer.inlineCallbacks
+    def test_backgroundExpires(self):
+        """
+        Keys read in the background expire as usual.
+        """
+        loader = yield self.backgroundLoad()
+        self.clock.advance(0)
+        self.clock.advance(10)
+        self.assertEqual(loader.store.dump(), ({'a': 1}, {}))
+
+
+    @defer.inlineCallbacks
+    def test_snapshotWhileLoading(self):
+        """
+        A snapshot waits for the last one to be read.
+        """
+        loader = yield self.backgroundLoad()
+        d = loader.snapshot()
+        self.assertNoResult(d)
+        self.clock.advance(0)
+        yield d
+        self.assertEqual(self.reload()[0], {'a': 1, 'b': 1})
@@ -0,0 +1,144 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, error
+from twisted.python.failure import Failure
+
+import itertools
+
+
+from vc.prefork import WorkerPool
+
+
+
+class FakeProcess(object):
+
+
+    def __init__(self, proto, pid):
+        self.proto = proto
+        self.pid = pid
+        self.signals = []
+
+
+    def signalProcess(self, name):
+        if self.pid is None:
+            raise error.ProcessExitedAlready()
+        self.signals.append(name)
+
+
+    def exit(self):
+        self.pid = None
+        self.proto.processEnded(Failure(error.ProcessDone(0)))
+
+
+
+class FakeReactor(task.Clock):
+
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.processes = []
+        self.pids = itertools.count(100)
+
+
+    def spawnProcess(self, proto, executable, args, env, childFDs):
+        proto.transport = FakeProcess(proto, next(self.pids))
+        proto.env = env
+        proto.childFDs = childFDs
+        self.processes.append(proto.transport)
+        return proto.transport
+
+
+
+class WorkerPoolTest(TestCase):
+
+
+    def getPool(self, workers=2):
+        reactor = FakeReactor()
+        pool = WorkerPool(reactor, ['python', 'run.py'], workers, 7,
+            env={'FOO': 'bar'})
+        return reactor, pool
+
+
+    def test_start(self):
+        """
+        Starting the pool starts the workers and hands them the socket.
+        """
+        reactor, pool = self.getPool()
+        pool.start()
+        self.assertEqual(len(reactor.processes), 2)
+        proto = pool.protocols[0]
+        self.assertEqual(proto.env['VC_LISTEN_FD'], '7')
+        self.assertEqual(proto.env['FOO'], 'bar')
+        self.assertEqual(proto.childFDs[7], 7)
+
+
+    def test_respawn(self):
+        """
+        A worker which dies is replaced.
+        """
+        reactor, pool = self.getPool()
+        pool.start()
+        reactor.processes[0].exit()
+        self.assertEqual(len(pool.protocols), 1)
+        reactor.advance(pool.respawn_delay)
+        self.assertEqual(len(pool.protocols), 2)
+        self.assertEqual(len(reactor.processes), 3)
+
+
+    def test_restart(self):
+        """
+        Restarting replaces the workers one at a time, starting each new one
+        before stopping an old one.
+        """
+        reactor, pool = self.getPool()
+        pool.start()
+        old = list(reactor.processes)
+        d = pool.restart()
+        self.assertEqual(len(reactor.processes), 3)
+        self.assertEqual(old[0].signals, ['TERM'])
+        self.assertEqual(old[1].signals, [])
+        old[0].exit()
+        self.assertEqual(len(reactor.processes), 4)
+        self.assertEqual(old[1].signals, ['TERM'])
+        old[1].exit()
+        self.successResultOf(d)
+        reactor.advance(pool.respawn_delay)
+        self.assertEqual(len(reactor.processes), 4)
+        self.assertEqual([x.transport for x in pool.protocols],
+            reactor.processes[2:])
+
+
+    def test_restart_workerDied(self):
+        """
+        A worker which dies while another is being replaced is only
+        replaced once.
+        """
+        reactor, pool = self.getPool()
+        pool.start()
+        old = list(reactor.processes)
+        d = pool.restart()
+        old[1].exit()
+        old[0].exit()
+        self.successResultOf(d)
+        reactor.advance(pool.respawn_delay)
+        self.assertEqual(len(pool.protocols), 2)
+        self.assertEqual(old[1].signals, [])
+
+
+    def test_stop(self):
+        """
+        Stopping asks each worker to exit, kills those which don't, and
+        doesn't start new ones.
+        """
+        reactor, pool = self.getPool()
+        pool.start()
+        d = pool.stop()
+        p1, p2 = reactor.processes
+        self.assertEqual(p1.signals, ['TERM'])
+        self.assertEqual(p2.signals, ['TERM'])
+        p1.exit()
+        reactor.advance(pool.stop_timeout)
+        self.assertEqual(p2.signals, ['TERM', 'KILL'])
+        p2.exit()
+        self.successResultOf(d)
+        reactor.advance(pool.respawn_delay)
+        self.assertEqual(len(reactor.processes), 2)
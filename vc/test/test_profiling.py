@@ -0,0 +1,139 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+import signal
+import sys
+
+from vc.metrics import timer
+from vc.profiling import Profiler, collapse, formatSteps
+
+
+def busy(seconds):
+    end = timer() + seconds
+    while timer() < end:
+        pass
+
+
+def outer():
+    pass
+
+
+def inner():
+    pass
+
+
+
+class CollapseTest(TestCase):
+
+
+    def test_collapse(self):
+        """
+        Stacks are written outermost first, with their counts.
+        """
+        counts = {
+            (inner.__code__, outer.__code__): 3,
+            (outer.__code__,): 1,
+        }
+        self.assertEqual(collapse(counts),
+            'test/test_profiling.py:outer 1\n'
+            'test/test_profiling.py:outer;test/test_profiling.py:inner 3\n')
+
+
+    def test_formatSteps(self):
+        """
+        Steps are listed slowest in total first.
+        """
+        text = formatSteps({
+            (outer.__code__, 1, 2): [0.02],
+            (inner.__code__, 3, 4): [0.015, 0.015],
+        }, 0.01)
+        lines = text.splitlines()
+        self.assertEqual(lines[0], '# inlineCallbacks steps over 10.0ms')
+        self.assertIn('inner (lines 3-4)', lines[2])
+        self.assertIn('outer (lines 1-2)', lines[3])
+
+
+
+class ProfilerTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.profiler = Profiler(interval=0.001, clock=self.clock)
+
+
+    def test_sample(self):
+        """
+        Stacks are sampled until the time is up, and the signal handler is
+        put back.
+        """
+        handler = signal.getsignal(signal.SIGPROF)
+        d = self.profiler.sample(1)
+        self.assertTrue(self.profiler.busy)
+        busy(0.2)
+        self.clock.advance(1)
+        stacks = self.successResultOf(d)
+        self.assertIn('test/test_profiling.py:busy', stacks)
+        self.assertFalse(self.profiler.busy)
+        self.assertEqual(signal.getsignal(signal.SIGPROF), handler)
+        self.assertEqual(signal.getitimer(signal.ITIMER_PROF), (0.0, 0.0))
+
+
+    def test_busy(self):
+        """
+        Only one thing is profiled at a time.
+        """
+        self.profiler.sample(1)
+        self.assertRaises(ValueError, self.profiler.slowSteps, 1)
+        self.profiler.stop()
+        self.assertFalse(self.profiler.busy)
+
+
+    def test_slowSteps(self):
+        """
+        Only inlineCallbacks steps slower than the threshold are recorded,
+        and tracing stops when the time is up.
+        """
+        waiting = defer.Deferred()
+        @defer.inlineCallbacks
+        def work():
+            yield waiting
+            busy(0.03)
+            yield defer.succeed(None)
+        d = self.profiler.slowSteps(1, 0.02)
+        work()
+        waiting.callback(None)
+        self.clock.advance(1)
+        text = self.successResultOf(d)
+        self.assertIn('test/test_profiling.py:work', text)
+        self.assertEqual(len(text.splitlines()), 3)
+        self.assertEqual(sys.getprofile(), None)
+
+
+    def test_profileRequest(self):
+        """
+        Only a request with an X-Profile header is profiled.
+        """
+        request = DummyRequest([])
+        marked = DummyRequest([])
+        marked.requestHeaders.setRawHeaders('x-profile', ['1'])
+        self.assertFalse(self.profiler.wants(marked))
+        d = self.profiler.profileRequest(10)
+        self.assertFalse(self.profiler.wants(request))
+        self.assertTrue(self.profiler.wants(marked))
+        result = self.profiler.profile(lambda x: x + 1, 1)
+        self.assertEqual(self.successResultOf(result), 2)
+        self.assertFalse(self.profiler.busy)
+        self.assertIn('function calls', self.successResultOf(d))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_profileRequest_none(self):
+        """
+        If no request comes, that's reported.
+        """
+        d = self.profiler.profileRequest(10)
+        self.clock.advance(10)
+        self.assertEqual(self.successResultOf(d), 'No request was profiled\n')
+        self.assertFalse(self.profiler.wants(DummyRequest([])))
@@ -0,0 +1,101 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+
+from sqlalchemy.sql import select
+
+
+from vc.rollup import RollupAggregator
+from vc.sql import SQLVoteStore, VoteRollup, RollupWatermark
+from vc.test.test_sql import makeEngine
+
+
+
+class RollupAggregatorTest(TestCase):
+
+
+    timeout = 10
+
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.engine = makeEngine(self)
+        self.store = SQLVoteStore(self.engine, ['foo', 'bar'])
+        yield self.store.upgradeSchema()
+
+
+    @defer.inlineCallbacks
+    def vote(self, *options):
+        for option in options:
+            yield self.store.vote(option, '1.2.3.4')
+
+
+    @defer.inlineCallbacks
+    def rollup(self):
+        result = yield self.engine.execute(select([VoteRollup.c.key,
+            VoteRollup.c.count]))
+        rows = yield result.fetchall()
+        totals = {}
+        for key, count in rows:
+            totals[key] = totals.get(key, 0) + count
+        defer.returnValue(totals)
+
+
+    @defer.inlineCallbacks
+    def test_catchUp(self):
+        """
+        Votes are counted in the rollup once each.
+        """
+        yield self.vote('foo', 'foo', 'bar')
+        aggregator = RollupAggregator(self.engine, lag=0)
+        count = yield aggregator.catchUp()
+        self.assertEqual(count, 3)
+        self.assertEqual((yield self.rollup()), {'foo': 2, 'bar': 1})
+
+        yield self.vote('bar')
+        count = yield aggregator.catchUp()
+        self.assertEqual(count, 1)
+        self.assertEqual((yield self.rollup()), {'foo': 2, 'bar': 2})
+
+        count = yield aggregator.catchUp()
+        self.assertEqual(count, 0)
+
+
+    @defer.inlineCallbacks
+    def test_batches(self):
+        """
+        Votes are read C{batch_size} at a time until they're all rolled up.
+        """
+        yield self.vote('foo', 'bar', 'foo', 'bar', 'foo')
+        aggregator = RollupAggregator(self.engine, batch_size=2, lag=0)
+        count = yield aggregator.catchUp()
+        self.assertEqual(count, 5)
+        self.assertEqual((yield self.rollup()), {'foo': 3, 'bar': 2})
+        result = yield self.engine.execute(select([RollupWatermark.c.last_id]))
+        self.assertEqual((yield result.scalar()), 5)
+
+
+    @defer.inlineCallbacks
+    def test_lag(self):
+        """
+        Votes younger than C{lag} seconds are left for later.
+        """
+        yield self.vote('foo')
+        aggregator = RollupAggregator(self.engine, lag=3600)
+        count = yield aggregator.catchUp()
+        self.assertEqual(count, 0)
+        self.assertEqual((yield self.rollup()), {})
+
+
+    @defer.inlineCallbacks
+    def test_getTimeseries(self):
+        """
+        The store reads votes per minute from the rollup.
+        """
+        yield self.vote('foo', 'foo', 'bar')
+        yield RollupAggregator(self.engine, lag=0).catchUp()
+        timeseries = yield self.store.getTimeseries(5)
+        self.assertEqual(timeseries['step'], 60)
+        self.assertEqual(sorted(timeseries['series']), ['bar', 'foo'])
+        self.assertEqual(len(timeseries['series']['foo']), 5)
+        self.assertEqual(sum(timeseries['series']['foo']), 2)
+        self.assertEqual(sum(timeseries['series']['bar']), 1)
@@ -0,0 +1,281 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
+
+import os
+
+
+from vc.shm import SharedMemoryStore, EMPTY
+from vc.token import TimedTokenDispenser, NoTokensLeft
+from vc.error import StoreFull
+
+
+
+class SharedMemoryStoreTest(TestCase):
+
+
+    def getStore(self, path=None, **kwargs):
+        if path is None:
+            path = self.mktemp()
+        kwargs.setdefault('slots', 64)
+        kwargs.setdefault('clock', task.Clock())
+        store = SharedMemoryStore(path, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+
+    @defer.inlineCallbacks
+    def test_basic(self):
+        store = self.getStore()
+        yield store.setValue('foo', 5)
+        value = yield store.getValue('foo')
+        self.assertEqual(value, 5)
+
+
+    @defer.inlineCallbacks
+    def test_KeyError(self):
+        store = self.getStore()
+        yield self.assertFailure(store.getValue('foo'), KeyError)
+        yield self.assertFailure(store.rmValue('foo'), KeyError)
+
+
+    @defer.inlineCallbacks
+    def test_rmValue(self):
+        store = self.getStore()
+        yield store.setValue('foo', 5)
+        yield store.rmValue('foo')
+        yield self.assertFailure(store.getValue('foo'), KeyError)
+        result = yield store.getValue('foo', 'default')
+        self.assertEqual(result, 'default')
+
+
+    @defer.inlineCallbacks
+    def test_integersOnly(self):
+        """
+        Only integers can be stored.
+        """
+        store = self.getStore()
+        yield self.assertFailure(store.setValue('foo', 'bar'), TypeError)
+
+
+    @defer.inlineCallbacks
+    def test_increment(self):
+        store = self.getStore()
+        result = yield store.increment('foo', 1)
+        self.assertEqual(result, 1)
+        result = yield store.increment('foo', -10)
+        self.assertEqual(result, -9)
+
+
+    @defer.inlineCallbacks
+    def test_expire(self):
+        """
+        You can cause keys to expire.
+        """
+        clock = task.Clock()
+        store = self.getStore(clock=clock)
+        yield store.setValue('foo', 1)
+        yield store.expire('foo', 50)
+        yield store.increment('bar', 1, expire=10)
+        clock.advance(10)
+        exists = yield store.exists('bar')
+        self.assertEqual(exists, False)
+        clock.advance(39)
+        result = yield store.getValue('foo')
+        self.assertEqual(result, 1)
+        clock.advance(1)
+        yield self.assertFailure(store.getValue('foo'), KeyError)
+
+
+    @defer.inlineCallbacks
+    def test_takePut(self):
+        """
+        take and put behave as they do for MemoryStore.
+        """
+        store = self.getStore()
+        result = yield store.take('foo')
+        self.assertEqual(result, None)
+        result = yield store.take('foo', initial=2)
+        self.assertEqual(result, 1)
+        result = yield store.take('foo', 2)
+        self.assertEqual(result, None)
+        result = yield store.take('foo')
+        self.assertEqual(result, 0)
+        result = yield store.put('foo', 1, 2)
+        self.assertEqual(result, 1)
+        result = yield store.put('foo', 1, 2)
+        self.assertEqual(result, 2)
+        exists = yield store.exists('foo')
+        self.assertEqual(exists, False)
+
+        result = yield store.take('bar', initial=1, remove_empty=True)
+        self.assertEqual(result, 0)
+        exists = yield store.exists('bar')
+        self.assertEqual(exists, False)
+
+
+    @defer.inlineCallbacks
+    def test_hit(self):
+        """
+        hit behaves as it does for MemoryStore.
+        """
+        clock = task.Clock()
+        store = self.getStore(clock=clock)
+        result = yield store.hit('foo', 2, 10)
+        self.assertEqual(result, 1)
+        clock.advance(4)
+        result = yield store.hit('foo', 2, 10)
+        self.assertEqual(result, 0)
+        result = yield store.hit('foo', 2, 10)
+        self.assertEqual(result, None)
+        clock.advance(6)
+        result = yield store.hit('foo', 2, 10)
+        self.assertEqual(result, 0)
+        result = yield store.hit('bar', 2, 10)
+        self.assertEqual(result, 1)
+
+
+    @defer.inlineCallbacks
+    def test_pipeline(self):
+        store = self.getStore()
+        result = yield store.pipeline([
+            ('setValue', 'foo', 2),
+            ('increment', 'foo', 3),
+            ('getValue', 'foo'),
+        ])
+        self.assertEqual(result, [None, 5, 5])
+        yield self.assertFailure(store.pipeline([('close',)]), ValueError)
+
+
+    @defer.inlineCallbacks
+    def test_longKeys(self):
+        """
+        Keys longer than a slot can hold are stored by their hash.
+        """
+        store = self.getStore()
+        yield store.setValue('x' * 100, 1)
+        yield store.setValue('x' * 101, 2)
+        result = yield store.getValue('x' * 100)
+        self.assertEqual(result, 1)
+
+
+    @defer.inlineCallbacks
+    def test_full(self):
+        """
+        Storing more keys than there are slots fails, until expired or
+        removed keys make room.
+        """
+        clock = task.Clock()
+        store = self.getStore(slots=4, clock=clock)
+        for i in range(4):
+            yield store.increment(str(i), 1, expire=10)
+        yield self.assertFailure(store.setValue('foo', 1), StoreFull)
+        clock.advance(10)
+        yield store.setValue('foo', 1)
+
+
+    @defer.inlineCallbacks
+    def test_reclaim(self):
+        """
+        Reclaiming drops removed and expired keys and keeps the rest.
+        """
+        clock = task.Clock()
+        store = self.getStore(clock=clock, reclaim_interval=30)
+        for i in range(10):
+            yield store.setValue(str(i), i)
+        yield store.increment('foo', 1, expire=10)
+        yield store.rmValue('3')
+        self.assertEqual(len(store), 10)
+        clock.advance(30)
+        self.assertEqual(len(store), 9)
+        for i in range(10):
+            if i != 3:
+                result = yield store.getValue(str(i))
+                self.assertEqual(result, i)
+
+
+    @defer.inlineCallbacks
+    def test_reclaimSlice(self):
+        """
+        Each reclaim only sweeps C{reclaim_slots} slots, carrying on where
+        the last one stopped.
+        """
+        clock = task.Clock()
+        store = self.getStore(clock=clock, reclaim_interval=None,
+            reclaim_slots=16)
+        for i in range(32):
+            yield store.increment(str(i), 1, expire=10)
+        clock.advance(10)
+        swept = []
+        for _ in range(4):
+            store.reclaim()
+            swept.append(len(store))
+        self.assertEqual(swept[-1], 0)
+        self.assertEqual(sorted(swept, reverse=True), swept)
+        self.assertTrue(swept[0] > 0, swept)
+
+
+    @defer.inlineCallbacks
+    def test_reclaimEmpties(self):
+        """
+        Removed slots which lookups would stop after anyway are emptied.
+        """
+        store = self.getStore(reclaim_interval=None)
+        yield store.setValue('foo', 1)
+        index, _ = store._find(store._encodeKey('foo'))
+        yield store.rmValue('foo')
+        store.reclaim()
+        self.assertEqual(store._getState(index), EMPTY)
+        self.assertEqual(len(store), 0)
+
+
+    @defer.inlineCallbacks
+    def test_shared(self):
+        """
+        Stores opened on the same file share their data.
+        """
+        path = self.mktemp()
+        store1 = self.getStore(path)
+        store2 = self.getStore(path)
+        yield store1.increment('foo', 3)
+        result = yield store2.increment('foo', 1)
+        self.assertEqual(result, 4)
+
+
+    def test_processes(self):
+        """
+        Increments from several processes are never lost.
+        """
+        path = self.mktemp()
+        self.getStore(path)
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    store = SharedMemoryStore(path, reclaim_interval=None)
+                    for _ in range(500):
+                        store.increment('foo', 1)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        store = self.getStore(path)
+        self.assertEqual(self.successResultOf(store.getValue('foo')), 2000)
+
+
+    @defer.inlineCallbacks
+    def test_dispenser(self):
+        """
+        Dispensers using stores on the same file enforce one combined limit.
+        """
+        path = self.mktemp()
+        clock = task.Clock()
+        d1 = TimedTokenDispenser(available=2, store=self.getStore(path),
+            clock=clock)
+        d2 = TimedTokenDispenser(available=2, store=self.getStore(path),
+            clock=clock)
+        yield d1.getToken('foo')
+        yield d2.getToken('foo')
+        yield self.assertFailure(d1.getToken('foo'), NoTokensLeft)
+        yield self.assertFailure(d2.getToken('foo'), NoTokensLeft)
@@ -1,22 +1,26 @@
-from twisted.trial.unittest import TestCase, SkipTest
-from twisted.internet import reactor, defer
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, defer, task
 import os
+import re
+import uuid
 
 
-from vc.error import NotAnOption
-from vc.sql import SQLVoteStore
+from vc.error import NotAnOption, NoSuchPoll, BufferFull
+from vc.sql import SQLVoteStore, createEngine, dialect_patches
 
 
-from sqlalchemy import create_engine
-from alchimia import TWISTED_STRATEGY
 
-
-
-def testEngine():
+def makeEngine(testcase):
+    """
+    Make an engine for the database in C{DATABASE_URL}, or for a new SQLite
+    database if that isn't set.
+    """
     url = os.environ.get('DATABASE_URL', None)
     if url is None:
-        raise SkipTest('You must set DATABASE_URL in order to test')
-    engine = create_engine(url, reactor=reactor, strategy=TWISTED_STRATEGY)
+        url = 'sqlite:///' + testcase.mktemp()
+    engine = createEngine(url, reactor)
+    if hasattr(engine, 'close'):
+        testcase.addCleanup(engine.close)
     return engine
 
 
@@ -26,7 +30,7 @@ class SQLVoteStoreTest(TestCase):
 
     @defer.inlineCallbacks
     def getStore(self, *args, **kwargs):
-        engine = testEngine()
+        engine = makeEngine(self)
         store = SQLVoteStore(engine, *args, **kwargs)
         yield store.upgradeSchema()
         defer.returnValue(store)
@@ -64,3 +68,224 @@ class SQLVoteStoreTest(TestCase):
         self.assertEqual(results['bar'], 1)
         self.assertEqual(results['baz'], 0)
 
+
+    @defer.inlineCallbacks
+    def test_vote_buffered(self):
+        """
+        In buffered mode, votes aren't written until a full batch is waiting.
+        """
+        store = yield self.getStore(options=['foo'], flush_size=2,
+            clock=task.Clock())
+        before = yield store.getResults()
+        d1 = store.vote('foo', '1.2.3.4')
+        self.assertFalse(d1.called)
+        d2 = store.vote('foo', '1.2.3.4')
+        yield d1
+        yield d2
+        results = yield store.getResults()
+        self.assertEqual(results['foo'], before['foo'] + 2)
+
+
+    @defer.inlineCallbacks
+    def test_vote_flushInterval(self):
+        """
+        Buffered votes are written after C{flush_interval} seconds even if the
+        batch isn't full.
+        """
+        clock = task.Clock()
+        store = yield self.getStore(options=['foo'], flush_size=10,
+            flush_interval=5, clock=clock)
+        before = yield store.getResults()
+        d = store.vote('foo', '1.2.3.4')
+        clock.advance(4)
+        self.assertFalse(d.called)
+        clock.advance(1)
+        yield d
+        results = yield store.getResults()
+        self.assertEqual(results['foo'], before['foo'] + 1)
+
+
+    @defer.inlineCallbacks
+    def test_vote_maxBuffered(self):
+        """
+        Votes are refused once C{max_buffered} votes are waiting to be written.
+        """
+        store = yield self.getStore(options=['foo'], flush_size=10,
+            max_buffered=1, clock=task.Clock())
+        d = store.vote('foo', '1.2.3.4')
+        yield self.assertFailure(store.vote('foo', '1.2.3.4'), BufferFull)
+        yield store.flush()
+        yield d
+        d = store.vote('foo', '1.2.3.4')
+        yield store.flush()
+        yield d
+
+
+    @defer.inlineCallbacks
+    def test_voteMany(self):
+        """
+        You can cast several votes at once.
+        """
+        store = yield self.getStore(options=['foo', 'bar'])
+        before = yield store.getResults()
+        yield store.voteMany(['foo', 'bar', 'foo'], '1.2.3.4')
+        results = yield store.getResults()
+        self.assertEqual(results['foo'], before['foo'] + 2)
+        self.assertEqual(results['bar'], before['bar'] + 1)
+
+
+    @defer.inlineCallbacks
+    def test_voteMany_allOrNothing(self):
+        """
+        If any option isn't valid, none of the votes are cast.
+        """
+        store = yield self.getStore(options=['foo'])
+        before = yield store.getResults()
+        yield self.assertFailure(store.voteMany(['foo', 'bar'], '1.2.3.4'),
+            NotAnOption)
+        yield self.assertFailure(store.voteMany([], '1.2.3.4'), NotAnOption)
+        results = yield store.getResults()
+        self.assertEqual(results, before)
+
+
+    @defer.inlineCallbacks
+    def test_voteMany_buffered(self):
+        """
+        In buffered mode, a ballot's votes are written in the same batch even
+        if it doesn't fit in C{flush_size}, and count towards
+        C{max_buffered}.
+        """
+        store = yield self.getStore(options=['foo', 'bar'], flush_size=2,
+            max_buffered=4, clock=task.Clock())
+        before = yield store.getResults()
+        d1 = store.vote('foo', '1.2.3.4')
+        d2 = store.voteMany(['foo', 'bar'], '1.2.3.4')
+        self.assertEqual(store._pending, [])
+        yield self.assertFailure(store.voteMany(['foo', 'bar'], '1.2.3.4'),
+            BufferFull)
+        yield d1
+        yield d2
+        results = yield store.getResults()
+        self.assertEqual(results['foo'], before['foo'] + 2)
+        self.assertEqual(results['bar'], before['bar'] + 1)
+
+
+    @defer.inlineCallbacks
+    def test_flush(self):
+        """
+        Flushing writes all buffered votes.
+        """
+        store = yield self.getStore(options=['foo', 'bar'], flush_size=10,
+            clock=task.Clock())
+        before = yield store.getResults()
+        store.vote('foo', '1.2.3.4')
+        store.vote('bar', '1.2.3.4')
+        yield store.flush()
+        results = yield store.getResults()
+        self.assertEqual(results['foo'], before['foo'] + 1)
+        self.assertEqual(results['bar'], before['bar'] + 1)
+
+
+    @defer.inlineCallbacks
+    def test_polls(self):
+        """
+        Each poll has its own options and totals.
+        """
+        store = yield self.getStore(options=['foo'])
+        poll = uuid.uuid4().hex
+        yield store.createPoll(poll, ['foo', 'bar'])
+        before = yield store.getResults()
+        yield store.vote('foo', '1.2.3.4', poll)
+        yield store.vote('bar', '1.2.3.4', poll)
+        yield store.vote('bar', '1.2.3.4', poll)
+        self.assertEqual((yield store.getResults(poll)), {'foo': 1, 'bar': 2})
+        self.assertEqual((yield store.getResults()), before)
+
+
+    @defer.inlineCallbacks
+    def test_polls_options(self):
+        store = yield self.getStore(options=['foo'])
+        poll = uuid.uuid4().hex
+        yield store.createPoll(poll, ['bar'])
+        yield self.assertFailure(store.vote('foo', '1.2.3.4', poll),
+            NotAnOption)
+        yield self.assertFailure(store.vote('foo', '1.2.3.4', 'nope'),
+            NoSuchPoll)
+        yield self.assertFailure(store.getResults('nope'), NoSuchPoll)
+
+
+    @defer.inlineCallbacks
+    def test_checkVotes(self):
+        """
+        Votes are checked against the known polls without a query.
+        """
+        store = yield self.getStore(options=['foo', 'bar'])
+        store.engine = None
+        store.checkVotes(['foo', 'bar', 'foo'])
+        self.assertRaises(NotAnOption, store.checkVotes, ['foo', 'baz'])
+        self.assertRaises(NotAnOption, store.checkVotes, [])
+        self.assertRaises(NoSuchPoll, store.checkVotes, ['foo'], 'nope')
+
+
+    @defer.inlineCallbacks
+    def test_loadPolls(self):
+        """
+        Polls are read from the database.
+        """
+        store = yield self.getStore(options=['foo'])
+        poll = uuid.uuid4().hex
+        yield store.createPoll(poll, ['bar', 'baz'])
+        other = SQLVoteStore(store.engine, ['foo'])
+        self.assertNotIn(poll, other.polls)
+        yield other.loadPolls()
+        self.assertEqual(other.polls[poll], frozenset(['bar', 'baz']))
+        self.assertEqual(other.polls[''], frozenset(['foo']))
+
+
+    @defer.inlineCallbacks
+    def test_polls_buffered(self):
+        store = yield self.getStore(options=['foo'], flush_size=10,
+            clock=task.Clock())
+        poll = uuid.uuid4().hex
+        yield store.createPoll(poll, ['foo'])
+        store.vote('foo', '1.2.3.4', poll)
+        store.vote('foo', '1.2.3.4')
+        yield store.flush()
+        self.assertEqual((yield store.getResults(poll)), {'foo': 1})
+
+
+
+# Statements which need a table to exist already, and those that rename one.
+_uses_table = re.compile(r'\b(?:ALTER TABLE|CREATE INDEX \w+ ON|INSERT INTO|'
+    r'UPDATE|DROP TABLE|DROP VIEW|DROP TRIGGER \w+ ON|INSERT ON) (\w+)')
+_renames_table = re.compile(r'\bALTER TABLE (\w+) RENAME TO (\w+)')
+_creates_table = re.compile(r'\bCREATE (?:TABLE|VIEW) (\w+)')
+
+
+
+class SchemaPatchTest(TestCase):
+
+
+    def assertOrdered(self, dialect):
+        """
+        Every table a patch uses was made by an earlier statement.
+        """
+        tables = set()
+        for name, sqls in dialect_patches[dialect].items():
+            for sql in sqls:
+                for table in _uses_table.findall(sql):
+                    self.assertIn(table, tables, '%s: %s' % (name, sql))
+                for old, new in _renames_table.findall(sql):
+                    tables.discard(old)
+                    tables.add(new)
+                tables.update(_creates_table.findall(sql))
+                if sql.startswith(('DROP TABLE', 'DROP VIEW')):
+                    tables.discard(sql.split()[2])
+
+
+    def test_postgresqlOrder(self):
+        self.assertOrdered('postgresql')
+
+
+    def test_sqliteOrder(self):
+        self.assertOrdered('sqlite')
@@ -0,0 +1,152 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+
+
+from vc.stream import ResultsBroadcaster
+
+
+
+class FakeVoteStore(object):
+
+
+    def __init__(self, results):
+        self.results = results
+
+
+    def getResults(self, poll=''):
+        return defer.succeed(dict(self.results))
+
+
+
+class FakeRequest(object):
+
+
+    def __init__(self):
+        self.headers = {}
+        self.written = []
+        self.producer = None
+        self.finished = defer.Deferred()
+
+
+    def setHeader(self, name, value):
+        self.headers[name] = value
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+    def notifyFinish(self):
+        return self.finished
+
+
+
+class ResultsBroadcasterTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.store = FakeVoteStore({'foo': 1, 'bar': 2})
+        self.broadcaster = ResultsBroadcaster(self.store, interval=1,
+            heartbeat=3, clock=self.clock)
+
+
+    def test_snapshot(self):
+        """
+        New subscribers are sent all the results.
+        """
+        request = FakeRequest()
+        self.broadcaster.subscribe(request)
+        self.assertEqual(request.headers['Content-Type'], 'text/event-stream')
+        self.assertEqual(request.written, [
+            b'event: results\ndata: {"bar": 2, "foo": 1}\n\n'])
+
+
+    def test_delta(self):
+        """
+        Once per tick, subscribers are sent the totals which changed, encoded
+        once for all of them.
+        """
+        r1, r2 = FakeRequest(), FakeRequest()
+        self.broadcaster.subscribe(r1)
+        self.broadcaster.subscribe(r2)
+        self.clock.advance(1)
+        self.assertEqual(r2.written, r1.written)
+        self.store.results['foo'] = 3
+        self.store.results['foo'] = 4
+        self.clock.advance(1)
+        self.assertEqual(r1.written[-1], b'event: delta\ndata: {"foo": 4}\n\n')
+        self.assertIs(r1.written[-1], r2.written[-1])
+        self.clock.advance(1)
+        self.assertEqual(len(r1.written), 2)
+        self.assertEqual(len(r2.written), 2)
+
+
+    def test_heartbeat(self):
+        """
+        A comment is sent after C{heartbeat} ticks without changes.
+        """
+        request = FakeRequest()
+        self.broadcaster.subscribe(request)
+        self.clock.advance(2)
+        self.assertEqual(len(request.written), 1)
+        self.clock.advance(1)
+        self.assertEqual(request.written[-1], b': keepalive\n\n')
+
+
+    def test_slowConsumer(self):
+        """
+        A subscriber whose connection is still backed up on the next tick is
+        dropped.
+        """
+        request = FakeRequest()
+        d = self.broadcaster.subscribe(request)
+        request.producer.pauseProducing()
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(self.broadcaster.subscribers, [])
+        self.assertEqual(request.producer, None)
+
+
+    def test_paused(self):
+        """
+        A subscriber which is paused and resumed between ticks is kept.
+        """
+        request = FakeRequest()
+        d = self.broadcaster.subscribe(request)
+        request.producer.pauseProducing()
+        request.producer.resumeProducing()
+        self.clock.advance(1)
+        self.assertNoResult(d)
+
+
+    def test_disconnect(self):
+        """
+        Subscribers are removed when they disconnect, and ticks stop when
+        nobody is subscribed.
+        """
+        request = FakeRequest()
+        self.broadcaster.subscribe(request)
+        request.finished.errback(Failure(ConnectionDone()))
+        self.assertEqual(self.broadcaster.subscribers, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_cancel(self):
+        """
+        Cancelling the stream's Deferred removes the subscriber.
+        """
+        request = FakeRequest()
+        d = self.broadcaster.subscribe(request)
+        d.cancel()
+        self.assertEqual(self.broadcaster.subscribers, [])
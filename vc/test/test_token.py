@@ -68,6 +68,184 @@ class MemoryStoreTest(TestCase):
         yield self.assertFailure(store.getValue('foo'), KeyError)
 
 
+    def test_expire_sweep(self):
+        """
+        Expired keys are removed by a periodic sweep even if nobody asks for
+        them again.
+        """
+        clock = task.Clock()
+        store = MemoryStore(clock=clock, sweep_interval=10)
+        store.setValue('foo', 'bar')
+        store.setValue('baz', 'bar')
+        store.expire('foo', 5)
+        store.expire('baz', 15)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.advance(10)
+        self.assertEqual(len(store), 1)
+        clock.advance(10)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    @defer.inlineCallbacks
+    def test_expire_again(self):
+        """
+        Setting a new expiration replaces the old one.
+        """
+        clock = task.Clock()
+        store = MemoryStore(clock=clock)
+        yield store.setValue('foo', 'bar')
+        yield store.expire('foo', 5)
+        yield store.expire('foo', 10)
+        clock.advance(9)
+        result = yield store.getValue('foo')
+        self.assertEqual(result, 'bar')
+        clock.advance(1)
+        yield self.assertFailure(store.getValue('foo'), KeyError)
+
+
+    @defer.inlineCallbacks
+    def test_expire_removed(self):
+        """
+        A key which is removed and set again doesn't keep its old expiration.
+        """
+        clock = task.Clock()
+        store = MemoryStore(clock=clock)
+        yield store.setValue('foo', 'bar')
+        yield store.expire('foo', 5)
+        yield store.rmValue('foo')
+        yield store.setValue('foo', 'baz')
+        clock.advance(10)
+        result = yield store.getValue('foo')
+        self.assertEqual(result, 'baz')
+
+
+    @defer.inlineCallbacks
+    def test_increment_expire(self):
+        """
+        An increment which creates a key can set when it expires.
+        """
+        clock = task.Clock()
+        store = MemoryStore(clock=clock)
+        yield store.increment('foo', 1, expire=10)
+        clock.advance(5)
+        result = yield store.increment('foo', 1, expire=10)
+        self.assertEqual(result, 2)
+        clock.advance(5)
+        exists = yield store.exists('foo')
+        self.assertEqual(exists, False)
+
+
+    @defer.inlineCallbacks
+    def test_take(self):
+        """
+        You can take from a count only while there's enough left.
+        """
+        store = MemoryStore()
+        result = yield store.take('foo')
+        self.assertEqual(result, None)
+        result = yield store.take('foo', initial=2)
+        self.assertEqual(result, 1)
+        result = yield store.take('foo', initial=2)
+        self.assertEqual(result, 0)
+        result = yield store.take('foo', initial=2)
+        self.assertEqual(result, None)
+        result = yield store.getValue('foo')
+        self.assertEqual(result, 0)
+
+
+    @defer.inlineCallbacks
+    def test_take_amount(self):
+        """
+        You can take more than one at a time, and remove the key once it's
+        empty.
+        """
+        clock = task.Clock()
+        store = MemoryStore(clock=clock)
+        yield store.setValue('foo', 3)
+        result = yield store.take('foo', 4)
+        self.assertEqual(result, None)
+        result = yield store.take('foo', 3, remove_empty=True)
+        self.assertEqual(result, 0)
+        exists = yield store.exists('foo')
+        self.assertEqual(exists, False)
+
+        yield store.take('bar', initial=3, expire=10)
+        clock.advance(10)
+        exists = yield store.exists('bar')
+        self.assertEqual(exists, False)
+
+
+    @defer.inlineCallbacks
+    def test_put(self):
+        """
+        You can add to a count, which is removed once it's full.
+        """
+        store = MemoryStore()
+        yield store.setValue('foo', 1)
+        result = yield store.put('foo', 1, 3)
+        self.assertEqual(result, 2)
+        result = yield store.put('foo', 1, 3)
+        self.assertEqual(result, 3)
+        exists = yield store.exists('foo')
+        self.assertEqual(exists, False)
+
+
+    @defer.inlineCallbacks
+    def test_hit(self):
+        """
+        Only C{limit} hits are allowed in any C{window} seconds, and the key
+        goes away once they're all that old.
+        """
+        clock = task.Clock()
+        store = MemoryStore(clock)
+        result = yield store.hit('foo', 2, 10)
+        self.assertEqual(result, 1)
+        clock.advance(4)
+        result = yield store.hit('foo', 2, 10)
+        self.assertEqual(result, 0)
+        result = yield store.hit('foo', 2, 10)
+        self.assertEqual(result, None)
+        clock.advance(6)
+        result = yield store.hit('foo', 2, 10)
+        self.assertEqual(result, 0)
+        clock.advance(14)
+        exists = yield store.exists('foo')
+        self.assertEqual(exists, False)
+
+
+    @defer.inlineCallbacks
+    def test_pipeline(self):
+        """
+        You can send several operations at once.
+        """
+        store = MemoryStore(task.Clock())
+        result = yield store.pipeline([
+            ('setValue', 'foo', 2),
+            ('increment', 'foo', 3),
+            ('expire', 'foo', 10),
+            ('getValue', 'foo'),
+        ])
+        self.assertEqual(result, [None, 5, None, 5])
+
+
+    @defer.inlineCallbacks
+    def test_pipeline_error(self):
+        """
+        A pipeline fails with the first error.
+        """
+        store = MemoryStore()
+        yield self.assertFailure(store.pipeline([
+            ('setValue', 'foo', 2),
+            ('getValue', 'bar'),
+        ]), KeyError)
+        yield self.assertFailure(store.pipeline([
+            ('_maybeRemove', 'foo'),
+        ]), ValueError)
+        result = yield store.getValue('foo')
+        self.assertEqual(result, 2)
+
+
     @defer.inlineCallbacks
     def test_exists(self):
         """
@@ -122,6 +300,39 @@ class TimedTokenDispenserTest(TestCase):
         yield self.assertFailure(d.useToken(token), InvalidToken)
 
 
+    @defer.inlineCallbacks
+    def test_useToken_many(self):
+        """
+        Several uses can be taken at once, only if there are that many left.
+        """
+        clock = task.Clock()
+        d = TimedTokenDispenser(use_limit=3, store=MemoryStore(clock),
+            clock=clock)
+        token = yield d.getToken('foo')
+        yield self.assertFailure(d.useToken(token, 4), InvalidToken)
+        yield d.useToken(token, 2)
+        yield self.assertFailure(d.useToken(token, 2), InvalidToken)
+        yield d.useToken(token)
+        yield self.assertFailure(d.useToken(token), InvalidToken)
+
+
+    @defer.inlineCallbacks
+    def test_refundToken(self):
+        """
+        Uses can be given back, even once a token was used up.
+        """
+        clock = task.Clock()
+        d = TimedTokenDispenser(use_limit=2, expiration=10,
+            store=MemoryStore(clock), clock=clock)
+        token = yield d.getToken('foo')
+        yield d.useToken(token, 2)
+        yield d.refundToken(token, 2)
+        yield d.useToken(token, 2)
+        yield d.refundToken(token)
+        clock.advance(10)
+        yield self.assertFailure(d.useToken(token), InvalidToken)
+
+
     @defer.inlineCallbacks
     def test_tokenExpires(self):
         """
@@ -185,4 +396,132 @@ class TimedTokenDispenserTest(TestCase):
         yield d.getToken('foo', check_available=False)
 
 
+    @defer.inlineCallbacks
+    def test_getToken_slidingWindow(self):
+        """
+        With a sliding window, tokens are given out exactly when they would
+        be if each were restored C{refresh} seconds later, but without
+        scheduling any calls.
+        """
+        steps = [0, 1, 0, 0, 3, 6, 0, 1, 9, 0, 0, 10, 20, 0, 0, 0]
+        outcomes = []
+        for sliding_window in (False, True):
+            clock = task.Clock()
+            d = TimedTokenDispenser(available=3, refresh=10,
+                store=MemoryStore(clock), clock=clock,
+                sliding_window=sliding_window)
+            got = []
+            for step in steps:
+                clock.advance(step)
+                try:
+                    yield d.getToken('foo')
+                    got.append(True)
+                except NoTokensLeft:
+                    got.append(False)
+            outcomes.append(got)
+            restores = [c for c in clock.getDelayedCalls()
+                if c.func == d._restoreToken]
+            self.assertEqual(bool(restores), not sliding_window)
+        self.assertEqual(outcomes[0], outcomes[1])
+        self.assertIn(False, outcomes[0])
+
+
+
+
 
+    @defer.inlineCallbacks
+    def test_signed_useToken_uses(self):
+        """
+        Signed tokens may only be used a certain number of times.
+        """
+        d = TimedTokenDispenser(use_limit=2, store=MemoryStore(task.Clock()),
+            clock=task.Clock(), secret='secret')
+        token = yield d.getToken('foo')
+        yield d.useToken(token)
+        yield d.useToken(token)
+        yield self.assertFailure(d.useToken(token), InvalidToken)
+
+
+    @defer.inlineCallbacks
+    def test_signed_useToken_many(self):
+        """
+        Several uses of a signed token can be taken at once, only if there
+        are that many left, and given back.
+        """
+        clock = task.Clock()
+        d = TimedTokenDispenser(use_limit=3, store=MemoryStore(clock),
+            clock=clock, secret='secret')
+        token = yield d.getToken('foo')
+        yield self.assertFailure(d.useToken(token, 4), InvalidToken)
+        yield d.useToken(token, 2)
+        yield self.assertFailure(d.useToken(token, 2), InvalidToken)
+        yield d.refundToken(token, 2)
+        yield d.useToken(token, 3)
+        yield self.assertFailure(d.useToken(token), InvalidToken)
+
+
+    @defer.inlineCallbacks
+    def test_signed_nothingStored(self):
+        """
+        Nothing is stored for a signed token until it's used.
+        """
+        store = MemoryStore(task.Clock())
+        d = TimedTokenDispenser(store=store, clock=task.Clock(),
+            secret='secret')
+        yield d.getToken('foo', check_available=False)
+        self.assertEqual(len(store), 0)
+
+
+    @defer.inlineCallbacks
+    def test_signed_tokenExpires(self):
+        """
+        Signed tokens expire after a certain amount of time, and so does the
+        record of their uses.
+        """
+        clock = task.Clock()
+        store = MemoryStore(clock)
+        d = TimedTokenDispenser(use_limit=2, expiration=50, store=store,
+            clock=clock, secret='secret')
+        token = yield d.getToken('foo', check_available=False)
+        clock.advance(20)
+        yield d.useToken(token)
+        self.assertEqual(len(store), 1)
+        clock.advance(30)
+        self.assertEqual(len(store), 0)
+        yield self.assertFailure(d.useToken(token), InvalidToken)
+
+
+    @defer.inlineCallbacks
+    def test_signed_forged(self):
+        """
+        Tokens signed with a different secret, tampered with or made up are
+        invalid.
+        """
+        clock = task.Clock()
+        d = TimedTokenDispenser(store=MemoryStore(clock), clock=clock,
+            secret='secret')
+        other = TimedTokenDispenser(store=MemoryStore(clock), clock=clock,
+            secret='other')
+        token = yield other.getToken('foo')
+        yield self.assertFailure(d.useToken(token), InvalidToken)
+
+        token = yield d.getToken('foo')
+        tampered = token[:5] + ('A' if token[5] != 'A' else 'B') + token[6:]
+        yield self.assertFailure(d.useToken(tampered), InvalidToken)
+        yield self.assertFailure(d.useToken('garbage!'), InvalidToken)
+        yield self.assertFailure(d.useToken(''), InvalidToken)
+
+
+    @defer.inlineCallbacks
+    def test_signed_shared(self):
+        """
+        Dispensers sharing a secret and a store accept each other's tokens
+        and share their use counts.
+        """
+        clock = task.Clock()
+        store = MemoryStore(clock)
+        d1 = TimedTokenDispenser(store=store, clock=clock, secret='secret')
+        d2 = TimedTokenDispenser(store=store, clock=clock, secret='secret')
+        token = yield d1.getToken('foo')
+        yield d2.useToken(token)
+        yield self.assertFailure(d1.useToken(token), InvalidToken)
@@ -0,0 +1,813 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task, reactor
+from twisted.web.server import Site
+from twisted.web.test.requesthelper import DummyRequest
+import treq
+
+from io import BytesIO
+import gzip
+import json
+import os
+
+
+from vc.error import CaptchaFailed, InvalidToken, NoSuchPoll, NotAnOption
+from vc.web import EncodedResults, etagMatches, chooseEncoding, CachedFile
+from vc.web import RecaptchaVerifier, isAdmin, VoteCounter
+from vc.profiling import Profiler
+from vc.token import TimedTokenDispenser, MemoryStore
+
+
+
+class EncodedResultsTest(TestCase):
+
+
+    def test_update(self):
+        """
+        Results are encoded when they change.
+        """
+        encoded = EncodedResults()
+        encoded.update({'foo': 1})
+        self.assertEqual(encoded.body, '{"foo": 1}')
+        etag = encoded.etag
+
+        encoded.update({'foo': 1})
+        self.assertEqual(encoded.etag, etag)
+
+        encoded.update({'foo': 2})
+        self.assertEqual(encoded.body, '{"foo": 2}')
+        self.assertNotEqual(encoded.etag, etag)
+
+
+    def test_etagFor(self):
+        """
+        JSONP responses have their own ETag per callback.
+        """
+        encoded = EncodedResults()
+        encoded.update({'foo': 1})
+        self.assertEqual(encoded.etagFor(None), encoded.etag)
+        a = encoded.etagFor('a')
+        b = encoded.etagFor('b')
+        self.assertNotEqual(a, encoded.etag)
+        self.assertNotEqual(a, b)
+        self.assertTrue(a.startswith('"') and a.endswith('"'))
+
+
+
+class EtagMatchesTest(TestCase):
+
+
+    def test_matches(self):
+        """
+        An ETag matches If-None-Match if it's in the list or the list is *.
+        """
+        request = DummyRequest([])
+        self.assertFalse(etagMatches(request, '"abc"'))
+        request.requestHeaders.setRawHeaders('if-none-match', ['"x", "abc"'])
+        self.assertTrue(etagMatches(request, '"abc"'))
+        self.assertFalse(etagMatches(request, '"ab"'))
+        request.requestHeaders.setRawHeaders('if-none-match', ['*'])
+        self.assertTrue(etagMatches(request, '"abc"'))
+
+
+
+class ChooseEncodingTest(TestCase):
+
+
+    def test_none(self):
+        """
+        Without an Accept-Encoding header the body isn't encoded.
+        """
+        self.assertEqual(chooseEncoding(None, ['br', 'gzip']), None)
+        self.assertEqual(chooseEncoding('', ['br', 'gzip']), None)
+
+
+    def test_preference(self):
+        """
+        The most preferred coding the client accepts is chosen.
+        """
+        self.assertEqual(chooseEncoding('gzip, deflate, br', ['br', 'gzip']),
+            'br')
+        self.assertEqual(chooseEncoding('gzip, deflate', ['br', 'gzip']),
+            'gzip')
+        self.assertEqual(chooseEncoding('deflate', ['br', 'gzip']), None)
+
+
+    def test_quality(self):
+        """
+        Codings with a quality of 0 are refused, and * covers the rest.
+        """
+        self.assertEqual(chooseEncoding('br;q=0, gzip;q=0.5', ['br', 'gzip']),
+            'gzip')
+        self.assertEqual(chooseEncoding('*', ['br', 'gzip']), 'br')
+        self.assertEqual(chooseEncoding('*;q=0', ['br', 'gzip']), None)
+
+
+
+class CachedFileTest(TestCase):
+
+
+    def setUp(self):
+        self.path = self.mktemp() + '.html'
+        with open(self.path, 'wb') as f:
+            f.write(b'<html>hello</html>')
+        self.clock = task.Clock()
+        self.resource = CachedFile(self.path, clock=self.clock)
+
+
+    def render(self, **headers):
+        request = DummyRequest([])
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name.replace('_', '-'),
+                [value])
+        body = self.resource.render(request)
+        return request, body
+
+
+    def header(self, request, name):
+        values = request.responseHeaders.getRawHeaders(name)
+        return values[0] if values else None
+
+
+    def test_render(self):
+        request, body = self.render()
+        self.assertEqual(body, b'<html>hello</html>')
+        self.assertEqual(self.header(request, 'content-type'), 'text/html')
+        self.assertEqual(self.header(request, 'content-encoding'), None)
+        self.assertNotEqual(self.header(request, 'etag'), None)
+        self.assertNotEqual(self.header(request, 'last-modified'), None)
+
+
+    def test_gzip(self):
+        """
+        Clients accepting gzip are sent the precompressed body.
+        """
+        request, body = self.render(accept_encoding='gzip')
+        self.assertEqual(self.header(request, 'content-encoding'), 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(body)).read(),
+            b'<html>hello</html>')
+        plain, _ = self.render()
+        self.assertNotEqual(self.header(request, 'etag'),
+            self.header(plain, 'etag'))
+
+
+    def test_etag(self):
+        """
+        Requests with a matching If-None-Match get a 304.
+        """
+        request, _ = self.render()
+        etag = self.header(request, 'etag')
+        request, body = self.render(if_none_match=etag)
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(body, b'')
+
+
+    def test_lastModified(self):
+        """
+        Requests with an If-Modified-Since no older than the file get a 304.
+        """
+        request, _ = self.render()
+        last_modified = self.header(request, 'last-modified')
+        request, body = self.render(if_modified_since=last_modified)
+        self.assertEqual(request.responseCode, 304)
+
+
+    def test_reload(self):
+        """
+        The file is read again once its modification time changes.
+        """
+        self.render()
+        with open(self.path, 'wb') as f:
+            f.write(b'changed')
+        mtime = os.stat(self.path).st_mtime + 10
+        os.utime(self.path, (mtime, mtime))
+        _, body = self.render()
+        self.assertEqual(body, b'<html>hello</html>')
+        self.clock.advance(self.resource.check_interval)
+        _, body = self.render()
+        self.assertEqual(body, b'changed')
+
+
+
+
+class IsAdminTest(TestCase):
+
+
+    def request(self, authorization=None):
+        request = DummyRequest([])
+        if authorization is not None:
+            request.requestHeaders.setRawHeaders('authorization',
+                [authorization])
+        return request
+
+
+    def test_bearer(self):
+        self.assertTrue(isAdmin(self.request('Bearer secret'), 'secret'))
+        self.assertTrue(isAdmin(self.request('bearer secret'), 'secret'))
+
+
+    def test_wrong(self):
+        self.assertFalse(isAdmin(self.request(), 'secret'))
+        self.assertFalse(isAdmin(self.request('Bearer wrong'), 'secret'))
+        self.assertFalse(isAdmin(self.request('Basic secret'), 'secret'))
+
+
+    def test_disabled(self):
+        """
+        Nobody is an admin without an admin token.
+        """
+        self.assertFalse(isAdmin(self.request('Bearer '), None))
+        self.assertFalse(isAdmin(self.request('Bearer '), ''))
+
+
+class FakeResponse(object):
+
+
+    def __init__(self, body):
+        self.body = body
+
+
+    def content(self):
+        return defer.succeed(self.body)
+
+
+
+class FakeHTTPClient(object):
+    """
+    I record posts, which are answered by firing the Deferreds in
+    C{requests}.
+    """
+
+
+    def __init__(self):
+        self.requests = []
+
+
+    def post(self, url, data=None):
+        d = defer.Deferred()
+        self.requests.append((url, data, d))
+        return d
+
+
+    def answer(self, body, i=0):
+        _, _, d = self.requests.pop(i)
+        d.callback(FakeResponse(body))
+
+
+
+class RecaptchaVerifierTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = FakeHTTPClient()
+
+
+    def verifier(self, **kwargs):
+        return RecaptchaVerifier('secret', http_client=self.client,
+            clock=self.clock, **kwargs)
+
+
+    def test_verified(self):
+        """
+        The answer is posted with the private key, and accepted if the
+        verifier says true.
+        """
+        verifier = self.verifier(url='http://127.0.0.1:1234/verify')
+        d = verifier.assertVerified('1.2.3.4', 'challenge', 'response')
+        url, data, _ = self.client.requests[0]
+        self.assertEqual(url, 'http://127.0.0.1:1234/verify')
+        self.assertEqual(data, {
+            'privatekey': 'secret',
+            'remoteip': '1.2.3.4',
+            'challenge': 'challenge',
+            'response': 'response',
+        })
+        self.client.answer(b'true\nsuccess')
+        self.successResultOf(d)
+
+
+    def test_failed(self):
+        verifier = self.verifier()
+        d = verifier.assertVerified('1.2.3.4', 'challenge', 'wrong')
+        self.client.answer(b'false\nincorrect-captcha-sol')
+        self.failureResultOf(d, CaptchaFailed)
+
+
+    def test_cached(self):
+        """
+        The outcome for an answer is remembered for C{cache_ttl} seconds.
+        """
+        verifier = self.verifier(cache_ttl=10)
+        d = verifier.assertVerified('1.2.3.4', 'challenge', 'wrong')
+        self.client.answer(b'false\n')
+        self.failureResultOf(d, CaptchaFailed)
+
+        self.clock.advance(9)
+        d = verifier.assertVerified('1.2.3.4', 'challenge', 'wrong')
+        self.failureResultOf(d, CaptchaFailed)
+        self.assertEqual(self.client.requests, [])
+
+        self.clock.advance(1)
+        verifier.assertVerified('1.2.3.4', 'challenge', 'wrong')
+        self.assertEqual(len(self.client.requests), 1)
+
+
+    def test_shared(self):
+        """
+        Identical answers checked at the same time share one request.
+        """
+        verifier = self.verifier()
+        d1 = verifier.assertVerified('1.2.3.4', 'challenge', 'response')
+        d2 = verifier.assertVerified('1.2.3.4', 'challenge', 'response')
+        self.assertEqual(len(self.client.requests), 1)
+        self.client.answer(b'true\n')
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+
+
+    def test_concurrency(self):
+        """
+        At most C{concurrency} requests are made at once; the rest wait.
+        """
+        verifier = self.verifier(concurrency=2)
+        ds = [verifier.assertVerified('1.2.3.4', 'challenge', str(i))
+            for i in range(3)]
+        self.assertEqual(len(self.client.requests), 2)
+        self.client.answer(b'true\n')
+        self.successResultOf(ds[0])
+        self.assertEqual(len(self.client.requests), 2)
+        self.assertEqual(self.client.requests[1][1]['response'], '2')
+
+
+    def test_timeout(self):
+        """
+        Checks that take longer than C{timeout} seconds fail, free their
+        connection and aren't remembered.
+        """
+        verifier = self.verifier(concurrency=1, timeout=5)
+        d1 = verifier.assertVerified('1.2.3.4', 'challenge', 'response')
+        self.clock.advance(3)
+        d2 = verifier.assertVerified('1.2.3.4', 'challenge', 'other')
+        self.clock.advance(2)
+        self.failureResultOf(d1, defer.TimeoutError)
+        self.assertEqual(len(self.client.requests), 2)
+        self.client.answer(b'true\n', 1)
+        self.successResultOf(d2)
+
+        verifier.assertVerified('1.2.3.4', 'challenge', 'response')
+        self.assertEqual(len(self.client.requests), 2)
+
+
+
+
+class FakeDispenser(object):
+
+
+    def __init__(self, uses):
+        self.uses = uses
+        self.calls = 0
+
+
+    def useToken(self, token, uses=1):
+        self.calls += 1
+        if uses > self.uses:
+            return defer.fail(InvalidToken('Token already used'))
+        self.uses -= uses
+        return defer.succeed(None)
+
+
+    def refundToken(self, token, uses=1):
+        self.uses += uses
+        return defer.succeed(None)
+
+
+
+class FakeBallotStore(object):
+
+
+    def __init__(self):
+        self.votes = []
+        self.error = None
+
+
+    def checkVotes(self, options, poll=''):
+        for option in options:
+            if option not in 'abcd':
+                raise NotAnOption('%r is not an option' % (option,))
+
+
+    def vote(self, option, ip, poll=''):
+        return self.voteMany([option], ip, poll)
+
+
+    def voteMany(self, options, ip, poll=''):
+        if self.error is not None:
+            return defer.fail(self.error)
+        self.votes.extend(options)
+        return defer.succeed(None)
+
+
+
+class VoteBatchTest(TestCase):
+
+
+    def setUp(self):
+        self.dispenser = FakeDispenser(3)
+        self.store = FakeBallotStore()
+        self.counter = VoteCounter(self.store, self.dispenser, None,
+            'example.html')
+
+
+    def request(self, options):
+        request = DummyRequest([])
+        request.args[b'token'] = [b'token']
+        request.args[b'option'] = [x.encode('ascii') for x in options]
+        return request
+
+
+    def vote(self, option):
+        return json.loads(self.successResultOf(
+            self.counter.vote(self.request([option]))))
+
+
+    def voteBatch(self, options):
+        return json.loads(self.successResultOf(
+            self.counter.vote_batch(self.request(options))))
+
+
+    def test_voteBatch(self):
+        """
+        Every option is voted for, using that many uses of the token.
+        """
+        self.assertEqual(self.voteBatch(['a', 'b']), {'votes': 2})
+        self.assertEqual(self.store.votes, ['a', 'b'])
+        self.assertEqual(self.dispenser.uses, 1)
+
+
+    def test_tooFewUses(self):
+        """
+        Nothing is voted for if the token has too few uses left.
+        """
+        self.assertEqual(self.voteBatch(['a', 'b', 'c', 'd']),
+            {'error': 'Token already used'})
+        self.assertEqual(self.store.votes, [])
+        self.assertEqual(self.dispenser.uses, 3)
+
+
+    def test_refund(self):
+        """
+        If the votes can't be recorded, the token's uses are given back.
+        """
+        self.store.error = Exception('db down')
+        self.assertEqual(self.voteBatch(['a', 'b']), {'error': 'db down'})
+        self.assertEqual(self.dispenser.uses, 3)
+
+
+    def test_notAnOption(self):
+        """
+        Ballots with an unknown option are refused before the token is used.
+        """
+        self.assertEqual(self.voteBatch(['a', 'z']),
+            {'error': "'z' is not an option"})
+        self.assertEqual(self.store.votes, [])
+        self.assertEqual(self.dispenser.calls, 0)
+
+
+    def test_vote(self):
+        """
+        A single vote uses one use of the token.
+        """
+        self.assertEqual(self.vote('a'), {})
+        self.assertEqual(self.store.votes, ['a'])
+        self.assertEqual(self.dispenser.uses, 2)
+
+
+    def test_voteRefund(self):
+        """
+        If a single vote can't be recorded, its use is given back.
+        """
+        self.store.error = Exception('db down')
+        self.assertEqual(self.vote('a'), {'error': 'db down'})
+        self.assertEqual(self.dispenser.uses, 3)
+
+
+    def test_voteNotAnOption(self):
+        """
+        Votes for an unknown option are refused before the token is used.
+        """
+        self.assertEqual(self.vote('z'), {'error': "'z' is not an option"})
+        self.assertEqual(self.dispenser.calls, 0)
+
+
+
+
+class DebugProfileTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.profiler = Profiler(clock=self.clock)
+        self.counter = VoteCounter(None, None, None, 'example.html',
+            admin_token='secret', profiler=self.profiler)
+
+
+    def request(self, admin=True, **args):
+        request = DummyRequest([])
+        if admin:
+            request.requestHeaders.setRawHeaders('authorization',
+                ['Bearer secret'])
+        for key, value in args.items():
+            request.args[key.encode('ascii')] = [value.encode('ascii')]
+        return request
+
+
+    def test_disabled(self):
+        """
+        Without a profiler, there's nothing there.
+        """
+        counter = VoteCounter(None, None, None, 'example.html',
+            admin_token='secret')
+        request = self.request()
+        counter.debug_profile(request)
+        self.assertEqual(request.responseCode, 404)
+
+
+    def test_unauthorized(self):
+        """
+        Only admins can profile.
+        """
+        request = self.request(admin=False)
+        self.counter.debug_profile(request)
+        self.assertEqual(request.responseCode, 401)
+        self.assertFalse(self.profiler.busy)
+
+
+    def test_badArguments(self):
+        """
+        Unknown modes and too long durations are refused.
+        """
+        for args in [{'mode': 'nope'}, {'seconds': '600'}]:
+            request = self.request(**args)
+            self.counter.debug_profile(request)
+            self.assertEqual(request.responseCode, 400)
+        self.assertFalse(self.profiler.busy)
+
+
+    def test_busy(self):
+        """
+        Only one profile is taken at a time.
+        """
+        self.counter.debug_profile(self.request(mode='request'))
+        request = self.request()
+        self.counter.debug_profile(request)
+        self.assertEqual(request.responseCode, 409)
+
+
+    def test_request(self):
+        """
+        The next admin JSON request with an X-Profile header is profiled.
+        """
+        self.counter.token_dispenser = FakeDispenser(3)
+        self.counter.vote_store = FakeBallotStore()
+        d = self.counter.debug_profile(self.request(mode='request'))
+        request = self.request(token='token')
+        request.args[b'option'] = [b'a']
+        request.requestHeaders.setRawHeaders('x-profile', ['1'])
+        self.successResultOf(self.counter.vote_batch(request))
+        self.assertIn(b'function calls', self.successResultOf(d))
+
+
+
+class FakeVoteStore(object):
+    """
+    I count votes for several polls in memory.
+    """
+
+
+    def __init__(self, polls):
+        self.totals = dict((poll, dict((x, 0) for x in options))
+            for poll, options in polls.items())
+
+
+    def _totals(self, poll):
+        if poll not in self.totals:
+            raise NoSuchPoll('%r is not a poll' % (poll,))
+        return self.totals[poll]
+
+
+    def checkVotes(self, options, poll=''):
+        totals = self._totals(poll)
+        for option in options:
+            if option not in totals:
+                raise NotAnOption('%r is not an option' % (option,))
+
+
+    def vote(self, option, ip, poll=''):
+        return self.voteMany([option], ip, poll)
+
+
+    def voteMany(self, options, ip, poll=''):
+        try:
+            self.checkVotes(options, poll)
+        except Exception:
+            return defer.fail()
+        for option in options:
+            self.totals[poll][option] += 1
+        return defer.succeed(None)
+
+
+    def getResults(self, poll=''):
+        try:
+            return defer.succeed(dict(self._totals(poll)))
+        except Exception:
+            return defer.fail()
+
+
+
+class ResultsTest(TestCase):
+
+
+    def setUp(self):
+        self.store = FakeVoteStore({'': ['a', 'b']})
+        self.counter = VoteCounter(self.store, None, None, 'example.html')
+
+
+    def results(self, **headers):
+        """
+        Request C{/results} with C{headers}, the C{callback} argument taken
+        from them if given.
+
+        @return: The request and the response body.
+        """
+        request = DummyRequest([])
+        callback_fn = headers.pop('callback', None)
+        if callback_fn is not None:
+            request.args[b'callback'] = [callback_fn.encode('ascii')]
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name.replace('_', '-'),
+                [value])
+        body = self.successResultOf(self.counter.results(request))
+        return request, body
+
+
+    def etag(self, request):
+        return request.responseHeaders.getRawHeaders('etag')[0]
+
+
+    def test_notModified(self):
+        """
+        A request whose If-None-Match matches the results' ETag gets a 304
+        with an empty body.
+        """
+        request, body = self.results()
+        self.assertEqual(json.loads(body), {'a': 0, 'b': 0})
+        request, body = self.results(if_none_match=self.etag(request))
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(body, '')
+
+
+    def test_modified(self):
+        """
+        Once the results change, the old ETag no longer matches.
+        """
+        request, _ = self.results()
+        self.store.totals['']['a'] += 1
+        request, body = self.results(if_none_match=self.etag(request))
+        self.assertNotEqual(request.responseCode, 304)
+        self.assertEqual(json.loads(body), {'a': 1, 'b': 0})
+
+
+    def test_notModifiedJSONP(self):
+        """
+        Each callback has its own ETag.
+        """
+        plain, _ = self.results()
+        request, body = self.results(callback='cb',
+            if_none_match=self.etag(plain))
+        self.assertNotEqual(request.responseCode, 304)
+        request, body = self.results(callback='cb',
+            if_none_match=self.etag(request))
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(body, '')
+
+
+    def test_jsonpNotReencoded(self):
+        """
+        JSONP responses wrap the encoded results, which aren't encoded again
+        while they stay the same.
+        """
+        self.results()
+        encoded = self.counter.encoded_results['']
+        def dumps(*args, **kwargs):
+            self.fail('Results encoded again')
+        self.patch(json, 'dumps', dumps)
+        request, body = self.results(callback='cb')
+        self.assertEqual(body, 'cb(%s)' % (encoded.body,))
+
+
+
+class SiteTest(TestCase):
+    """
+    Requests made over HTTP, where argument names and values are bytes.
+    """
+
+
+    def setUp(self):
+        self.store = FakeVoteStore({'': ['a', 'b'], 'other': ['x', 'y']})
+        dispenser = TimedTokenDispenser(use_limit=2,
+            store=MemoryStore(task.Clock()), clock=task.Clock())
+        counter = VoteCounter(self.store, dispenser, None, 'example.html')
+        port = reactor.listenTCP(0, Site(counter.app.resource()),
+            interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.url = 'http://127.0.0.1:%d' % (port.getHost().port,)
+
+
+    @defer.inlineCallbacks
+    def get(self, path, **params):
+        response = yield treq.get(self.url + path, params=params,
+            persistent=False)
+        result = yield treq.json_content(response)
+        defer.returnValue(result)
+
+
+    @defer.inlineCallbacks
+    def test_vote(self):
+        result = yield self.get('/token')
+        result = yield self.get('/vote', token=result['token'], option='a')
+        self.assertEqual(result, {})
+        self.assertEqual(self.store.totals['']['a'], 1)
+
+
+    @defer.inlineCallbacks
+    def test_voteBatch(self):
+        result = yield self.get('/token')
+        result = yield self.get('/vote/batch', token=result['token'],
+            option=['a', 'b'])
+        self.assertEqual(result, {'votes': 2})
+        self.assertEqual(self.store.totals[''], {'a': 1, 'b': 1})
+
+
+    @defer.inlineCallbacks
+    def test_jsonp(self):
+        response = yield treq.get(self.url + '/results',
+            params={'callback': 'cb'}, persistent=False)
+        body = yield treq.content(response)
+        self.assertEqual(body, b'cb({"a": 0, "b": 0})')
+
+
+    @defer.inlineCallbacks
+    def test_polls(self):
+        """
+        Votes and results go to the poll named by the C{poll} argument.
+        """
+        result = yield self.get('/token')
+        result = yield self.get('/vote/batch', token=result['token'],
+            option=['x', 'y'], poll='other')
+        self.assertEqual(result, {'votes': 2})
+        result = yield self.get('/results', poll='other')
+        self.assertEqual(result, {'x': 1, 'y': 1})
+        result = yield self.get('/results')
+        self.assertEqual(result, {'a': 0, 'b': 0})
+
+
+    @defer.inlineCallbacks
+    def test_noSuchPoll(self):
+        result = yield self.get('/results', poll='nope')
+        self.assertEqual(result, {'error': "'nope' is not a poll"})
+        result = yield self.get('/token')
+        result = yield self.get('/vote', token=result['token'], option='a',
+            poll='nope')
+        self.assertEqual(result, {'error': "'nope' is not a poll"})
+
+
+    @defer.inlineCallbacks
+    def test_notAnOption(self):
+        """
+        Votes for unknown options don't use up the token.
+        """
+        result = yield self.get('/token')
+        token = result['token']
+        result = yield self.get('/vote', token=token, option='z')
+        self.assertEqual(result, {'error': "'z' is not an option"})
+        result = yield self.get('/vote/batch', token=token,
+            option=['a', 'z'])
+        self.assertEqual(result, {'error': "'z' is not an option"})
+        result = yield self.get('/vote/batch', token=token,
+            option=['a', 'b'])
+        self.assertEqual(result, {'votes': 2})
+
+
+    @defer.inlineCallbacks
+    def test_notModified(self):
+        """
+        Results which haven't changed since the client's copy get a 304.
+        """
+        response = yield treq.get(self.url + '/results', persistent=False)
+        yield treq.content(response)
+        etag = response.headers.getRawHeaders(b'etag')[0]
+        response = yield treq.get(self.url + '/results',
+            headers={b'If-None-Match': [etag]}, persistent=False)
+        body = yield treq.content(response)
+        self.assertEqual(response.code, 304)
+        self.assertEqual(body, b'')
@@ -1,8 +1,16 @@
 
+import base64
+import binascii
+import hashlib
+import heapq
+import hmac
+import os
+import struct
 import uuid
 from twisted.internet import defer, reactor
 
 from vc.error import NoTokensLeft, InvalidToken
+from vc.metrics import REGISTRY, timer
 
 
 
@@ -11,23 +19,72 @@ from vc.error import NoTokensLeft, InvalidToken
 NOTHING = object()
 
 
+TOKEN_SECONDS = REGISTRY.histogram('vc_token_seconds',
+    'Time spent getting and using tokens', ['operation'])
+_GET_TOKEN_SECONDS = TOKEN_SECONDS.labels('get')
+_USE_TOKEN_SECONDS = TOKEN_SECONDS.labels('use')
+
+
+def _native(data):
+    """
+    Turn ASCII C{bytes} into a native string.
+    """
+    if str is bytes:
+        return data
+    return data.decode('ascii')
+
+
 class MemoryStore(object):
     """
     I am an asynchronous, in-memory key-value store.
+
+    Expired keys are removed lazily when they are next touched and by a
+    single periodic sweep over a heap of deadlines, rather than by one timer
+    per key.
+
+    Values are never changed in place, so a copy of L{dump} stays
+    consistent.
     """
 
 
-    def __init__(self, clock=None):
+    def __init__(self, clock=None, sweep_interval=1):
+        """
+        @param sweep_interval: Seconds between sweeps for expired keys.
+        """
         self._data = {}
+        self._deadlines = {}
+        self._heap = []
+        self._sweeper = None
         self.clock = clock
+        self.sweep_interval = sweep_interval
+        # Told about every change, if set.  See L{vc.persist.StoreJournal}.
+        self.journal = None
+
+
+    def __len__(self):
+        """
+        Number of keys held, including expired keys not yet swept.
+        """
+        return len(self._data)
+
+
+    def pendingExpiries(self):
+        """
+        Number of deadlines waiting to be swept, including stale ones for
+        keys which were removed or given a new deadline.
+        """
+        return len(self._heap)
 
     
     def setValue(self, key, value):
+        self._expireIfDue(key)
         self._data[key] = value
+        self._changed(key)
         return defer.succeed(None)
 
 
     def getValue(self, key, default=NOTHING):
+        self._expireIfDue(key)
         if key in self._data:
             return defer.succeed(self._data[key])
         else:
@@ -38,33 +95,228 @@ class MemoryStore(object):
 
 
     def rmValue(self, key):
+        self._expireIfDue(key)
         del self._data[key]
+        self._deadlines.pop(key, None)
+        self._changed(key)
         return defer.succeed(None)
 
 
     def exists(self, key):
+        self._expireIfDue(key)
         return defer.succeed(key in self._data)
 
 
-    def increment(self, key, amount):
+    def increment(self, key, amount, expire=None):
         """
         Increment a value by a certain amount.
+
+        @param expire: If the key is created by this increment, it expires
+            in this many seconds.
         """
+        self._expireIfDue(key)
         if key not in self._data:
             self._data[key] = 0
+            if expire is not None:
+                self._setDeadline(key, expire)
         self._data[key] += amount
+        self._changed(key)
         return defer.succeed(self._data[key])
 
 
+    def take(self, key, amount=1, initial=None, expire=None,
+            remove_empty=False):
+        """
+        Atomically take C{amount} from the count at C{key}, but only if there
+        is that much left.
+
+        @param initial: If the key doesn't exist, it's created with this count
+            before taking.  If C{None}, a missing key has nothing to take.
+        @param expire: If the key is created, it expires in this many seconds.
+        @param remove_empty: If C{True}, remove the key once nothing is left.
+
+        @return: A Deferred firing with the count left, or C{None} if there
+            wasn't enough to take.
+        """
+        self._expireIfDue(key)
+        created = key not in self._data
+        if created:
+            if initial is None:
+                return defer.succeed(None)
+            self._data[key] = initial
+            if expire is not None:
+                self._setDeadline(key, expire)
+        left = self._data[key] - amount
+        if left < 0:
+            if created:
+                self._changed(key)
+            return defer.succeed(None)
+        if left == 0 and remove_empty:
+            self._maybeRemove(key)
+        else:
+            self._data[key] = left
+        self._changed(key)
+        return defer.succeed(left)
+
+
+    def put(self, key, amount, full):
+        """
+        Atomically add C{amount} to the count at C{key}, removing the key once
+        the count reaches C{full}.
+
+        @return: A Deferred firing with the new count.
+        """
+        self._expireIfDue(key)
+        value = self._data.get(key, 0) + amount
+        if value >= full:
+            self._maybeRemove(key)
+        else:
+            self._data[key] = value
+        self._changed(key)
+        return defer.succeed(value)
+
+
+    def hit(self, key, limit, window):
+        """
+        Atomically record a hit at C{key}, unless there have already been
+        C{limit} hits in the last C{window} seconds.
+
+        Only the times of the last C{limit} hits are kept, and the key
+        expires once they're all C{window} seconds old.
+
+        @return: A Deferred firing with the number of hits left in the
+            window, or C{None} if there were none left.
+        """
+        self._expireIfDue(key)
+        now = self.clock.seconds()
+        hits = tuple(t for t in self._data.get(key, ()) if t + window > now)
+        if len(hits) >= limit:
+            return defer.succeed(None)
+        hits += (now,)
+        self._data[key] = hits
+        self._setDeadline(key, window)
+        self._changed(key)
+        return defer.succeed(limit - len(hits))
+
+
+    # Methods which may be used in a pipeline.
+    operations = frozenset(['setValue', 'getValue', 'rmValue', 'exists',
+        'increment', 'expire', 'take', 'put', 'hit'])
+
+
+    def pipeline(self, operations):
+        """
+        Run several operations in one round trip.
+
+        @param operations: A list of tuples of a method name (one of
+            L{operations}) followed by its arguments, for instance
+            C{[('increment', 'foo', 1), ('expire', 'foo', 60)]}.
+
+        @return: A Deferred firing with the list of results, or failing with
+            the first operation's error.  Operations are applied in order and
+            those before a failed operation are not undone.
+        """
+        ds = []
+        for operation in operations:
+            name, args = operation[0], operation[1:]
+            if name not in self.operations:
+                ds.append(defer.fail(ValueError(
+                    '%r is not a pipeline operation' % (name,))))
+                break
+            ds.append(getattr(self, name)(*args))
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addErrback(lambda err: err.value.subFailure)
+        return d
+
+
     def _maybeRemove(self, key):
         self._data.pop(key, None)
+        self._deadlines.pop(key, None)
+
+
+    def _expireIfDue(self, key):
+        deadline = self._deadlines.get(key)
+        if deadline is not None and deadline <= self.clock.seconds():
+            self._maybeRemove(key)
 
 
     def expire(self, key, seconds):
         """
         Set a key to expire in C{seconds} seconds.
         """
-        self.clock.callLater(seconds, self._maybeRemove, key)
+        self._expireIfDue(key)
+        if key in self._data:
+            self._setDeadline(key, seconds)
+            self._changed(key)
+        return defer.succeed(None)
+
+
+    def dump(self):
+        """
+        Return copies of the values and deadlines of every key, as a tuple of
+        two dicts.
+        """
+        return self._data.copy(), self._deadlines.copy()
+
+
+    def restore(self, data, deadlines):
+        """
+        Replace everything held with C{data} and C{deadlines}, as returned by
+        L{dump}.
+        """
+        self._data = data
+        self._deadlines = deadlines
+        self._heap = [(deadline, key) for key, deadline in deadlines.items()]
+        heapq.heapify(self._heap)
+        if self._heap and self._sweeper is None:
+            self._sweeper = self.clock.callLater(self.sweep_interval,
+                self._sweep)
+
+
+    def merge(self, data, deadlines):
+        """
+        Add the keys in C{data} and C{deadlines}, as returned by L{dump}, to
+        those held, replacing any already held.
+        """
+        self._data.update(data)
+        self._deadlines.update(deadlines)
+        for key, deadline in deadlines.items():
+            heapq.heappush(self._heap, (deadline, key))
+        if self._heap and self._sweeper is None:
+            self._sweeper = self.clock.callLater(self.sweep_interval,
+                self._sweep)
+
+
+    def _changed(self, key):
+        if self.journal is not None:
+            self.journal.changed(key, self._data.get(key, NOTHING),
+                self._deadlines.get(key))
+
+
+    def _setDeadline(self, key, seconds):
+        deadline = self.clock.seconds() + seconds
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if self._sweeper is None:
+            self._sweeper = self.clock.callLater(self.sweep_interval,
+                self._sweep)
+
+
+    def _sweep(self):
+        """
+        Remove every key whose deadline has passed.
+        """
+        self._sweeper = None
+        now = self.clock.seconds()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            # Skip entries for keys that were removed or given a new deadline.
+            if self._deadlines.get(key) == deadline:
+                self._maybeRemove(key)
+        if heap:
+            self._sweeper = self.clock.callLater(self.sweep_interval,
+                self._sweep)
 
 
 
@@ -72,13 +324,22 @@ class TimedTokenDispenser(object):
     
 
     def __init__(self, available=3, refresh=60, use_limit=1, expiration=120,
-            store=None, clock=reactor):
+            store=None, clock=reactor, secret=None, sliding_window=False):
         """
         @param available: Number of tokens available per key.
         @param refresh: Seconds after which a token becomes available
             again for a particular key.
         @param use_limit: Number of times a token can be used.
         @param expiration: Seconds after which a token can't be used.
+        @param secret: If given, tokens are signed with this key and carry
+            their own expiration and use limit, so nothing is stored for a
+            token until it is used.  Every dispenser sharing a secret (and a
+            store) accepts the others' tokens.
+        @param sliding_window: If C{True}, the times of the last C{available}
+            tokens given out for a key are kept with the store's C{hit}, and
+            a token is available when the oldest is C{refresh} seconds old.
+            This gives out tokens exactly when restoring each token after
+            C{refresh} seconds would, without a timer per token.
         """
         self.available = available
         self.refresh = refresh
@@ -86,51 +347,148 @@ class TimedTokenDispenser(object):
         self.expiration = expiration
         self.store = store
         self.clock = clock
+        if secret is not None and not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.sliding_window = sliding_window
 
 
-    @defer.inlineCallbacks
     def getToken(self, key, check_available=True):
         """
         @param key: Some identifying key, like an IP address.
         @param check_available: If C{False} then return a token whether there
             is one available or not.
         """
-        if check_available:
+        start = timer()
+        return _GET_TOKEN_SECONDS.observeDeferred(
+            self._getToken(key, check_available), start)
+
+
+    @defer.inlineCallbacks
+    def _getToken(self, key, check_available):
+        if check_available and self.sliding_window:
+            tokens_left = yield self.store.hit('W:' + key, self.available,
+                self.refresh)
+            if tokens_left is None:
+                raise NoTokensLeft('No tokens left')
+        elif check_available:
             key_key = 'K:' + key
-            exists = yield self.store.exists(key_key)
-            # XXX this exposes a race condition because some other process might
-            # cause it to exist between this line and the next yield.
-            if not exists:
-                yield self.store.setValue(key_key, self.available + 1)
-            tokens_left = yield self.store.increment(key_key, -1)
-            if tokens_left <= 0:
-                # XXX another race condition between the above yield and this
-                yield self.store.increment(key_key, 1)
+            tokens_left = yield self.store.take(key_key,
+                initial=self.available)
+            if tokens_left is None:
                 raise NoTokensLeft('No tokens left')
-            a = self.clock.callLater(self.refresh, self._restoreToken, key_key)
+            self.clock.callLater(self.refresh, self._restoreToken, key_key)
+
+        if self.secret is not None:
+            defer.returnValue(self._signToken())
 
         # make a new token
         token = str(uuid.uuid4())
         token_key = 'TK:' + token
-        yield self.store.increment(token_key, self.use_limit)
-        yield self.store.expire(token_key, self.expiration)
+        yield self.store.increment(token_key, self.use_limit,
+            expire=self.expiration)
         defer.returnValue(token)
 
 
+    def useToken(self, token, uses=1):
+        """
+        Use a token C{uses} times, all at once: if it has fewer uses left,
+        none are used.
+
+        @return: A Deferred which fails with L{InvalidToken} if the token
+            can't be used.
+        """
+        start = timer()
+        if self.secret is not None:
+            d = self._useSignedToken(token, uses)
+        else:
+            d = self._useStoredToken(token, uses)
+        return _USE_TOKEN_SECONDS.observeDeferred(d, start)
+
+
     @defer.inlineCallbacks
-    def useToken(self, token):
+    def _useStoredToken(self, token, uses):
         token_key = 'TK:' + token
-        uses_left = yield self.store.increment(token_key, -1)
-        if uses_left <= 0:
-            yield self.store.rmValue(token_key)
-        if uses_left < 0:
+        uses_left = yield self.store.take(token_key, uses, remove_empty=True)
+        if uses_left is None:
             raise InvalidToken('Token already used')
 
 
+    def refundToken(self, token, uses=1):
+        """
+        Give back C{uses} uses of a token, after what they were used for
+        failed.
+        """
+        if self.secret is not None:
+            token_id, expires, _ = self._verifyToken(token)
+            remaining = expires / 1000.0 - self.clock.seconds()
+            if remaining <= 0:
+                return defer.succeed(None)
+            key = 'TU:' + _native(binascii.hexlify(token_id))
+        else:
+            # The key may have been removed once empty, so it may come back
+            # with a fresh expiration.
+            key = 'TK:' + token
+            remaining = self.expiration
+        return self.store.increment(key, uses, expire=remaining)
+
+
+    # A signed token is a random id, an expiration time in milliseconds and
+    # a use limit followed by a truncated HMAC of the three, base64 encoded.
+    _signed_format = struct.Struct('>8sQH')
+    _mac_size = 16
+
+
+    def _mac(self, payload):
+        return hmac.new(self.secret, payload,
+            hashlib.sha256).digest()[:self._mac_size]
+
+
+    def _signToken(self):
+        expires = int((self.clock.seconds() + self.expiration) * 1000)
+        payload = self._signed_format.pack(os.urandom(8), expires,
+            self.use_limit)
+        token = base64.urlsafe_b64encode(payload + self._mac(payload))
+        return _native(token.rstrip(b'='))
+
+
+    def _verifyToken(self, token):
+        """
+        Check a signed token's signature.
+
+        @return: A tuple of the token's (id, expiration, use limit).
+        @raise InvalidToken: If the token wasn't signed by us.
+        """
+        try:
+            raw = token.encode('ascii')
+            raw = base64.urlsafe_b64decode(raw + b'=' * (-len(raw) % 4))
+        except (ValueError, TypeError, UnicodeError, binascii.Error):
+            raise InvalidToken('Invalid token')
+        size = self._signed_format.size
+        if len(raw) != size + self._mac_size:
+            raise InvalidToken('Invalid token')
+        payload, mac = raw[:size], raw[size:]
+        if not hmac.compare_digest(mac, self._mac(payload)):
+            raise InvalidToken('Invalid token')
+        return self._signed_format.unpack(payload)
+
+
     @defer.inlineCallbacks
+    def _useSignedToken(self, token, uses):
+        token_id, expires, use_limit = self._verifyToken(token)
+        remaining = expires / 1000.0 - self.clock.seconds()
+        if remaining <= 0:
+            raise InvalidToken('Token expired')
+        # Only tokens which have been used take up space in the store, where
+        # the uses they have left are kept.
+        uses_key = 'TU:' + _native(binascii.hexlify(token_id))
+        uses_left = yield self.store.take(uses_key, uses, initial=use_limit,
+            expire=remaining)
+        if uses_left is None:
+            raise InvalidToken('Token already used')
+
+
     def _restoreToken(self, key_key):
-        tokens_left = yield self.store.increment(key_key, 1)
-        if tokens_left == (self.available + 1):
-            yield self.store.rmValue(key_key)
+        return self.store.put(key_key, 1, self.available)
 
 
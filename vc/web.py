@@ -1,11 +1,31 @@
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 from twisted.web.static import File
-import treq
+from twisted.web import http
+from twisted.web.client import Agent, HTTPConnectionPool
+from treq.client import HTTPClient
 from klein import Klein
 
+from vc.error import CaptchaFailed, Overloaded
+from vc.sql import DEFAULT_POLL
+from vc.stream import ResultsBroadcaster
+from vc.metrics import REGISTRY, timer
+
+from collections import OrderedDict
 from functools import wraps
+from io import BytesIO
 
+import gzip
+import hashlib
+import hmac
 import json
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 def getIP(request):
@@ -15,58 +35,482 @@ def getIP(request):
     return ip
 
 
+def getArgs(request, name):
+    """
+    Return every value of the query argument C{name}, as text.  Twisted
+    gives argument names and values as bytes on Python 3.
+    """
+    values = request.args.get(name)
+    if values is None:
+        values = request.args.get(name.encode('ascii'), [])
+    return [x.decode('utf-8') if isinstance(x, bytes) else x for x in values]
+
+
+def getArg(request, name, default=None):
+    """
+    Return the first value of the query argument C{name}, as text, or
+    C{default} if it wasn't given.
+    """
+    values = getArgs(request, name)
+    if not values:
+        return default
+    return values[0]
+
+
+def jsonp(body, callback_fn):
+    """
+    Wrap an already-encoded JSON C{body} in a JSONP callback, if there is one.
+    """
+    if callback_fn:
+        return '%s(%s)' % (callback_fn, body)
+    return body
+
+
+def hexdigest(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def etagMatches(request, etag):
+    """
+    Return C{True} if C{request}'s If-None-Match header matches C{etag}.
+    """
+    tags = request.getHeader('if-none-match')
+    if not tags:
+        return False
+    tags = [x.strip() for x in tags.split(',')]
+    return etag in tags or '*' in tags
+
+
+REQUEST_SECONDS = REGISTRY.histogram('vc_request_seconds',
+    'Time spent handling requests', ['route'])
+REQUESTS = REGISTRY.counter('vc_requests_total',
+    'Requests handled', ['route', 'outcome'])
+CAPTCHA_SECONDS = REGISTRY.histogram('vc_captcha_seconds',
+    'Time spent verifying captchas')
+CAPTCHA_CHECKS = REGISTRY.counter('vc_captcha_checks_total',
+    'Captcha answers checked', ['source'])
+CAPTCHA_WAITING = REGISTRY.gauge('vc_captcha_waiting',
+    'Captcha checks waiting for a connection to the verifier')
+
+
+def isAdmin(request, admin_token):
+    """
+    Return C{True} if C{request} carries C{admin_token} as a bearer token.
+    Nobody is an admin if C{admin_token} is C{None}.
+    """
+    if not admin_token:
+        return False
+    authorization = request.getHeader('authorization') or ''
+    if isinstance(authorization, bytes):
+        authorization = authorization.decode('latin-1')
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer':
+        return False
+    return hmac.compare_digest(token.strip().encode('utf-8'),
+        admin_token.encode('utf-8'))
+
+
 def jsonHandler(func):
+    seconds = REQUEST_SECONDS.labels(func.__name__)
+    succeeded = REQUESTS.labels(func.__name__, 'ok')
+    failed = REQUESTS.labels(func.__name__, 'error')
+    rejected = REQUESTS.labels(func.__name__, 'rejected')
     @wraps(func)
     @defer.inlineCallbacks
     def deco(instance, request, *args, **kwargs):
-        callback_fn = request.args.get('callback', [None])[0]
+        start = timer()
+        callback_fn = getArg(request, 'callback')
         request.setHeader('Content-Type', 'application/json')
+        profiler = getattr(instance, 'profiler', None)
         try:
-            result = yield func(instance, request, *args, **kwargs)
+            if profiler is not None and profiler.wants(request) and \
+                    isAdmin(request, instance.admin_token):
+                result = yield profiler.profile(func, instance, request,
+                    *args, **kwargs)
+            else:
+                result = yield func(instance, request, *args, **kwargs)
+            succeeded.inc()
+        except Overloaded as e:
+            # A script tag won't run the body of an error response, so JSONP
+            # clients get theirs with a 200 like any other error; plain JSON
+            # clients get a 503.
+            if not callback_fn:
+                request.setResponseCode(503)
+            request.setHeader('Retry-After', str(int(e.retry_after)))
+            result = {'error': str(e), 'retry_after': e.retry_after}
+            rejected.inc()
         except Exception as e:
             # XXX since jquery is awesome and doesn't handle error codes
             #request.setResponseCode(400)
             result = {'error': str(e)}
-        result = json.dumps(result)
-        if callback_fn:
-            result = '%s(%s)' % (callback_fn, result)
+            failed.inc()
+        seconds.observe(timer() - start)
+        defer.returnValue(jsonp(json.dumps(result), callback_fn))
+    return deco
+
+
+def admitted(func):
+    """
+    Only run a L{VoteCounter} route when its admission controller, if it has
+    one, has room for it.  Requests that give up while waiting lose their
+    place in the queue.
+    """
+    @wraps(func)
+    @defer.inlineCallbacks
+    def deco(instance, request, *args, **kwargs):
+        controller = instance.admission.get(func.__name__)
+        if controller is None:
+            result = yield func(instance, request, *args, **kwargs)
+            defer.returnValue(result)
+        waiting = controller.acquire()
+        request.notifyFinish().addErrback(lambda _: waiting.cancel())
+        yield waiting
+        start = controller.clock.seconds()
+        try:
+            result = yield func(instance, request, *args, **kwargs)
+        finally:
+            controller.release(controller.clock.seconds() - start)
         defer.returnValue(result)
     return deco
 
 
+
+class EncodedResults(object):
+    """
+    I hold the JSON encoding of the latest results, so that totals which
+    haven't changed aren't encoded again.
+
+    @ivar body: The encoded results.
+    @ivar etag: A quoted ETag which changes only when the results do.
+    """
+
+
+    def __init__(self):
+        self.results = None
+        self.body = None
+        self.etag = None
+
+
+    def update(self, results):
+        """
+        Make C{results} the latest results, encoding them if they changed.
+        """
+        if results != self.results:
+            self.results = dict(results)
+            self.body = json.dumps(self.results, sort_keys=True)
+            self.etag = '"%s"' % (hexdigest(self.body)[:16],)
+
+
+    def etagFor(self, callback_fn):
+        """
+        Return the ETag of the response wrapped in C{callback_fn}.
+        """
+        if not callback_fn:
+            return self.etag
+        return '%s-%s"' % (self.etag[:-1], hexdigest(callback_fn)[:8])
+
+
+def chooseEncoding(accept_encoding, available):
+    """
+    Pick a content-coding acceptable to the client.
+
+    @param accept_encoding: The request's Accept-Encoding header, or C{None}.
+    @param available: Codings we can send, most preferred first.
+
+    @return: One of C{available}, or C{None} for the unencoded body.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+    default = qualities.get('*', 0.0)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = qualities.get(coding, default)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+
+class CachedFile(object):
+    """
+    I serve a file from memory along with precompressed copies of it.  The
+    file is read again only when its modification time changes, which is
+    checked at most once every C{check_interval} seconds.
+    """
+
+
+    def __init__(self, path, max_age=60, check_interval=1, clock=reactor):
+        """
+        @param max_age: Seconds clients may cache the file for.
+        """
+        self.path = path
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.clock = clock
+        self.content_type = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        self.mtime = None
+        self.etag = None
+        self.variants = {}
+        self._checked = None
+
+
+    def _refresh(self):
+        now = self.clock.seconds()
+        if self._checked is not None and \
+                now < self._checked + self.check_interval:
+            return
+        self._checked = now
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        variants = {None: body}
+        buf = BytesIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+        gz.write(body)
+        gz.close()
+        variants['gzip'] = buf.getvalue()
+        if brotli is not None:
+            variants['br'] = brotli.compress(body)
+        self.variants = variants
+        self.etag = hexdigest(body)[:16]
+        self.mtime = mtime
+
+
+    def _notModified(self, request, etag):
+        if request.getHeader('if-none-match'):
+            return etagMatches(request, etag)
+        since = request.getHeader('if-modified-since')
+        if since:
+            if not isinstance(since, bytes):
+                since = since.encode('ascii', 'replace')
+            try:
+                since = http.stringToDatetime(since.split(b';', 1)[0])
+            except ValueError:
+                return False
+            return int(self.mtime) <= since
+        return False
+
+
+    def render(self, request):
+        self._refresh()
+        coding = chooseEncoding(request.getHeader('accept-encoding'),
+            [x for x in ('br', 'gzip') if x in self.variants])
+        etag = '"%s%s"' % (self.etag, '-' + coding if coding else '')
+        request.setHeader('Content-Type', self.content_type)
+        request.setHeader('Vary', 'Accept-Encoding')
+        request.setHeader('ETag', etag)
+        request.setHeader('Last-Modified',
+            http.datetimeToString(int(self.mtime)))
+        request.setHeader('Cache-Control', 'public, max-age=%d' % (
+            self.max_age,))
+        if self._notModified(request, etag):
+            request.setResponseCode(304)
+            return b''
+        if coding:
+            request.setHeader('Content-Encoding', coding)
+        return self.variants[coding]
+
+
+
 class VoteCounter(object):
 
     app = Klein()
 
 
     def __init__(self, vote_store, token_dispenser, captcha_verifier,
-            index_file):
+            index_file, stream_interval=1, registry=REGISTRY, exporter=None,
+            admin_token=None, admission=None, profiler=None):
+        """
+        @param stream_interval: Seconds between updates sent to clients of
+            C{/results/stream}.
+        @param registry: The L{vc.metrics.Registry} served at C{/metrics}.
+        @param exporter: A L{vc.export.VoteExporter} serving C{/export}.
+        @param admin_token: Bearer token required by admin-only endpoints
+            such as C{/export}.  If C{None} they're disabled.
+        @param admission: A dict of route names (C{'token'}, C{'vote'},
+            C{'vote_batch'}) to
+            the L{vc.admission.AdmissionController} limiting them.  Routes
+            without one aren't limited.
+        @param profiler: A L{vc.profiling.Profiler} driven from the
+            admin-only C{/debug/profile}.  If C{None} it's disabled.
+        """
         self.vote_store = vote_store
         self.token_dispenser = token_dispenser
         self.captcha_verifier = captcha_verifier
         self.index_file = index_file
+        self.index_resource = CachedFile(index_file)
+        self.stream_interval = stream_interval
+        # poll: EncodedResults
+        self.encoded_results = {}
+        # poll: ResultsBroadcaster
+        self.broadcasters = {}
+        self.registry = registry
+        self.exporter = exporter
+        self.admin_token = admin_token
+        self.admission = admission or {}
+        self.profiler = profiler
 
 
     @app.route('/')
     def index(self, request):
-        return open(self.index_file, 'rb').read()
+        return self.index_resource.render(request)
 
 
     @app.route('/results')
+    def results(self, request):
+        start = timer()
+        return REQUEST_SECONDS.labels('results').observeDeferred(
+            self._results(request), start)
+
+
+    @defer.inlineCallbacks
+    def _results(self, request):
+        callback_fn = getArg(request, 'callback')
+        request.setHeader('Content-Type', 'application/json')
+        poll = getArg(request, 'poll', DEFAULT_POLL)
+        try:
+            results = yield self.vote_store.getResults(poll)
+        except Exception as e:
+            REQUESTS.labels('results', 'error').inc()
+            defer.returnValue(jsonp(json.dumps({'error': str(e)}), callback_fn))
+        REQUESTS.labels('results', 'ok').inc()
+        encoded = self.encoded_results.get(poll)
+        if encoded is None:
+            encoded = self.encoded_results[poll] = EncodedResults()
+        encoded.update(results)
+        etag = encoded.etagFor(callback_fn)
+        request.setHeader('ETag', etag)
+        request.setHeader('Cache-Control', 'no-cache')
+        if etagMatches(request, etag):
+            request.setResponseCode(304)
+            defer.returnValue('')
+        defer.returnValue(jsonp(encoded.body, callback_fn))
+
+
+    @app.route('/results/timeseries')
     @jsonHandler
+    def timeseries(self, request):
+        minutes = int(getArg(request, 'minutes', 60))
+        if not 1 <= minutes <= 1440:
+            raise ValueError('minutes must be between 1 and 1440')
+        poll = getArg(request, 'poll', DEFAULT_POLL)
+        return self.vote_store.getTimeseries(minutes, poll)
+
+
+    @app.route('/results/stream')
     @defer.inlineCallbacks
-    def results(self, request):        
-        results = yield self.vote_store.getResults()
-        defer.returnValue(results)
+    def results_stream(self, request):
+        poll = getArg(request, 'poll', DEFAULT_POLL)
+        broadcaster = self.broadcasters.get(poll)
+        if broadcaster is None:
+            # Only make broadcasters for polls that exist.
+            try:
+                yield self.vote_store.getResults(poll)
+            except Exception as e:
+                request.setResponseCode(404)
+                defer.returnValue(str(e).encode('utf-8'))
+            broadcaster = self.broadcasters.get(poll)
+            if broadcaster is None:
+                broadcaster = self.broadcasters[poll] = ResultsBroadcaster(
+                    self.vote_store, interval=self.stream_interval, poll=poll)
+        result = yield broadcaster.subscribe(request)
+        defer.returnValue(result)
+
+
+    @app.route('/metrics')
+    def metrics(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
+
+
+    @app.route('/export')
+    def export(self, request):
+        if self.exporter is None or not self.admin_token:
+            request.setResponseCode(404)
+            return b''
+        if not isAdmin(request, self.admin_token):
+            request.setResponseCode(401)
+            request.setHeader('WWW-Authenticate', 'Bearer')
+            return b''
+        format = getArg(request, 'format', 'csv')
+        try:
+            return self.exporter.export(request, format)
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e).encode('utf-8')
+
+
+    @app.route('/debug/profile')
+    def debug_profile(self, request):
+        """
+        Profile the server for C{seconds} and return the result as text.
+        C{mode} is one of:
+
+          - C{sample} (the default): collapsed stacks for a flame graph.
+          - C{steps}: C{inlineCallbacks} steps slower than C{threshold}
+            milliseconds.
+          - C{request}: C{cProfile} statistics for the next admin request
+            with an C{X-Profile} header.
+        """
+        if self.profiler is None or not self.admin_token:
+            request.setResponseCode(404)
+            return b''
+        if not isAdmin(request, self.admin_token):
+            request.setResponseCode(401)
+            request.setHeader('WWW-Authenticate', 'Bearer')
+            return b''
+        if self.profiler.busy:
+            request.setResponseCode(409)
+            return b'Already profiling'
+        mode = getArg(request, 'mode', 'sample')
+        try:
+            seconds = float(getArg(request, 'seconds', 10))
+            if not 0 < seconds <= self.profiler.max_seconds:
+                raise ValueError('seconds must be between 0 and %d' % (
+                    self.profiler.max_seconds,))
+            if mode == 'sample':
+                d = self.profiler.sample(seconds)
+            elif mode == 'steps':
+                threshold = float(getArg(request, 'threshold', 10))
+                d = self.profiler.slowSteps(seconds, threshold / 1000.0)
+            elif mode == 'request':
+                d = self.profiler.profileRequest(seconds)
+            else:
+                raise ValueError('Unknown mode %r' % (mode,))
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e).encode('utf-8')
+        request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        request.notifyFinish().addErrback(lambda _: self.profiler.stop())
+        return d.addCallback(lambda text: text.encode('utf-8'))
 
 
     @app.route('/token', methods=['GET'])
     @jsonHandler
+    @admitted
     @defer.inlineCallbacks
     def token(self, request):
         ip = getIP(request)
-        captcha_challenge = request.args.get('recaptcha_challenge_field', [None])[0]
-        captcha_response = request.args.get('recaptcha_response_field', [None])[0]
+        captcha_challenge = getArg(request, 'recaptcha_challenge_field')
+        captcha_response = getArg(request, 'recaptcha_response_field')
         token = None
         if captcha_challenge and captcha_response:
             yield self.captcha_verifier.assertVerified(
@@ -81,36 +525,194 @@ class VoteCounter(object):
 
     @app.route('/vote')
     @jsonHandler
+    @admitted
     @defer.inlineCallbacks
     def vote(self, request):
-        option = request.args.get('option', [None])[0]
-        token = request.args.get('token', [None])[0]
+        option = getArg(request, 'option')
+        poll = getArg(request, 'poll', DEFAULT_POLL)
+        token = getArg(request, 'token')
         ip = getIP(request)
         if not token:
             raise Exception('You must provide a token')
+        self.vote_store.checkVotes([option], poll)
         yield self.token_dispenser.useToken(token)
-        yield self.vote_store.vote(option, ip)
+        try:
+            yield self.vote_store.vote(option, ip, poll)
+        except Exception as e:
+            yield self.token_dispenser.refundToken(token)
+            raise e
         defer.returnValue({})
 
 
+    @app.route('/vote/batch')
+    @jsonHandler
+    @admitted
+    @defer.inlineCallbacks
+    def vote_batch(self, request):
+        """
+        Cast a whole ballot, one vote for each C{option} argument, using
+        that many uses of the token.  Either every vote is recorded or none
+        are and the token's uses are given back.
+        """
+        options = getArgs(request, 'option')
+        poll = getArg(request, 'poll', DEFAULT_POLL)
+        token = getArg(request, 'token')
+        ip = getIP(request)
+        if not token:
+            raise Exception('You must provide a token')
+        if not options:
+            raise Exception('You must choose at least one option')
+        self.vote_store.checkVotes(options, poll)
+        yield self.token_dispenser.useToken(token, len(options))
+        try:
+            yield self.vote_store.voteMany(options, ip, poll)
+        except Exception as e:
+            yield self.token_dispenser.refundToken(token, len(options))
+            raise e
+        defer.returnValue({'votes': len(options)})
+
+
 
 class RecaptchaVerifier(object):
+    """
+    I check captcha answers with reCAPTCHA's verify API.
+
+    Requests go over persistent connections, at most C{concurrency} at a
+    time; more wait their turn.  Each answer's outcome is remembered for
+    C{cache_ttl} seconds, so a client retrying with the same answer doesn't
+    ask the verifier again, and identical answers checked at the same time
+    share one request.
+
+    @ivar url: The verify API's URL.
+    """
 
+    url = 'http://www.google.com/recaptcha/api/verify'
 
-    def __init__(self, private_key):
+
+    def __init__(self, private_key, url=None, concurrency=10, timeout=10,
+            cache_ttl=60, http_client=None, clock=reactor):
+        """
+        @param url: Verify against this URL instead of reCAPTCHA's.
+        @param concurrency: Maximum number of requests to the verifier at
+            once.
+        @param timeout: Seconds after which a request (including any time
+            spent waiting for a connection) fails with
+            C{defer.TimeoutError}.
+        @param cache_ttl: Seconds for which an answer's outcome is
+            remembered.
+        @param http_client: A C{treq.client.HTTPClient} to make requests
+            with.  By default one with its own connection pool is made.
+        """
         self.private_key = private_key
+        if url is not None:
+            self.url = url
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.clock = clock
+        if http_client is None:
+            pool = HTTPConnectionPool(clock)
+            pool.maxPersistentPerHost = concurrency
+            http_client = HTTPClient(Agent(clock, pool=pool))
+        self.http_client = http_client
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._cache = OrderedDict()
+        self._verifying = {}
 
 
     def assertVerified(self, ip, challenge, response):
+        """
+        Fail with L{CaptchaFailed} unless C{response} is the right answer to
+        C{challenge}.
+        """
+        start = timer()
+        return CAPTCHA_SECONDS.observeDeferred(
+            self._check(ip, challenge, response), start)
+
+
+    def _check(self, ip, challenge, response):
+        key = (challenge, response)
+        passed = self._cached(key)
+        if passed is not None:
+            CAPTCHA_CHECKS.labels('cache').inc()
+            d = defer.succeed(passed)
+        else:
+            waiting = self._verifying.get(key)
+            if waiting is None:
+                CAPTCHA_CHECKS.labels('verifier').inc()
+                waiting = self._verifying[key] = []
+                self._queue(ip, challenge, response).addBoth(
+                    self._verified, key)
+            else:
+                CAPTCHA_CHECKS.labels('shared').inc()
+            d = defer.Deferred()
+            waiting.append(d)
+        def checked(passed):
+            if not passed:
+                raise CaptchaFailed('Captcha failed')
+        return d.addCallback(checked)
+
+
+    def _cached(self, key):
+        """
+        Return the remembered outcome for C{key}, or C{None}.
+        """
+        # Entries are added in order of expiry, so expired ones are in front.
+        now = self.clock.seconds()
+        while self._cache:
+            oldest = next(iter(self._cache))
+            if self._cache[oldest][0] > now:
+                break
+            del self._cache[oldest]
+        return self._cache.get(key, (None, None))[1]
+
+
+    def _queue(self, ip, challenge, response):
+        """
+        Verify once a connection is free, or time out.
+        """
+        CAPTCHA_WAITING.inc()
+        def acquired(_):
+            CAPTCHA_WAITING.dec()
+            d = self._verify(ip, challenge, response)
+            d.addBoth(released)
+            return d
+        def abandoned(err):
+            CAPTCHA_WAITING.dec()
+            return err
+        def released(result):
+            self._semaphore.release()
+            return result
+        d = self._semaphore.acquire()
+        d.addCallbacks(acquired, abandoned)
+        d.addTimeout(self.timeout, self.clock)
+        return d
+
+
+    def _verified(self, result, key):
+        waiting = self._verifying.pop(key)
+        if not isinstance(result, Failure):
+            self._cache.pop(key, None)
+            self._cache[key] = (self.clock.seconds() + self.cache_ttl, result)
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+    @defer.inlineCallbacks
+    def _verify(self, ip, challenge, response):
+        """
+        Ask the verifier whether C{response} answers C{challenge}.
+
+        @return: A Deferred firing with C{True} or C{False}.
+        """
         params = {
             'privatekey': self.private_key,
             'remoteip': ip,
             'challenge': challenge,
             'response': response,
         }
-        response = yield treq.post('http://www.google.com/recaptcha/api/verify',
-                params)
-        content = yield treq.content(response)
-        if not content.startswith('true\n'):
-            raise Exception('Captcha failed')
-
+        response = yield self.http_client.post(self.url, data=params)
+        content = yield response.content()
+        defer.returnValue(content.startswith(b'true\n'))